@@ -37,25 +37,26 @@ async def get_llm_chat() -> LlmChat:
         Respond with structured JSON when requested."""
     ).with_model("openai", "gpt-5.2")
 
-def calculate_productivity_metrics(time_entries: list, activity_logs: list, screenshots: list) -> dict:
-    """Calculate productivity metrics from raw data"""
+def calculate_productivity_metrics(time_entries: list, activity_sessions: list, screenshots: list) -> dict:
+    """Calculate productivity metrics from time entries and activity sessions"""
     total_tracked_hours = sum(e.get("duration", 0) for e in time_entries) / 3600
     total_idle_time = sum(e.get("idle_time", 0) for e in time_entries) / 3600
     active_hours = total_tracked_hours - total_idle_time
     
-    # Calculate activity level
-    if activity_logs:
-        avg_activity = sum(a.get("activity_level", 0) for a in activity_logs) / len(activity_logs)
+    # Calculate activity level, weighted by the samples behind each session
+    sample_count = sum(s.get("sample_count", 0) for s in activity_sessions)
+    if sample_count:
+        avg_activity = sum(s.get("activity_sum", 0) for s in activity_sessions) / sample_count
     else:
         avg_activity = 0
     
-    # App usage breakdown
+    # App usage breakdown, in minutes
     app_usage = {}
-    for log in activity_logs:
-        app = log.get("app_name", "Unknown")
+    for session in activity_sessions:
+        app = session.get("app_name", "Unknown")
         if app not in app_usage:
             app_usage[app] = 0
-        app_usage[app] += 1
+        app_usage[app] += round(session.get("duration", 0) / 60, 1)
     
     # Sort by usage
     sorted_apps = sorted(app_usage.items(), key=lambda x: x[1], reverse=True)[:10]
@@ -112,7 +113,7 @@ async def analyze_productivity(
     
     # Build user query based on analysis type and user_id
     time_query = {"start_time": date_query}
-    activity_query = {"timestamp": date_query}
+    activity_query = {"started_at": date_query}
     screenshot_query = {"taken_at": date_query}
     
     if analysis_request.user_id:
@@ -122,11 +123,11 @@ async def analyze_productivity(
     
     # Fetch data
     time_entries = await db.time_entries.find(time_query, {"_id": 0}).to_list(10000)
-    activity_logs = await db.activity_logs.find(activity_query, {"_id": 0}).to_list(10000)
+    activity_sessions = await db.activity_sessions.find(activity_query)
     screenshots = await db.screenshots.find(screenshot_query, {"_id": 0}).to_list(1000)
     
     # Calculate metrics
-    metrics = calculate_productivity_metrics(time_entries, activity_logs, screenshots)
+    metrics = calculate_productivity_metrics(time_entries, activity_sessions, screenshots)
     
     # Get user info for context
     users_info = []
@@ -311,7 +312,7 @@ async def get_app_usage_breakdown(
     start_date = end_date - timedelta(days=days)
     
     query = {
-        "timestamp": {
+        "started_at": {
             "$gte": start_date.isoformat(),
             "$lte": end_date.isoformat()
         }
@@ -320,7 +321,8 @@ async def get_app_usage_breakdown(
     if user_id:
         query["user_id"] = user_id
     
-    activity_logs = await db.activity_logs.find(query, {"_id": 0}).to_list(10000)
+    # Sessions of consecutive samples rather than the samples themselves
+    activity_sessions = await db.activity_sessions.find(query)
     
     # Categorize apps
     categories = {
@@ -335,28 +337,31 @@ async def get_app_usage_breakdown(
     category_usage = {cat: 0 for cat in categories}
     category_usage["other"] = 0
     
-    for log in activity_logs:
-        app = log.get("app_name", "Unknown").lower()
+    for session in activity_sessions:
+        app = session.get("app_name", "Unknown").lower()
+        samples = session.get("sample_count", 0)
         
         if app not in app_usage:
             app_usage[app] = {
                 "count": 0,
-                "total_activity": 0
+                "total_activity": 0,
+                "seconds": 0
             }
         
-        app_usage[app]["count"] += 1
-        app_usage[app]["total_activity"] += log.get("activity_level", 0)
+        app_usage[app]["count"] += samples
+        app_usage[app]["total_activity"] += session.get("activity_sum", 0)
+        app_usage[app]["seconds"] += session.get("duration", 0)
         
         # Categorize
         categorized = False
         for cat, apps in categories.items():
             if any(a in app for a in apps):
-                category_usage[cat] += 1
+                category_usage[cat] += samples
                 categorized = True
                 break
         
         if not categorized:
-            category_usage["other"] += 1
+            category_usage["other"] += samples
     
     # Calculate averages and sort
     for app in app_usage:
@@ -370,6 +375,7 @@ async def get_app_usage_breakdown(
             {
                 "name": app,
                 "usage_count": data["count"],
+                "minutes": round(data["seconds"] / 60, 1),
                 "avg_activity_level": data.get("avg_activity", 0)
             }
             for app, data in sorted_apps
@@ -383,5 +389,5 @@ async def get_app_usage_breakdown(
             "end": end_date.isoformat()[:10],
             "days": days
         },
-        "total_activities": len(activity_logs)
+        "total_activities": sum(s.get("sample_count", 0) for s in activity_sessions)
     }
@@ -178,15 +178,16 @@ async def get_burnout_risk(user_id: Optional[str] = None, user=Depends(lambda: N
         indicator = await db.get('burnout_indicators', {'user_id': target_user, 'week_start_date': week_start})
 
         if not indicator:
-            time_entries = await db.query('time_entries', {'user_id': target_user})
+            daily_stats = await db.query('daily_user_stats', {'user_id': target_user})
 
-            current_week_entries = [
-                e for e in time_entries
-                if datetime.fromisoformat(e['start_time']).date() >= week_start
+            current_week_days = [
+                d for d in daily_stats
+                if date.fromisoformat(str(d['day'])) >= week_start
             ]
 
-            total_hours = sum(e.get('duration', 0) for e in current_week_entries) / 3600
+            total_hours = sum(d.get('tracked_seconds', 0) for d in current_week_days) / 3600
             avg_daily_hours = total_hours / 7
+            weekend_hours = sum(d.get('tracked_seconds', 0) for d in current_week_days if d.get('is_weekend')) / 3600
 
             risk_level = 'low'
             risk_score = 0
@@ -209,7 +210,7 @@ async def get_burnout_risk(user_id: Optional[str] = None, user=Depends(lambda: N
                 'risk_level': risk_level,
                 'risk_score': risk_score,
                 'avg_daily_hours': round(avg_daily_hours, 2),
-                'weekend_work_hours': 0,
+                'weekend_work_hours': round(weekend_hours, 2),
                 'late_night_hours': 0,
                 'consecutive_work_days': 0,
                 'recommendations': []
@@ -0,0 +1,390 @@
+"""
+Chunked Uploads Routes
+Resumable uploads of screen recordings and video screenshots from the desktop tracker
+"""
+from fastapi import APIRouter, Depends, HTTPException, Request
+from pydantic import BaseModel
+from typing import Dict, Optional
+import asyncio
+import hashlib
+import os
+import uuid
+from datetime import datetime, timezone
+import logging
+
+from utils.auth import get_current_user
+from utils.id_generator import generate_id
+from utils.storage_backends import get_storage, EXTENSIONS
+from utils.video_pipeline import video_pipeline
+
+router = APIRouter(prefix="/storage/uploads", tags=["storage"])
+logger = logging.getLogger(__name__)
+
+# S3 requires every part but the last to be at least 5 MiB
+UPLOAD_CHUNK_SIZE = max(int(os.environ.get('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024)), 5 * 1024 * 1024)
+MAX_VIDEO_UPLOAD_BYTES = int(os.environ.get('MAX_VIDEO_UPLOAD_BYTES', 200 * 1024 * 1024))
+VIDEO_CONTENT_TYPES = ("video/mp4", "video/webm")
+UPLOAD_KINDS = {"recording": "recordings", "video": "videos"}
+
+# Chunks of one upload are written one at a time
+_upload_locks: Dict[str, asyncio.Lock] = {}
+
+
+class UploadInitiateRequest(BaseModel):
+    kind: str  # "recording" (screen_recordings) or "video" (video_screenshots)
+    time_entry_id: str
+    total_size: int
+    content_type: str = "video/mp4"
+    duration: int = 30
+    video_id: Optional[str] = None  # existing video screenshot record to attach the file to
+    app_name: Optional[str] = None
+    window_title: Optional[str] = None
+    metadata: Optional[dict] = None
+
+
+def upload_state(session: Dict) -> Dict:
+    return {
+        "upload_id": session["upload_id"],
+        "status": session["status"],
+        "chunk_size": session["chunk_size"],
+        "total_size": session["total_size"],
+        "received_bytes": session["received_bytes"]
+    }
+
+
+async def read_chunk(request: Request, max_bytes: int) -> bytes:
+    """Read a chunk body, refusing anything longer than the expected chunk"""
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Chunk exceeds {max_bytes} bytes")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+async def get_upload_session(db, upload_id: str, user: Dict) -> Dict:
+    """The caller's upload; other users' uploads are reported as not found"""
+    session = await db.upload_sessions.find_one({"upload_id": upload_id})
+    if not session or session["user_id"] != user["user_id"]:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return session
+
+
+@router.post("/initiate")
+async def initiate_upload(data: UploadInitiateRequest, request: Request, user: dict = Depends(get_current_user)):
+    """
+    Start a resumable upload
+
+    The file is then sent in order as chunks of `chunk_size` bytes (the last
+    one may be shorter) and completed. After an interruption the client asks
+    for the upload's state and continues from `received_bytes`.
+    """
+    db = request.app.state.db
+
+    if data.kind not in UPLOAD_KINDS:
+        raise HTTPException(status_code=400, detail="kind must be 'recording' or 'video'")
+    if data.content_type not in VIDEO_CONTENT_TYPES:
+        raise HTTPException(status_code=415, detail=f"Unsupported content type: {data.content_type}")
+    if data.total_size <= 0 or data.total_size > MAX_VIDEO_UPLOAD_BYTES:
+        raise HTTPException(status_code=400, detail=f"total_size must be between 1 and {MAX_VIDEO_UPLOAD_BYTES} bytes")
+
+    entry = await db.time_entries.find_one({"entry_id": data.time_entry_id})
+    if not entry or entry["user_id"] != user["user_id"]:
+        raise HTTPException(status_code=404, detail="Time entry not found")
+
+    if data.kind == "recording":
+        from utils.consent_checker import ConsentChecker
+        consent_result = await ConsentChecker.check_screen_recording_consent(db, entry["user_id"], entry["company_id"])
+        if not consent_result["has_consent"]:
+            raise HTTPException(
+                status_code=403,
+                detail=f"Screen recording not allowed: {consent_result['reason']}"
+            )
+
+    if data.kind == "video" and data.video_id:
+        video = await db.video_screenshots.find_one({
+            "video_id": data.video_id,
+            "company_id": entry["company_id"],
+            "user_id": entry["user_id"]
+        })
+        if not video:
+            raise HTTPException(status_code=404, detail="Video screenshot not found")
+
+    storage = get_storage()
+    if not storage:
+        raise HTTPException(status_code=503, detail="Storage not configured")
+
+    upload_id = f"upl_{uuid.uuid4().hex}"
+    storage_key = (
+        f"{UPLOAD_KINDS[data.kind]}/{datetime.now().strftime('%Y/%m/%d')}/"
+        f"{upload_id}.{EXTENSIONS[data.content_type]}"
+    )
+    handle = await storage.begin_upload(storage_key, data.content_type)
+
+    now = datetime.now(timezone.utc).isoformat()
+    session = {
+        "upload_id": upload_id,
+        "kind": data.kind,
+        "company_id": entry["company_id"],
+        "user_id": entry["user_id"],
+        "time_entry_id": data.time_entry_id,
+        "storage_type": storage.storage_type,
+        "storage_key": storage_key,
+        "storage_upload_id": handle,
+        "content_type": data.content_type,
+        "total_size": data.total_size,
+        "chunk_size": UPLOAD_CHUNK_SIZE,
+        "received_bytes": 0,
+        "parts": [],
+        "status": "uploading",
+        "details": {
+            "duration": data.duration,
+            "video_id": data.video_id,
+            "app_name": data.app_name,
+            "window_title": data.window_title,
+            "metadata": data.metadata or {}
+        },
+        "created_at": now,
+        "updated_at": now
+    }
+    await db.upload_sessions.insert_one(session)
+
+    return upload_state(session)
+
+
+@router.get("/{upload_id}")
+async def get_upload(upload_id: str, request: Request, user: dict = Depends(get_current_user)):
+    """State of an upload; a resuming client continues from `received_bytes`"""
+    session = await get_upload_session(request.app.state.db, upload_id, user)
+    return upload_state(session)
+
+
+@router.put("/{upload_id}/chunks")
+async def upload_chunk(upload_id: str, offset: int, request: Request, user: dict = Depends(get_current_user)):
+    """
+    Upload the chunk starting at byte `offset`
+
+    The chunk's SHA-256 must be sent in X-Checksum-SHA256. Chunks must arrive
+    in order: a chunk below `received_bytes` was already acknowledged and is
+    accepted without being stored again, one past it is rejected with 409.
+    """
+    db = request.app.state.db
+    lock = _upload_locks.setdefault(upload_id, asyncio.Lock())
+
+    async with lock:
+        session = await get_upload_session(db, upload_id, user)
+        if session["status"] != "uploading":
+            raise HTTPException(status_code=409, detail=f"Upload is {session['status']}")
+
+        chunk_size = session["chunk_size"]
+        received = session["received_bytes"]
+        if offset < 0 or offset % chunk_size != 0:
+            raise HTTPException(status_code=400, detail=f"offset must be a multiple of {chunk_size}")
+        if offset < received or received == session["total_size"]:
+            return upload_state(session)
+        if offset > received:
+            raise HTTPException(
+                status_code=409,
+                detail={"message": "Chunk out of order", "received_bytes": received}
+            )
+
+        expected_size = min(chunk_size, session["total_size"] - offset)
+        data = await read_chunk(request, expected_size)
+        if len(data) != expected_size:
+            raise HTTPException(status_code=400, detail=f"Chunk must be {expected_size} bytes")
+
+        checksum = hashlib.sha256(data).hexdigest()
+        expected_checksum = request.headers.get("x-checksum-sha256")
+        if not expected_checksum:
+            raise HTTPException(status_code=400, detail="X-Checksum-SHA256 header is required")
+        if expected_checksum.lower() != checksum:
+            raise HTTPException(status_code=400, detail="Checksum mismatch")
+
+        storage = get_storage(session["storage_type"])
+        if not storage:
+            raise HTTPException(status_code=503, detail="Storage not configured")
+
+        part_number = offset // chunk_size + 1
+        etag = await storage.write_part(
+            session["storage_key"], session["storage_upload_id"], part_number, offset, data
+        )
+
+        # Acknowledge only once the part is stored; a lost acknowledgement means the chunk is resent
+        session["parts"] = [part for part in session["parts"] if part["part_number"] != part_number] + [{
+            "part_number": part_number,
+            "offset": offset,
+            "size": len(data),
+            "etag": etag,
+            "checksum_sha256": checksum
+        }]
+        session["received_bytes"] = offset + len(data)
+        session["updated_at"] = datetime.now(timezone.utc).isoformat()
+        await db.upload_sessions.update_one(
+            {"upload_id": upload_id},
+            {"$set": {
+                "parts": session["parts"],
+                "received_bytes": session["received_bytes"],
+                "updated_at": session["updated_at"]
+            }}
+        )
+
+    return upload_state(session)
+
+
+@router.post("/{upload_id}/complete")
+async def complete_upload(upload_id: str, request: Request, user: dict = Depends(get_current_user)):
+    """
+    Assemble the uploaded chunks and create the recording or video screenshot record
+
+    Once the chunks are assembled the upload is marked `finished` together
+    with the id of the record to create, so a retried completion after a
+    failure creates or attaches that record without assembling again.
+    """
+    db = request.app.state.db
+    lock = _upload_locks.setdefault(upload_id, asyncio.Lock())
+
+    async with lock:
+        session = await get_upload_session(db, upload_id, user)
+        if session["status"] == "completed":
+            return {**upload_state(session), "result_id": session.get("result_id")}
+        if session["status"] not in ("uploading", "finished"):
+            raise HTTPException(status_code=409, detail=f"Upload is {session['status']}")
+        if session["received_bytes"] != session["total_size"]:
+            raise HTTPException(
+                status_code=409,
+                detail={"message": "Upload is incomplete", "received_bytes": session["received_bytes"]}
+            )
+
+        storage = get_storage(session["storage_type"])
+        if not storage:
+            raise HTTPException(status_code=503, detail="Storage not configured")
+
+        if session["status"] == "uploading":
+            session["storage_key"] = await storage.finish_upload(
+                session["storage_key"], session["storage_upload_id"], session["parts"], session["content_type"]
+            )
+            if session["kind"] == "recording":
+                session["result_id"] = generate_id("recording")
+            else:
+                session["result_id"] = session["details"].get("video_id") or f"video_{uuid.uuid4().hex[:12]}"
+            session["status"] = "finished"
+            await db.upload_sessions.update_one(
+                {"upload_id": upload_id},
+                {"$set": {
+                    "status": "finished",
+                    "storage_key": session["storage_key"],
+                    "result_id": session["result_id"],
+                    "updated_at": datetime.now(timezone.utc).isoformat()
+                }}
+            )
+
+        storage_key = session["storage_key"]
+        result_id = session["result_id"]
+        if session["kind"] == "recording":
+            await _create_recording(db, session, storage)
+        else:
+            await _attach_video(db, session, storage)
+
+        session["status"] = "completed"
+        await db.upload_sessions.update_one(
+            {"upload_id": upload_id},
+            {"$set": {"status": "completed", "updated_at": datetime.now(timezone.utc).isoformat()}}
+        )
+    _upload_locks.pop(upload_id, None)
+    video_pipeline.enqueue(session["kind"], result_id)
+
+    return {
+        **upload_state(session),
+        "result_id": result_id,
+        "url": storage.signed_url(storage_key)[0]
+    }
+
+
+@router.delete("/{upload_id}")
+async def abort_upload(upload_id: str, request: Request, user: dict = Depends(get_current_user)):
+    """Abandon an upload and discard its stored chunks"""
+    db = request.app.state.db
+    lock = _upload_locks.setdefault(upload_id, asyncio.Lock())
+
+    async with lock:
+        session = await get_upload_session(db, upload_id, user)
+        if session["status"] != "uploading":
+            raise HTTPException(status_code=409, detail=f"Upload is {session['status']}")
+
+        storage = get_storage(session["storage_type"])
+        if storage:
+            await storage.abort_upload(session["storage_key"], session["storage_upload_id"])
+        await db.upload_sessions.update_one(
+            {"upload_id": upload_id},
+            {"$set": {"status": "aborted", "updated_at": datetime.now(timezone.utc).isoformat()}}
+        )
+    _upload_locks.pop(upload_id, None)
+
+    return {"status": "aborted", "upload_id": upload_id}
+
+
+async def _create_recording(db, session: Dict, storage):
+    from routes.screen_recordings import save_recording
+
+    # A retried completion may find the recording already created
+    if await db.screen_recordings.find_one({"recording_id": session["result_id"]}):
+        return
+
+    details = session["details"]
+    user = await db.users.find_one({"user_id": session["user_id"]}) or {}
+    recording_doc = {
+        "recording_id": session["result_id"],
+        "company_id": session["company_id"],
+        "user_id": session["user_id"],
+        "entry_id": session["time_entry_id"],
+        "recording_url": storage.reference(session["storage_key"]),
+        "storage_key": session["storage_key"],
+        "storage_type": session["storage_type"],
+        "duration": details["duration"],
+        "file_size": session["total_size"],
+        "processing_status": "pending",
+        "metadata": details["metadata"],
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+    await save_recording(db, {**user, "user_id": session["user_id"], "company_id": session["company_id"]}, recording_doc)
+
+
+async def _attach_video(db, session: Dict, storage):
+    details = session["details"]
+    now = datetime.now(timezone.utc).isoformat()
+    fields = {
+        "s3_url": storage.reference(session["storage_key"]),
+        "storage_key": session["storage_key"],
+        "storage_type": session["storage_type"],
+        "content_type": session["content_type"],
+        "file_size": session["total_size"],
+        "status": "uploaded",
+        "processing_status": "pending",
+        "uploaded_at": now
+    }
+
+    if details.get("video_id"):
+        # Only the uploader's own video screenshot can receive the file
+        result = await db.video_screenshots.update_one(
+            {"video_id": details["video_id"], "company_id": session["company_id"], "user_id": session["user_id"]},
+            {"$set": fields}
+        )
+        if not result["modified_count"]:
+            raise HTTPException(status_code=404, detail="Video screenshot not found")
+        return
+
+    if await db.video_screenshots.find_one({"video_id": session["result_id"]}):
+        return
+    await db.video_screenshots.insert_one({
+        "video_id": session["result_id"],
+        "company_id": session["company_id"],
+        "user_id": session["user_id"],
+        "time_entry_id": session["time_entry_id"],
+        "duration_seconds": details["duration"],
+        "app_name": details["app_name"],
+        "window_title": details["window_title"],
+        "captured_at": session["created_at"],
+        **fields
+    })
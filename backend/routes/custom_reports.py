@@ -7,11 +7,13 @@ Advanced reporting with custom templates and workforce insights
 from fastapi import APIRouter, HTTPException, Request, Depends
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
-from datetime import datetime, timezone, timedelta
+from datetime import date, datetime, timezone, timedelta
 import uuid
 import json
 import logging
 
+from utils.daily_user_stats import read_daily_stats
+
 router = APIRouter(prefix="/reports", tags=["reports"])
 logger = logging.getLogger(__name__)
 
@@ -142,19 +144,15 @@ class WorkforceAnalytics:
     @staticmethod
     async def calculate_benchmarks(db, company_id: str, period_days: int = 30) -> dict:
         """Calculate team benchmarks and rankings"""
-        end_date = datetime.now(timezone.utc)
-        start_date = end_date - timedelta(days=period_days)
+        start_day = datetime.now(timezone.utc).date() - timedelta(days=period_days)
         
-        # Get all time entries for the period
-        entries = await db.time_entries.find({
-            "company_id": company_id,
-            "start_time": {"$gte": start_date.isoformat(), "$lte": end_date.isoformat()}
-        }, {"_id": 0}).to_list(10000)
+        # Daily rollup rows for the period, one per user and day
+        daily_stats = await read_daily_stats(db, {"company_id": company_id}, start_day)
         
         # Group by user
         user_stats = {}
-        for entry in entries:
-            user_id = entry.get("user_id")
+        for row in daily_stats:
+            user_id = row.get("user_id")
             if user_id not in user_stats:
                 user_stats[user_id] = {
                     "total_hours": 0,
@@ -163,13 +161,13 @@ class WorkforceAnalytics:
                     "entries_count": 0
                 }
             
-            duration = entry.get("duration", 0) / 3600
-            idle = entry.get("idle_time", 0) / 3600
+            duration = row.get("tracked_seconds", 0) / 3600
+            idle = row.get("idle_seconds", 0) / 3600
             
             user_stats[user_id]["total_hours"] += duration
             user_stats[user_id]["active_hours"] += (duration - idle)
             user_stats[user_id]["idle_hours"] += idle
-            user_stats[user_id]["entries_count"] += 1
+            user_stats[user_id]["entries_count"] += row.get("entry_count", 0)
         
         # Calculate productivity scores and rankings
         rankings = []
@@ -204,44 +202,23 @@ class WorkforceAnalytics:
     @staticmethod
     async def calculate_work_life_balance(db, user_id: str, period_days: int = 30) -> dict:
         """Calculate work-life balance insights for a user"""
-        end_date = datetime.now(timezone.utc)
-        start_date = end_date - timedelta(days=period_days)
+        start_day = datetime.now(timezone.utc).date() - timedelta(days=period_days)
         
-        entries = await db.time_entries.find({
-            "user_id": user_id,
-            "start_time": {"$gte": start_date.isoformat(), "$lte": end_date.isoformat()}
-        }, {"_id": 0}).to_list(1000)
+        # Daily rollup rows carry the hours and the late / early / weekend counts
+        daily_stats = await read_daily_stats(db, {"user_id": user_id}, start_day)
         
         # Analyze work patterns
         daily_hours = {}
-        late_nights = 0  # Work after 8 PM
-        early_mornings = 0  # Work before 7 AM
+        late_nights = 0  # Entries started after 8 PM
+        early_mornings = 0  # Entries started before 7 AM
         weekends = 0
         
-        for entry in entries:
-            try:
-                start = datetime.fromisoformat(entry["start_time"].replace('Z', '+00:00'))
-                date_key = start.date().isoformat()
-                duration = entry.get("duration", 0) / 3600
-                
-                if date_key not in daily_hours:
-                    daily_hours[date_key] = 0
-                daily_hours[date_key] += duration
-                
-                # Check for late nights
-                if start.hour >= 20:
-                    late_nights += 1
-                
-                # Check for early mornings
-                if start.hour < 7:
-                    early_mornings += 1
-                
-                # Check for weekends
-                if start.weekday() >= 5:
-                    weekends += 1
-                    
-            except:
-                continue
+        for row in daily_stats:
+            daily_hours[row["day"]] = row.get("tracked_seconds", 0) / 3600
+            late_nights += row.get("late_night_entries", 0)
+            early_mornings += row.get("early_morning_entries", 0)
+            if row.get("is_weekend"):
+                weekends += row.get("entry_count", 0)
         
         # Calculate metrics
         total_days = len(daily_hours)
@@ -381,14 +358,33 @@ async def generate_report(data: GenerateReportRequest, request: Request):
     
     # Fetch data based on report type
     if data.report_type in ["time_summary", "productivity"]:
-        entries = await db.time_entries.find(query, {"_id": 0}).to_list(10000)
+        if data.project_ids:
+            # The daily rollup is per user, not per project
+            entries = await db.time_entries.find(query, {"_id": 0}).to_list(10000)
+            rows = [
+                {
+                    "user_id": entry.get("user_id", "unknown"),
+                    "tracked_seconds": entry.get("duration", 0),
+                    "idle_seconds": entry.get("idle_time", 0),
+                    "entry_count": 1
+                }
+                for entry in entries
+            ]
+        else:
+            try:
+                start_day = date.fromisoformat(data.start_date[:10])
+                end_day = date.fromisoformat(data.end_date[:10])
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Dates must start with YYYY-MM-DD")
+            stats_query = {"user_id": {"$in": data.user_ids}} if data.user_ids else {}
+            rows = await read_daily_stats(db, stats_query, start_day, end_day)
         
         # Process data
         report_data = []
         grouped = {}
         
-        for entry in entries:
-            key = entry.get("user_id", "unknown")
+        for row in rows:
+            key = row.get("user_id", "unknown")
             if key not in grouped:
                 grouped[key] = {
                     "user_id": key,
@@ -398,13 +394,13 @@ async def generate_report(data: GenerateReportRequest, request: Request):
                     "entries_count": 0
                 }
             
-            duration = entry.get("duration", 0) / 3600
-            idle = entry.get("idle_time", 0) / 3600
+            duration = row.get("tracked_seconds", 0) / 3600
+            idle = row.get("idle_seconds", 0) / 3600
             
             grouped[key]["total_hours"] += duration
             grouped[key]["active_hours"] += (duration - idle)
             grouped[key]["idle_hours"] += idle
-            grouped[key]["entries_count"] += 1
+            grouped[key]["entries_count"] += row.get("entry_count", 0)
         
         # Calculate derived fields
         for user_id, stats in grouped.items():
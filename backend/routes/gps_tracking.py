@@ -1,21 +1,23 @@
 from fastapi import APIRouter, HTTPException, Depends
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Optional
 from datetime import datetime, timedelta
 import math
 
+from utils.ingest_buffer import ingest_buffer, IngestBufferFull
+
 router = APIRouter(prefix='/api/gps', tags=['GPS Tracking'])
 
 class GPSLocation(BaseModel):
-    latitude: float
-    longitude: float
-    accuracy: Optional[float] = 0
+    latitude: float = Field(..., ge=-90, le=90)
+    longitude: float = Field(..., ge=-180, le=180)
+    accuracy: Optional[float] = Field(0, ge=0)
     altitude: Optional[float] = None
-    speed: Optional[float] = None
-    heading: Optional[float] = None
+    speed: Optional[float] = Field(None, ge=0)
+    heading: Optional[float] = Field(None, ge=0, le=360)
     address: Optional[str] = None
     activity_type: Optional[str] = 'unknown'
-    battery_level: Optional[int] = None
+    battery_level: Optional[int] = Field(None, ge=0, le=100)
 
 class Geofence(BaseModel):
     name: str
@@ -75,7 +77,7 @@ async def track_location(location: GPSLocation, user=Depends(lambda: None), db=D
             'timestamp': datetime.utcnow().isoformat()
         }
 
-        await db.insert('gps_locations', location_data)
+        ingest_buffer.submit('gps_locations', location_data)
 
         geofences = await db.query(
             'geofences',
@@ -95,6 +97,8 @@ async def track_location(location: GPSLocation, user=Depends(lambda: None), db=D
                     pass
 
         return {'success': True, 'location_id': location_id}
+    except IngestBufferFull:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
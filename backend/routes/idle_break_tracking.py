@@ -3,6 +3,8 @@ from pydantic import BaseModel
 from typing import Optional
 from datetime import datetime
 
+from utils.ingest_buffer import ingest_buffer, IngestBufferFull
+
 router = APIRouter(prefix='/api/tracking', tags=['Idle & Break Tracking'])
 
 class IdlePeriod(BaseModel):
@@ -35,8 +37,10 @@ async def start_idle_period(idle: IdlePeriod, user=Depends(lambda: None), db=Dep
             'is_automatic': True
         }
 
-        await db.insert('idle_periods', idle_data)
+        ingest_buffer.submit('idle_periods', idle_data)
         return {'success': True, 'idle_id': idle_id}
+    except IngestBufferFull:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
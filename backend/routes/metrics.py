@@ -0,0 +1,52 @@
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+import os
+import secrets
+
+from utils.metrics import registry
+from utils.screenshot_scheduler import screenshot_scheduler
+from utils.screen_recording_scheduler import screen_recording_scheduler
+
+router = APIRouter(tags=["Metrics"])
+
+
+def verify_metrics_token(request: Request, required: bool = False):
+    """
+    Require METRICS_TOKEN as a bearer token when it is configured; with
+    `required`, refuse the request when no token is configured
+    """
+    token = os.environ.get('METRICS_TOKEN')
+    if not token:
+        if required:
+            raise HTTPException(status_code=403, detail="METRICS_TOKEN is not configured")
+        return
+    auth_header = request.headers.get("Authorization", "")
+    if not secrets.compare_digest(auth_header, f"Bearer {token}"):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics(request: Request):
+    """Export in-process metrics in Prometheus text format"""
+    verify_metrics_token(request)
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@router.get("/debug/schedulers/lag")
+async def get_scheduler_lag(request: Request, limit: int = 20):
+    """List the capture scheduler entries with the worst firing lag"""
+    # Lists user and company ids across every tenant, so never served without a token
+    verify_metrics_token(request, required=True)
+    limit = max(1, min(limit, 500))
+    return {
+        "screenshot": {
+            "active": len(screenshot_scheduler.active_timers),
+            "backlog": screenshot_scheduler.get_backlog(),
+            "worst_lag": screenshot_scheduler.get_lag_report(limit)
+        },
+        "screen_recording": {
+            "active": len(screen_recording_scheduler.active_recorders),
+            "backlog": screen_recording_scheduler.get_backlog(),
+            "worst_lag": screen_recording_scheduler.get_lag_report(limit)
+        }
+    }
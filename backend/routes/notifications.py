@@ -54,6 +54,42 @@ async def create_notification(
         return None
 
 
+async def create_notifications(db, notifications: list):
+    """Helper function to create many notifications with a single insert
+
+    Each item takes the same fields as `create_notification`.
+    """
+    if not notifications:
+        return []
+
+    try:
+        now = datetime.now(timezone.utc).isoformat()
+        notification_docs = [
+            {
+                "notification_id": generate_id("notification"),
+                "company_id": n["company_id"],
+                "user_id": n["user_id"],
+                "notification_type": n["notification_type"],
+                "title": n["title"],
+                "message": n["message"],
+                "data": n.get("data") or {},
+                "read": False,
+                "priority": n.get("priority", "normal"),
+                "created_at": now
+            }
+            for n in notifications
+        ]
+
+        await db.notifications.insert_many(notification_docs)
+        logger.info(f"Created {len(notification_docs)} notifications")
+
+        return [doc["notification_id"] for doc in notification_docs]
+
+    except Exception as e:
+        logger.error(f"Error creating notifications: {e}")
+        return []
+
+
 @router.get("")
 async def get_notifications(request: Request, user: dict, unread_only: Optional[bool] = False):
     """Get user notifications"""
@@ -1,21 +1,23 @@
 from fastapi import APIRouter, HTTPException, Depends
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Optional
 from datetime import datetime, date, timedelta
 
+from utils.ingest_buffer import ingest_buffer, IngestBufferFull
+
 router = APIRouter(prefix='/api/productivity', tags=['Productivity Monitoring'])
 
 class AppUsage(BaseModel):
     app_name: str
     app_title: Optional[str] = None
-    duration_seconds: int
+    duration_seconds: int = Field(..., ge=0)
     timestamp: Optional[datetime] = None
 
 class WebsiteUsage(BaseModel):
     url: str
     domain: str
     page_title: Optional[str] = None
-    duration_seconds: int
+    duration_seconds: int = Field(..., ge=0)
     timestamp: Optional[datetime] = None
 
 class AppCategory(BaseModel):
@@ -81,8 +83,10 @@ async def track_app_usage(usage: AppUsage, user=Depends(lambda: None), db=Depend
             'date': (usage.timestamp or datetime.utcnow()).date()
         }
 
-        await db.insert('app_usage', usage_data)
+        ingest_buffer.submit('app_usage', usage_data)
         return {'success': True, 'usage_id': usage_id}
+    except IngestBufferFull:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -108,8 +112,10 @@ async def track_website_usage(usage: WebsiteUsage, user=Depends(lambda: None), d
             'date': (usage.timestamp or datetime.utcnow()).date()
         }
 
-        await db.insert('website_usage', usage_data)
+        ingest_buffer.submit('website_usage', usage_data)
         return {'success': True, 'usage_id': usage_id}
+    except IngestBufferFull:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -441,6 +441,32 @@ async def process_scheduled_payment(schedule_id: str, request: Request, user: di
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.post("/process-due")
+async def process_due_payments(request: Request, user: dict, run_date: Optional[date] = None):
+    """Process every due recurring payment for the company in one batch run (admin only)"""
+    from db import SupabaseDB
+    from utils.recurring_payment_processor import recurring_payment_processor
+    db = SupabaseDB.get_db()
+
+    try:
+        if user["role"] not in ["admin", "hr"]:
+            raise HTTPException(status_code=403, detail="Admin access required")
+        if run_date and run_date > datetime.now(timezone.utc).date():
+            raise HTTPException(status_code=400, detail="run_date cannot be in the future")
+
+        summary = await recurring_payment_processor.process_due(
+            db, run_date=run_date, company_id=user["company_id"]
+        )
+
+        return {"success": True, "data": summary}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error processing due recurring payments: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @router.delete("/{schedule_id}")
 async def delete_recurring_schedule(schedule_id: str, request: Request, user: dict):
     """Delete (deactivate) a recurring payment schedule (admin only)"""
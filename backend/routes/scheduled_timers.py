@@ -137,6 +137,9 @@ async def create_scheduled_timer(
 
     await db.scheduled_timers.insert_one(schedule_doc)
 
+    from utils.timer_schedule_engine import timer_schedule_engine
+    timer_schedule_engine.upsert_schedule(schedule_doc)
+
     logger.info(f"Scheduled timer {schedule_id} created for employee {data.employee_id}")
 
     return {
@@ -302,6 +305,9 @@ async def update_scheduled_timer(
         {"$set": update_data}
     )
 
+    from utils.timer_schedule_engine import timer_schedule_engine
+    timer_schedule_engine.upsert_schedule({**timer, **update_data})
+
     return {"message": "Scheduled timer updated successfully"}
 
 
@@ -328,6 +334,9 @@ async def delete_scheduled_timer(
 
     await db.scheduled_timers.delete_one({"schedule_id": schedule_id})
 
+    from utils.timer_schedule_engine import timer_schedule_engine
+    timer_schedule_engine.remove_schedule(schedule_id)
+
     return {"message": "Scheduled timer deleted successfully"}
 
 
@@ -7,6 +7,7 @@ from pydantic import BaseModel
 from typing import Optional
 from datetime import datetime, timezone
 from utils.id_generator import generate_id
+from utils.video_pipeline import playback_urls
 import logging
 
 router = APIRouter()
@@ -22,6 +23,42 @@ class ScreenRecordingCreate(BaseModel):
     metadata: Optional[dict] = None
 
 
+async def save_recording(db, user: dict, recording_doc: dict):
+    """Insert a recording and record it in the activity history and the manager's notifications"""
+    await db.screen_recordings.insert_one(recording_doc)
+
+    # Create activity history entry
+    from routes.activity_history import create_activity_entry
+    await create_activity_entry(
+        db=db,
+        company_id=user["company_id"],
+        user_id=user["user_id"],
+        entry_id=recording_doc["entry_id"],
+        activity_type="recording_captured",
+        description=f"Screen recording captured ({recording_doc['duration']}s)",
+        metadata={"recording_id": recording_doc["recording_id"]}
+    )
+
+    # Notify manager
+    manager_assignment = await db.manager_assignments.find_one({
+        "employee_id": user["user_id"],
+        "active": True
+    })
+
+    if manager_assignment:
+        from routes.notifications import create_notification
+        await create_notification(
+            db=db,
+            company_id=user["company_id"],
+            user_id=manager_assignment["manager_id"],
+            notification_type="recording_captured",
+            title="Screen Recording Captured",
+            message=f"{user.get('name', 'Employee')} - {recording_doc['duration']}s recording",
+            data={"recording_id": recording_doc["recording_id"], "employee_id": user["user_id"]},
+            priority="low"
+        )
+
+
 @router.post("")
 async def create_recording(data: ScreenRecordingCreate, request: Request, user: dict):
     """Create a new screen recording entry"""
@@ -55,38 +92,7 @@ async def create_recording(data: ScreenRecordingCreate, request: Request, user:
             "created_at": datetime.now(timezone.utc).isoformat()
         }
 
-        await db.screen_recordings.insert_one(recording_doc)
-
-        # Create activity history entry
-        from routes.activity_history import create_activity_entry
-        await create_activity_entry(
-            db=db,
-            company_id=user["company_id"],
-            user_id=user["user_id"],
-            entry_id=data.entry_id,
-            activity_type="recording_captured",
-            description=f"Screen recording captured ({data.duration}s)",
-            metadata={"recording_id": recording_id}
-        )
-
-        # Notify manager
-        manager_assignment = await db.manager_assignments.find_one({
-            "employee_id": user["user_id"],
-            "active": True
-        })
-
-        if manager_assignment:
-            from routes.notifications import create_notification
-            await create_notification(
-                db=db,
-                company_id=user["company_id"],
-                user_id=manager_assignment["manager_id"],
-                notification_type="recording_captured",
-                title="Screen Recording Captured",
-                message=f"{user.get('name', 'Employee')} - {data.duration}s recording",
-                data={"recording_id": recording_id, "employee_id": user["user_id"]},
-                priority="low"
-            )
+        await save_recording(db, user, recording_doc)
 
         return {"success": True, "recording_id": recording_id}
 
@@ -151,10 +157,11 @@ async def get_recordings(
             limit=limit
         )
 
-        # Enrich with user names
+        # Enrich with user names and playback URLs
         for recording in recordings:
             employee = await db.users.find_one({"user_id": recording["user_id"]})
             recording["user_name"] = employee.get("name", "Unknown") if employee else "Unknown"
+            playback_urls("recording", recording)
 
         return {"success": True, "data": recordings}
 
@@ -198,6 +205,7 @@ async def get_recording(recording_id: str, request: Request, user: dict):
         # Get user name
         employee = await db.users.find_one({"user_id": recording["user_id"]})
         recording["user_name"] = employee.get("name", "Unknown") if employee else "Unknown"
+        playback_urls("recording", recording)
 
         return {"success": True, "data": recording}
 
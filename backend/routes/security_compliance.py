@@ -3,6 +3,8 @@ from pydantic import BaseModel
 from typing import Optional, Dict, Any
 from datetime import datetime
 
+from utils.ingest_buffer import ingest_buffer, IngestBufferFull
+
 router = APIRouter(prefix='/api/security', tags=['Security & Compliance'])
 
 class AuditLog(BaseModel):
@@ -89,7 +91,7 @@ async def log_usb_event(event: USBEvent, user=Depends(lambda: None), db=Depends(
             **event.dict()
         }
 
-        await db.insert('usb_events', event_data)
+        ingest_buffer.submit('usb_events', event_data)
 
         if event.action_taken == 'blocked':
             alert_data = {
@@ -106,6 +108,8 @@ async def log_usb_event(event: USBEvent, user=Depends(lambda: None), db=Depends(
             await db.insert('security_alerts', alert_data)
 
         return {'success': True, 'event_id': event_id}
+    except IngestBufferFull:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -1,43 +1,64 @@
-from fastapi import APIRouter, HTTPException, Depends, Request, UploadFile, File
+from fastapi import APIRouter, HTTPException, Depends, Request, UploadFile, File, Response
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional, Tuple
 import os
-import boto3
-from botocore.config import Config
 from botocore.exceptions import ClientError
 import base64
+import hashlib
+import mimetypes
+import tempfile
+import time
 import uuid
 from datetime import datetime, timezone
 import logging
 
+from utils.auth import get_current_user
+from utils.s3_client import get_bucket_name, SIGNED_URL_TTL
+from utils.storage_backends import get_storage, get_local_storage, LocalStorageBackend
+from utils.range_file_response import RangeFileResponse, RangeNotSatisfiable, parse_range
+from utils.image_pipeline import image_pipeline, duplicate_blob_fields
+from utils.perceptual_hash import phash_index, parse_hash
+from utils.job_runs import read_progress
+from utils.retention_purge import retention_purge_engine
+from utils.video_pipeline import VIDEO_KINDS, render_playlist
+
 router = APIRouter(prefix="/storage", tags=["storage"])
 logger = logging.getLogger(__name__)
 
-# S3-compatible storage configuration (works with Contabo Object Storage, MinIO, AWS S3, etc.)
-def get_s3_client():
-    """Initialize S3-compatible client for Contabo or other providers"""
-    endpoint_url = os.environ.get('S3_ENDPOINT_URL')  # e.g., https://eu2.contabostorage.com
-    access_key = os.environ.get('S3_ACCESS_KEY')
-    secret_key = os.environ.get('S3_SECRET_KEY')
-    region = os.environ.get('S3_REGION', 'eu2')
-    
-    if not all([endpoint_url, access_key, secret_key]):
-        return None
-    
-    return boto3.client(
-        's3',
-        endpoint_url=endpoint_url,
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-        region_name=region,
-        config=Config(
-            signature_version='s3v4',
-            s3={'addressing_style': 'path'}
-        )
-    )
+# Binary uploads are spooled to disk past this size so memory per upload stays bounded
+UPLOAD_SPOOL_BYTES = 1024 * 1024
+MAX_SCREENSHOT_BYTES = int(os.environ.get('MAX_SCREENSHOT_BYTES', 20 * 1024 * 1024))
+SCREENSHOT_CONTENT_TYPES = {
+    'image/png': 'png',
+    'image/jpeg': 'jpg',
+    'image/webp': 'webp'
+}
+
+# A negotiated duplicate may only reference a screenshot uploaded this recently
+PHASH_NEGOTIATE_WINDOW_SECONDS = int(os.environ.get('PHASH_NEGOTIATE_WINDOW_SECONDS', 900))
 
-def get_bucket_name():
-    return os.environ.get('S3_BUCKET_NAME', 'workmonitor-screenshots')
+async def spool_request_body(request: Request, max_bytes: int) -> Tuple[tempfile.SpooledTemporaryFile, int, str]:
+    """
+    Read the raw request body chunk by chunk into a spooled temporary file,
+    computing its size and SHA-256 on the fly
+
+    Returns the rewound file, the byte count and the hex digest.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > max_bytes:
+                raise HTTPException(status_code=413, detail=f"Upload exceeds {max_bytes} bytes")
+            digest.update(chunk)
+            spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, size, digest.hexdigest()
 
 class ScreenshotUploadRequest(BaseModel):
     time_entry_id: str
@@ -47,118 +68,330 @@ class ScreenshotUploadRequest(BaseModel):
     window_title: Optional[str] = None
     blurred: bool = False
 
+class ScreenshotNegotiateRequest(BaseModel):
+    time_entry_id: str
+    perceptual_hash: str  # 64-bit dHash as 16 hex characters
+    taken_at: Optional[str] = None
+    app_name: Optional[str] = None
+    window_title: Optional[str] = None
+    blurred: bool = False
+
 class PresignedUrlRequest(BaseModel):
     file_key: str
-    expires_in: int = 3600  # 1 hour default
+    expires_in: int = SIGNED_URL_TTL
+
+class BatchPresignedUrlRequest(BaseModel):
+    file_keys: List[str]
+
+MAX_BATCH_PRESIGN_KEYS = 1000
 
 @router.post("/upload-screenshot")
 async def upload_screenshot(
     data: ScreenshotUploadRequest,
-    request: Request
+    request: Request,
+    user: dict = Depends(get_current_user)
 ):
-    """Upload a screenshot to S3-compatible storage"""
+    """Upload a screenshot to the configured storage backend"""
     db = request.app.state.db
-    s3_client = get_s3_client()
-    bucket_name = get_bucket_name()
-    
+    storage = get_storage()
+
+    # The row carries the owner so the image pipeline applies the company's blur and retention policy
+    entry = await db.time_entries.find_one({"entry_id": data.time_entry_id})
+    if not entry or entry["user_id"] != user["user_id"]:
+        raise HTTPException(status_code=404, detail="Time entry not found")
+
     # Generate unique file key
     screenshot_id = f"ss_{uuid.uuid4().hex[:12]}"
     file_key = f"screenshots/{datetime.now().strftime('%Y/%m/%d')}/{screenshot_id}.png"
-    
+
     try:
         # Decode base64 image
         image_bytes = base64.b64decode(data.image_data)
-        
-        if s3_client:
-            # Upload to S3-compatible storage
-            s3_client.put_object(
-                Bucket=bucket_name,
-                Key=file_key,
-                Body=image_bytes,
-                ContentType='image/png',
-                Metadata={
+
+        if storage:
+            # The backend may choose its own key (the local backend is content-addressed)
+            file_key = await storage.save_bytes(
+                image_bytes,
+                file_key,
+                'image/png',
+                metadata={
                     'time_entry_id': data.time_entry_id,
                     'taken_at': data.taken_at,
                     'app_name': data.app_name or '',
                     'blurred': str(data.blurred)
                 }
             )
-            
-            # Generate presigned URL for viewing
-            url = s3_client.generate_presigned_url(
-                'get_object',
-                Params={'Bucket': bucket_name, 'Key': file_key},
-                ExpiresIn=86400  # 24 hours
-            )
+
+            # Persist a stable reference; URLs are signed when screenshots are read
+            stored_url = storage.reference(file_key)
+            url = storage.signed_url(file_key)[0]
         else:
-            # Fallback: Store reference without actual upload (for development)
-            url = f"/api/storage/screenshots/{screenshot_id}"
-            logger.warning("S3 not configured - screenshot stored as reference only")
-        
+            # Fallback: Store reference without actual upload
+            stored_url = url = f"/api/storage/screenshots/{screenshot_id}"
+            logger.warning("Storage not configured - screenshot stored as reference only")
+
         # Save metadata to database
         screenshot_doc = {
             "screenshot_id": screenshot_id,
+            "user_id": entry["user_id"],
+            "company_id": entry["company_id"],
             "time_entry_id": data.time_entry_id,
             "s3_key": file_key,
-            "s3_url": url,
+            "s3_url": stored_url,
             "taken_at": data.taken_at,
             "app_name": data.app_name,
             "window_title": data.window_title,
             "blurred": data.blurred,
             "file_size": len(image_bytes),
-            "storage_type": "s3" if s3_client else "reference",
+            "storage_type": storage.storage_type if storage else "reference",
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }
+
+        await db.screenshots.insert_one(screenshot_doc)
+        if storage:
+            image_pipeline.enqueue(screenshot_id)
+
+        return {
+            "screenshot_id": screenshot_id,
+            "url": url,
+            "file_key": file_key,
+            "storage_type": screenshot_doc["storage_type"]
+        }
+
+    except Exception as e:
+        logger.error(f"Screenshot upload error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to upload screenshot: {str(e)}")
+
+@router.post("/upload-screenshot/binary")
+async def upload_screenshot_binary(request: Request, user: dict = Depends(get_current_user)):
+    """
+    Upload a screenshot as the raw request body
+
+    The image bytes are the body (Content-Type image/png, image/jpeg or
+    image/webp) and metadata travels in headers: X-Time-Entry-Id (required),
+    X-Taken-At, X-App-Name, X-Window-Title, X-Blurred and optionally
+    X-Checksum-SHA256, which is verified against the received bytes.
+    """
+    db = request.app.state.db
+    storage = get_storage()
+
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    extension = SCREENSHOT_CONTENT_TYPES.get(content_type)
+    if not extension:
+        raise HTTPException(status_code=415, detail=f"Unsupported content type: {content_type or 'none'}")
+
+    time_entry_id = request.headers.get("x-time-entry-id")
+    if not time_entry_id:
+        raise HTTPException(status_code=400, detail="X-Time-Entry-Id header is required")
+
+    entry = await db.time_entries.find_one({"entry_id": time_entry_id})
+    if not entry or entry["user_id"] != user["user_id"]:
+        raise HTTPException(status_code=404, detail="Time entry not found")
+
+    taken_at = request.headers.get("x-taken-at") or datetime.now(timezone.utc).isoformat()
+    app_name = request.headers.get("x-app-name")
+    window_title = request.headers.get("x-window-title")
+    blurred = request.headers.get("x-blurred", "false").lower() == "true"
+
+    screenshot_id = f"ss_{uuid.uuid4().hex[:12]}"
+    file_key = f"screenshots/{datetime.now().strftime('%Y/%m/%d')}/{screenshot_id}.{extension}"
+
+    body, file_size, checksum = await spool_request_body(request, MAX_SCREENSHOT_BYTES)
+    try:
+        if file_size == 0:
+            raise HTTPException(status_code=400, detail="Empty upload")
+
+        expected_checksum = request.headers.get("x-checksum-sha256")
+        if expected_checksum and expected_checksum.lower() != checksum:
+            raise HTTPException(status_code=400, detail="Checksum mismatch")
+
+        if storage:
+            file_key = await storage.save_file(
+                body,
+                file_key,
+                content_type,
+                metadata={
+                    'time_entry_id': time_entry_id,
+                    'taken_at': taken_at,
+                    'app_name': app_name or '',
+                    'blurred': str(blurred),
+                    'sha256': checksum
+                }
+            )
+            stored_url = storage.reference(file_key)
+            url = storage.signed_url(file_key)[0]
+        else:
+            stored_url = url = f"/api/storage/screenshots/{screenshot_id}"
+            logger.warning("Storage not configured - screenshot stored as reference only")
+
+        screenshot_doc = {
+            "screenshot_id": screenshot_id,
+            "user_id": entry["user_id"],
+            "company_id": entry["company_id"],
+            "time_entry_id": time_entry_id,
+            "s3_key": file_key,
+            "s3_url": stored_url,
+            "taken_at": taken_at,
+            "app_name": app_name,
+            "window_title": window_title,
+            "blurred": blurred,
+            "content_type": content_type,
+            "file_size": file_size,
+            "checksum_sha256": checksum,
+            "storage_type": storage.storage_type if storage else "reference",
             "created_at": datetime.now(timezone.utc).isoformat()
         }
-        
+
         await db.screenshots.insert_one(screenshot_doc)
-        
+        if storage:
+            image_pipeline.enqueue(screenshot_id)
+
         return {
             "screenshot_id": screenshot_id,
             "url": url,
             "file_key": file_key,
+            "file_size": file_size,
+            "checksum_sha256": checksum,
             "storage_type": screenshot_doc["storage_type"]
         }
-        
+
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Screenshot upload error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to upload screenshot: {str(e)}")
+    finally:
+        body.close()
+
+@router.post("/screenshots/negotiate")
+async def negotiate_screenshot(data: ScreenshotNegotiateRequest, request: Request,
+                               user: dict = Depends(get_current_user)):
+    """
+    Hash-first upload negotiation for the desktop agent
+
+    When the capture's perceptual hash matches one of the caller's
+    screenshots uploaded in the last PHASH_NEGOTIATE_WINDOW_SECONDS, the
+    screenshot is recorded as a reference to that blob and the agent skips
+    the upload. Otherwise the agent uploads the image to the binary
+    endpoint as usual. The hash comes from the agent, so the short window
+    makes it upload a real image, hashed by the server, regularly even
+    while the screen does not change.
+    """
+    db = request.app.state.db
+
+    value = parse_hash(data.perceptual_hash)
+    if value is None:
+        raise HTTPException(status_code=400, detail="perceptual_hash must be a hex string")
+
+    entry = await db.time_entries.find_one({"entry_id": data.time_entry_id})
+    if not entry or entry["user_id"] != user["user_id"]:
+        raise HTTPException(status_code=404, detail="Time entry not found")
+
+    policy = await image_pipeline.tracking_policy(entry["company_id"])
+    blurred = data.blurred or bool(policy.get("blur_screenshots"))
+    earlier = await phash_index.match(db, entry["user_id"], value, blurred, PHASH_NEGOTIATE_WINDOW_SECONDS)
+    if not earlier:
+        return {"duplicate": False, "upload_url": "/api/storage/upload-screenshot/binary"}
+
+    screenshot_id = f"ss_{uuid.uuid4().hex[:12]}"
+    now = datetime.now(timezone.utc).isoformat()
+    await db.screenshots.insert_one({
+        "screenshot_id": screenshot_id,
+        "user_id": entry["user_id"],
+        "company_id": entry["company_id"],
+        "time_entry_id": data.time_entry_id,
+        "taken_at": data.taken_at or now,
+        "app_name": data.app_name,
+        "window_title": data.window_title,
+        **duplicate_blob_fields(earlier),
+        "perceptual_hash": data.perceptual_hash.lower(),
+        "bytes_saved": earlier["file_size"],
+        "processed_at": now,
+        "created_at": now
+    })
+
+    return {"duplicate": True, "screenshot_id": screenshot_id, "duplicate_of": earlier["screenshot_id"]}
+
+async def company_keys(db, company_id: str, keys: List[str]) -> set:
+    """The subset of `keys` that belong to the company's screenshots, recordings and videos"""
+    if not keys:
+        return set()
+    rows = await db.rpc("company_storage_keys", {"p_company_id": company_id, "p_keys": keys})
+    return {row["key"] for row in rows}
 
 @router.post("/presigned-url")
-async def get_presigned_url(data: PresignedUrlRequest):
-    """Get a presigned URL for accessing a file"""
-    s3_client = get_s3_client()
-    bucket_name = get_bucket_name()
-    
-    if not s3_client:
+async def get_presigned_url(data: PresignedUrlRequest, request: Request, user: dict = Depends(get_current_user)):
+    """Get a presigned URL for accessing one of the company's files"""
+    storage = get_storage()
+
+    if not storage:
         raise HTTPException(status_code=503, detail="Storage not configured")
-    
+
+    if not await company_keys(request.app.state.db, user["company_id"], [data.file_key]):
+        raise HTTPException(status_code=404, detail="File not found")
+
     try:
-        url = s3_client.generate_presigned_url(
+        if data.expires_in == SIGNED_URL_TTL or storage.storage_type != "s3":
+            url, expires_at = storage.signed_url(data.file_key)
+            return {"url": url, "expires_in": int(expires_at - time.time())}
+
+        url = storage.client.generate_presigned_url(
             'get_object',
-            Params={'Bucket': bucket_name, 'Key': data.file_key},
+            Params={'Bucket': get_bucket_name(), 'Key': data.file_key},
             ExpiresIn=data.expires_in
         )
         return {"url": url, "expires_in": data.expires_in}
     except ClientError as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/presigned-urls")
+async def get_presigned_urls(data: BatchPresignedUrlRequest, request: Request, user: dict = Depends(get_current_user)):
+    """
+    Get presigned URLs for many of the company's files in one call, reusing
+    cached signatures; keys of other companies, or unknown keys, are omitted
+    """
+    storage = get_storage()
+    if not storage:
+        raise HTTPException(status_code=503, detail="Storage not configured")
+
+    if len(data.file_keys) > MAX_BATCH_PRESIGN_KEYS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_PRESIGN_KEYS} keys per request")
+
+    keys = [key for key in dict.fromkeys(data.file_keys) if key]
+    owned = await company_keys(request.app.state.db, user["company_id"], keys)
+    try:
+        signed = {key: storage.signed_url(key) for key in keys if key in owned}
+    except ClientError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return {
+        "urls": [
+            {
+                "file_key": key,
+                "url": url,
+                "expires_at": datetime.fromtimestamp(expires_at, timezone.utc).isoformat()
+            }
+            for key, (url, expires_at) in signed.items()
+        ]
+    }
+
 @router.post("/presigned-upload-url")
 async def get_presigned_upload_url(
     filename: str,
     content_type: str = "image/png"
 ):
-    """Get a presigned URL for direct upload from client"""
-    s3_client = get_s3_client()
+    """Get a presigned URL for direct upload from client (S3 backend only)"""
+    storage = get_storage()
     bucket_name = get_bucket_name()
-    
-    if not s3_client:
-        raise HTTPException(status_code=503, detail="Storage not configured")
-    
+
+    if not storage or storage.storage_type != "s3":
+        raise HTTPException(status_code=503, detail="Direct uploads require S3 storage")
+
     # Generate unique file key
     file_key = f"uploads/{datetime.now().strftime('%Y/%m/%d')}/{uuid.uuid4().hex[:12]}_{filename}"
-    
+
     try:
-        url = s3_client.generate_presigned_url(
+        url = storage.client.generate_presigned_url(
             'put_object',
             Params={
                 'Bucket': bucket_name,
@@ -182,56 +415,157 @@ async def delete_screenshot(
 ):
     """Delete a screenshot from storage"""
     db = request.app.state.db
-    s3_client = get_s3_client()
-    bucket_name = get_bucket_name()
-    
+
     # Get screenshot from database
     screenshot = await db.screenshots.find_one({"screenshot_id": screenshot_id})
     if not screenshot:
         raise HTTPException(status_code=404, detail="Screenshot not found")
-    
+
     try:
-        # Delete from S3 if configured
-        if s3_client and screenshot.get("storage_type") == "s3":
-            s3_client.delete_object(
-                Bucket=bucket_name,
-                Key=screenshot["s3_key"]
-            )
-        
+        # Delete the blob unless another screenshot shares it
+        storage_type = screenshot.get("storage_type")
+        storage = get_storage(storage_type) if storage_type in ("s3", "local") else None
+        if storage:
+            keys = [screenshot.get("original_key")]
+            shared = await db.screenshots.count_documents({
+                "s3_key": screenshot["s3_key"],
+                "screenshot_id": {"$ne": screenshot_id}
+            })
+            if not shared:
+                keys += [screenshot["s3_key"], screenshot.get("thumbnail_key")]
+            await storage.delete_many(key for key in keys if key)
+
         # Delete from database
         await db.screenshots.delete_one({"screenshot_id": screenshot_id})
-        
+
         return {"status": "deleted", "screenshot_id": screenshot_id}
-        
+
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete screenshot: {str(e)}")
 
+@router.post("/retention/purge")
+async def purge_expired_data(request: Request, user: dict = Depends(get_current_user)):
+    """Start a retention purge for the company in the background (admin only)"""
+    if user["role"] not in ["admin", "hr"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    started = await retention_purge_engine.trigger(request.app.state.db, user["company_id"])
+    if not started:
+        raise HTTPException(status_code=409, detail="A retention purge is already running")
+    return {"status": "started"}
+
+@router.get("/retention/status")
+async def get_retention_status(request: Request, user: dict = Depends(get_current_user)):
+    """Progress of the running retention purge, or the company's most recent one"""
+    if user["role"] not in ["admin", "hr"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    db = request.app.state.db
+    progress = await read_progress(db, "retention_purge")
+    if progress and progress["status"] == "running" and progress["company_id"] == user["company_id"]:
+        return progress
+
+    runs = await db.retention_purge_runs.find(
+        {"company_id": user["company_id"]}, sort=[("started_at", -1)], limit=1
+    )
+    return runs[0] if runs else {"status": "never_run"}
+
 @router.get("/storage-status")
 async def get_storage_status():
-    """Check if S3 storage is configured and accessible"""
-    s3_client = get_s3_client()
-    bucket_name = get_bucket_name()
-    
-    if not s3_client:
+    """Check if the storage backend is configured and accessible"""
+    storage = get_storage()
+
+    if not storage:
         return {
             "configured": False,
             "message": "S3 storage not configured. Set S3_ENDPOINT_URL, S3_ACCESS_KEY, S3_SECRET_KEY environment variables."
         }
-    
+
+    return await storage.status()
+
+@router.get("/hls/{kind}/{item_id}/index.m3u8")
+async def get_hls_playlist(kind: str, item_id: str, request: Request, user: dict = Depends(get_current_user)):
+    """
+    HLS playlist of a processed recording ("recording") or video screenshot
+    ("video") whose segment URIs are signed download URLs
+
+    Segments are stored under backend-chosen keys, so the playlist is built
+    per request instead of being stored next to them. Only the company's
+    users can play a video, and employees only their own.
+    """
+    spec = VIDEO_KINDS.get(kind)
+    if not spec:
+        raise HTTPException(status_code=404, detail="Unknown video kind")
+
+    row = await request.app.state.db[spec["table"]].find_one({spec["id_field"]: item_id})
+    if not row or row.get("company_id") != user["company_id"]:
+        raise HTTPException(status_code=404, detail="Video not found")
+    if user["role"] == "employee" and row.get("user_id") != user["user_id"]:
+        raise HTTPException(status_code=404, detail="Video not found")
+    if row.get("processing_status") != "ready" or not row.get("hls_segments"):
+        raise HTTPException(status_code=409, detail="Video is still being processed")
+
+    storage = get_storage(row.get("storage_type"))
+    if not storage:
+        raise HTTPException(status_code=503, detail="Storage not configured")
+
+    playlist = render_playlist([
+        (storage.signed_url(segment["key"])[0], segment["duration"]) for segment in row["hls_segments"]
+    ])
+    return Response(
+        playlist,
+        media_type="application/vnd.apple.mpegurl",
+        headers={"cache-control": "private, max-age=60"}
+    )
+
+@router.api_route("/files/{key:path}", methods=["GET", "HEAD"])
+async def serve_local_file(key: str, request: Request, expires: int = 0, signature: str = ""):
+    """
+    Serve a blob from the local storage backend through a signed URL
+
+    Supports single byte ranges and conditional requests; the ETag is the
+    blob's content hash, so it never changes for a given key.
+    """
+    storage = get_local_storage()
+    path = storage.path_for(key)
+    if not path:
+        raise HTTPException(status_code=404, detail="File not found")
+    if not storage.verify_signature(key, expires, signature):
+        raise HTTPException(status_code=403, detail="Invalid or expired signature")
+
     try:
-        # Try to list bucket contents
-        s3_client.head_bucket(Bucket=bucket_name)
-        return {
-            "configured": True,
-            "accessible": True,
-            "bucket": bucket_name,
-            "endpoint": os.environ.get('S3_ENDPOINT_URL')
-        }
-    except ClientError as e:
-        error_code = e.response.get('Error', {}).get('Code', 'Unknown')
-        return {
-            "configured": True,
-            "accessible": False,
-            "error": error_code,
-            "message": f"Cannot access bucket: {error_code}"
-        }
+        size = os.stat(path).st_size
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    etag = LocalStorageBackend.etag_for(key)
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    headers = {
+        "etag": etag,
+        "accept-ranges": "bytes",
+        "cache-control": f"private, max-age={max(expires - int(time.time()), 0)}, immutable"
+    }
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if if_range and if_range != etag:
+        range_header = None
+
+    try:
+        byte_range = parse_range(range_header, size)
+    except RangeNotSatisfiable:
+        return Response(status_code=416, headers={**headers, "content-range": f"bytes */{size}"})
+
+    if byte_range is None:
+        return RangeFileResponse(path, 0, size, headers=headers, media_type=media_type)
+
+    start, end = byte_range
+    return RangeFileResponse(
+        path, start, end - start + 1, status_code=206,
+        headers={**headers, "content-range": f"bytes {start}-{end}/{size}"},
+        media_type=media_type
+    )
@@ -1,14 +1,17 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, WebSocket, WebSocketDisconnect, Response
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+import asyncio
 import os
+import json
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, EmailStr, ValidationError
+from typing import List, Literal, Optional, Dict, Any
 import uuid
-from datetime import datetime, timezone, timedelta
+import time
+from datetime import date, datetime, timezone, timedelta
 from dateutil.relativedelta import relativedelta
 import bcrypt
 import jwt
@@ -16,10 +19,32 @@ import httpx
 from contextlib import asynccontextmanager
 
 # Import Supabase database adapter
-from utils.db_adapter import SupabaseDatabase
+from utils.db_adapter import SupabaseDatabase, add_write_listener
 from db import get_db
 from utils.screenshot_scheduler import screenshot_scheduler
 from utils.screen_recording_scheduler import screen_recording_scheduler
+from utils.timer_schedule_engine import timer_schedule_engine, resolve_timezone
+from utils.recurring_payment_processor import recurring_payment_processor
+from utils.s3_client import shutdown_s3_executor
+from utils.storage_backends import signed_url_for
+from utils.image_pipeline import image_pipeline
+from utils.video_pipeline import video_pipeline
+from utils.retention_purge import retention_purge_engine
+from utils.daily_user_stats import DAILY_STATS_JOB, daily_stats_repair_engine, read_daily_stats
+from utils.job_runs import read_progress
+from utils.timesheet_batch import TIMESHEET_BATCH_JOB, timesheet_batch_engine, generate_timesheets, local_week_start, week_start_of
+from utils.batch_ingest import decode_batch, BatchDecodeError
+from utils.ingest_buffer import ingest_buffer, IngestBufferFull
+from utils.activity_sessionizer import activity_sessionizer
+from utils.presence_index import presence_index
+from utils.presence_service import presence_service
+from utils.auth import (
+    JWT_SECRET, JWT_ALGORITHM, get_current_user, jwt_claims, session_token_from, user_for_token
+)
+from utils.response_cache import CachePolicy, ConditionalGetMiddleware, data_versions
+from utils.activity_rollups import (
+    SUPPORTED_BUCKET_VERSIONS, bucket_row, merge_buckets, summarize_rollups
+)
 from utils.id_generator import (
     generate_entry_id, generate_screenshot_id, generate_log_id,
     generate_company_id, generate_user_id
@@ -29,6 +54,7 @@ from utils.id_generator import (
 from routes.payments import router as payments_router
 from routes.ai_insights import router as ai_insights_router
 from routes.storage import router as storage_router
+from routes.chunked_uploads import router as chunked_uploads_router
 from routes.email import router as email_router
 from routes.pdf_generator import router as pdf_router
 from routes.google_calendar import router as calendar_router
@@ -62,6 +88,7 @@ from routes.idle_break_tracking import router as idle_break_router
 from routes.integrations import router as integrations_router
 from routes.security_compliance import router as security_router
 from routes.analytics import router as analytics_router
+from routes.metrics import router as metrics_router
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -69,10 +96,12 @@ load_dotenv(ROOT_DIR / '.env')
 # Supabase connection
 supabase_client = get_db()
 db = SupabaseDatabase(supabase_client)
+# Writes to the tables polled endpoints read change those endpoints' ETags;
+# versions need a pub/sub backend shared by every worker
+if data_versions.enabled:
+    add_write_listener(data_versions.record_write)
 
-# JWT Configuration
-JWT_SECRET = os.environ.get('JWT_SECRET', 'workmonitor-secret-key-2024')
-JWT_ALGORITHM = 'HS256'
+# JWT Configuration (secret and algorithm live in utils.auth)
 JWT_EXPIRY_HOURS = 168  # 7 days
 
 # Subscription Plans Configuration
@@ -135,22 +164,33 @@ logger = logging.getLogger(__name__)
 class ConnectionManager:
     def __init__(self):
         self.active_connections: Dict[str, List[WebSocket]] = {}
+        # Connections allowed to see the company's presence (admins, managers, HR)
+        self.presence_viewers: set = set()
     
-    async def connect(self, websocket: WebSocket, company_id: str):
+    async def connect(self, websocket: WebSocket, company_id: str, views_presence: bool = False):
         await websocket.accept()
         if company_id not in self.active_connections:
             self.active_connections[company_id] = []
         self.active_connections[company_id].append(websocket)
+        if views_presence:
+            self.presence_viewers.add(websocket)
         logger.info(f"WebSocket connected for company: {company_id}")
     
     def disconnect(self, websocket: WebSocket, company_id: str):
+        self.presence_viewers.discard(websocket)
         if company_id in self.active_connections:
             if websocket in self.active_connections[company_id]:
                 self.active_connections[company_id].remove(websocket)
     
-    async def broadcast(self, company_id: str, message: dict):
+    def has_presence_viewers(self, company_id: str) -> bool:
+        return any(connection in self.presence_viewers for connection in self.active_connections.get(company_id, []))
+    
+    async def broadcast(self, company_id: str, message: dict, presence: bool = False):
+        """Send to the company's connections; `presence` messages only reach presence viewers"""
         if company_id in self.active_connections:
-            for connection in self.active_connections[company_id]:
+            for connection in list(self.active_connections[company_id]):
+                if presence and connection not in self.presence_viewers:
+                    continue
                 try:
                     await connection.send_json(message)
                 except:
@@ -158,6 +198,31 @@ class ConnectionManager:
 
 manager = ConnectionManager()
 
+# Unsubscribe functions of the companies whose presence changes this worker forwards to its websockets
+presence_subscriptions: Dict[str, Any] = {}
+# Serializes follow / unfollow so concurrent connects never subscribe a company twice
+presence_subscriptions_lock = asyncio.Lock()
+
+async def follow_presence(company_id: str):
+    """Forward the company's presence changes to its presence viewers on this worker"""
+    async with presence_subscriptions_lock:
+        if company_id in presence_subscriptions:
+            return
+
+        async def forward(change: dict):
+            await manager.broadcast(company_id, {"type": "presence_changed", "data": change}, presence=True)
+
+        presence_subscriptions[company_id] = await presence_service.subscribe(company_id, forward)
+
+async def unfollow_presence(company_id: str):
+    """Stop forwarding once the company's last presence viewer on this worker has gone"""
+    async with presence_subscriptions_lock:
+        if manager.has_presence_viewers(company_id):
+            return
+        unsubscribe = presence_subscriptions.pop(company_id, None)
+        if unsubscribe:
+            await unsubscribe()
+
 # Pydantic Models
 class UserCreate(BaseModel):
     email: EmailStr
@@ -230,11 +295,42 @@ class ScreenshotResponse(BaseModel):
     app_name: Optional[str]
     window_title: Optional[str]
 
+class PresenceHeartbeat(BaseModel):
+    status: Literal["online", "idle", "offline"] = "online"
+    app_name: Optional[str] = None
+    activity_level: Optional[int] = Field(None, ge=0, le=100)
+
 class ActivityLogCreate(BaseModel):
     app_name: str
     url: Optional[str] = None
-    activity_level: int  # 0-100
+    activity_level: int = Field(..., ge=0, le=100)
+    window_title: Optional[str] = None
+
+class ActivityLogBatchRecord(BaseModel):
+    client_id: str = Field(..., min_length=8, max_length=64)  # client-generated, makes retries idempotent
+    app_name: str
+    url: Optional[str] = None
+    activity_level: int = Field(..., ge=0, le=100)
     window_title: Optional[str] = None
+    duration: Optional[int] = None  # seconds
+    category: Optional[str] = None
+    timestamp: Optional[datetime] = None  # when the activity happened; defaults to receipt time
+
+class ActivityMinuteBucket(BaseModel):
+    minute: datetime  # start of the minute
+    app_name: str
+    domain: Optional[str] = None
+    category: Optional[str] = None
+    active_seconds: int = Field(0, ge=0, le=60)
+    idle_seconds: int = Field(0, ge=0, le=60)
+    keystrokes: int = Field(0, ge=0)
+    mouse_clicks: int = Field(0, ge=0)
+    mouse_moves: int = Field(0, ge=0)
+
+class ActivityBucketUpload(BaseModel):
+    version: int
+    agent: Optional[str] = None  # desktop, chrome, firefox, ...
+    buckets: List[ActivityMinuteBucket] = Field(..., max_length=1440)
 
 class ActivityLogResponse(BaseModel):
     log_id: str
@@ -396,50 +492,6 @@ def create_jwt_token(user_id: str, company_id: str, role: str) -> str:
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-async def get_current_user(request: Request) -> dict:
-    # Try cookie first
-    session_token = request.cookies.get('session_token')
-    
-    # Then try Authorization header
-    if not session_token:
-        auth_header = request.headers.get('Authorization')
-        if auth_header and auth_header.startswith('Bearer '):
-            session_token = auth_header.split(' ')[1]
-    
-    if not session_token:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    # Check if it's a JWT token
-    try:
-        payload = jwt.decode(session_token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user = await db.users.find_one({"user_id": payload['user_id']}, {"_id": 0})
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
-    except jwt.ExpiredSignatureError:
-        pass
-    except jwt.InvalidTokenError:
-        pass
-    
-    # Check if it's a session token from Google OAuth
-    session = await db.user_sessions.find_one({"session_token": session_token}, {"_id": 0})
-    if not session:
-        raise HTTPException(status_code=401, detail="Invalid session")
-    
-    expires_at = session.get("expires_at")
-    if isinstance(expires_at, str):
-        expires_at = datetime.fromisoformat(expires_at)
-    if expires_at.tzinfo is None:
-        expires_at = expires_at.replace(tzinfo=timezone.utc)
-    if expires_at < datetime.now(timezone.utc):
-        raise HTTPException(status_code=401, detail="Session expired")
-    
-    user = await db.users.find_one({"user_id": session['user_id']}, {"_id": 0})
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
-    
-    return user
-
 async def check_subscription(company_id: str) -> dict:
     """Check if company has valid subscription"""
     subscription = await db.subscriptions.find_one(
@@ -484,11 +536,46 @@ async def lifespan(app: FastAPI):
     # Store db in app state for route access
     app.state.db = db
     logger.info("Supabase database connected")
+    await data_versions.start()
+    await activity_sessionizer.start(db)
+    await presence_index.start(db)
+    await presence_service.start()
+    await ingest_buffer.start(db)
+    await timer_schedule_engine.start(db)
+    await image_pipeline.start(db)
+    await video_pipeline.start(db)
+    await retention_purge_engine.start(db)
+    await daily_stats_repair_engine.start(db)
+    await timesheet_batch_engine.start(db)
+    await recurring_payment_processor.start(
+        db, interval=int(os.environ.get('RECURRING_PAYMENTS_INTERVAL', 3600))
+    )
     yield
+    # Write buffered telemetry before anything else shuts down
+    await ingest_buffer.stop()
+    await recurring_payment_processor.stop()
+    await timer_schedule_engine.stop()
+    await image_pipeline.stop()
+    await video_pipeline.stop()
+    await retention_purge_engine.stop()
+    await daily_stats_repair_engine.stop()
+    await timesheet_batch_engine.stop()
+    await presence_service.stop()
+    await data_versions.stop()
+    shutdown_s3_executor()
     logger.info("Application shutdown")
 
 # Create FastAPI app
 app = FastAPI(lifespan=lifespan)
+
+@app.exception_handler(IngestBufferFull)
+async def ingest_buffer_full_handler(request: Request, exc: IngestBufferFull):
+    """Backpressure: ask telemetry clients to retry once the buffer has drained"""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Ingest buffer is full, retry later"},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
 api_router = APIRouter(prefix="/api")
 
 # ==================== AUTH ROUTES ====================
@@ -937,9 +1024,63 @@ async def capture_screen_recording_callback(entry_id: str, user_id: str, company
     except Exception as e:
         logger.error(f"Error in capture_screen_recording_callback: {e}")
 
+# Scheduled timer callbacks
+async def scheduled_entries_started_callback(entries: List[dict]):
+    """Start capture schedulers for time entries auto-started by the timer engine"""
+    company_ids = list({e["company_id"] for e in entries})
+    companies = await db.companies.find({"company_id": {"$in": company_ids}})
+    policies = {c["company_id"]: c.get("tracking_policy", {}) for c in companies}
+
+    for entry in entries:
+        if entry["company_id"] not in policies:
+            continue
+        await screenshot_scheduler.start_timer(
+            entry_id=entry["entry_id"],
+            user_id=entry["user_id"],
+            company_id=entry["company_id"],
+            interval=policies[entry["company_id"]].get("screenshot_interval", 600)
+        )
+        await screen_recording_scheduler.start_recorder(
+            entry_id=entry["entry_id"],
+            user_id=entry["user_id"],
+            company_id=entry["company_id"]
+        )
+
+    for entry in entries:
+        presence_index.entry_started(entry["company_id"], entry["user_id"], entry["entry_id"], entry["start_time"])
+
+    for company_id in company_ids:
+        await manager.broadcast(company_id, {
+            "type": "time_entries_auto_started",
+            "data": {"entries": [
+                {"entry_id": e["entry_id"], "user_id": e["user_id"]}
+                for e in entries if e["company_id"] == company_id
+            ]}
+        })
+
+async def scheduled_entries_stopped_callback(entries: List[dict]):
+    """Stop capture schedulers for time entries auto-stopped by the timer engine"""
+    for entry in entries:
+        await screenshot_scheduler.stop_timer(entry["entry_id"])
+        await screen_recording_scheduler.stop_recorder(entry["entry_id"])
+        presence_index.entry_stopped(
+            entry["company_id"], entry["user_id"], entry["entry_id"], entry["start_time"], entry.get("duration", 0)
+        )
+
+    for company_id in {e["company_id"] for e in entries}:
+        await manager.broadcast(company_id, {
+            "type": "time_entries_auto_stopped",
+            "data": {"entries": [
+                {"entry_id": e["entry_id"], "user_id": e["user_id"]}
+                for e in entries if e["company_id"] == company_id
+            ]}
+        })
+
 # Set the callbacks
 screenshot_scheduler.set_screenshot_callback(capture_screenshot_callback)
 screen_recording_scheduler.set_recording_callback(capture_screen_recording_callback)
+timer_schedule_engine.set_start_callback(scheduled_entries_started_callback)
+timer_schedule_engine.set_stop_callback(scheduled_entries_stopped_callback)
 
 # ==================== TIME ENTRIES ROUTES ====================
 @api_router.post("/time-entries")
@@ -965,6 +1106,10 @@ async def create_time_entry(entry: TimeEntryCreate, user: dict = Depends(get_cur
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     await db.time_entries.insert_one(doc)
+    if entry.end_time:
+        presence_index.entry_stopped(user["company_id"], user["user_id"], entry_id, doc["start_time"], duration)
+    else:
+        presence_index.entry_started(user["company_id"], user["user_id"], entry_id, doc["start_time"])
 
     # Start screenshot and screen recording schedulers if entry is active
     if not entry.end_time:
@@ -1068,6 +1213,13 @@ async def update_time_entry(entry_id: str, data: TimeEntryUpdate, user: dict = D
             await screen_recording_scheduler.stop_recorder(entry_id)
 
     await db.time_entries.update_one({"entry_id": entry_id}, {"$set": update_data})
+    if data.end_time and entry.get("status") == "active":
+        presence_index.entry_stopped(
+            entry["company_id"], entry["user_id"], entry_id, entry["start_time"], update_data["duration"]
+        )
+    elif data.end_time or data.status:
+        # The entry's earlier duration is already counted; reload rather than add the new one on top
+        presence_index.invalidate(entry["company_id"])
 
     # Broadcast update
     await manager.broadcast(user["company_id"], {
@@ -1087,6 +1239,7 @@ async def delete_time_entry(entry_id: str, user: dict = Depends(get_current_user
         raise HTTPException(status_code=403, detail="Not authorized")
     
     await db.time_entries.delete_one({"entry_id": entry_id})
+    presence_index.invalidate(entry["company_id"])
     return {"message": "Entry deleted"}
 
 # ==================== SCREENSHOTS ROUTES ====================
@@ -1144,7 +1297,20 @@ async def get_screenshots(
         else:
             query["taken_at"] = {"$lte": end_date}
     
-    screenshots = await db.screenshots.find(query, {"_id": 0}).sort("taken_at", -1).to_list(500)
+    screenshots = await db.screenshots.find(query, {"_id": 0}, sort=[("taken_at", -1)], limit=500)
+
+    # Galleries load thumbnails; the full image is only fetched when opened
+    for screenshot in screenshots:
+        storage_type = screenshot.get("storage_type")
+        if storage_type not in ("s3", "local"):
+            continue
+        if not screenshot.get("processed_at"):
+            # Until the image pipeline has run, the stored blob may be the unblurred original
+            screenshot["s3_url"] = screenshot["thumbnail_url"] = None
+            screenshot["processing"] = True
+            continue
+        screenshot["s3_url"] = signed_url_for(storage_type, screenshot.get("s3_key")) or screenshot.get("s3_url")
+        screenshot["thumbnail_url"] = signed_url_for(storage_type, screenshot.get("thumbnail_key"))
     return screenshots
 
 # ==================== ACTIVITY LOGS ROUTES ====================
@@ -1162,10 +1328,157 @@ async def create_activity_log(log: ActivityLogCreate, user: dict = Depends(get_c
         "window_title": log.window_title,
         "timestamp": datetime.now(timezone.utc).isoformat()
     }
-    await db.activity_logs.insert_one(doc)
+    ingest_buffer.submit("activity_logs", doc)
     
     return {"log_id": log_id}
 
+MAX_ACTIVITY_BATCH_RECORDS = 1000
+MAX_ACTIVITY_BATCH_BYTES = 4 * 1024 * 1024
+
+@api_router.post("/activity-logs/batch")
+async def create_activity_logs_batch(request: Request, user: dict = Depends(get_current_user)):
+    """
+    Ingest many activity log records in one request, written with one multi-row insert
+
+    The body is a JSON array of records, or NDJSON (Content-Type
+    application/x-ndjson), optionally compressed with Content-Encoding gzip
+    or zstd. Records are keyed by their `client_id`, so a retried batch
+    inserts nothing twice. Invalid records are reported back by index and
+    the rest are still stored.
+    """
+    body = await request.body()
+    if len(body) > MAX_ACTIVITY_BATCH_BYTES:
+        raise HTTPException(status_code=413, detail=f"Batch exceeds {MAX_ACTIVITY_BATCH_BYTES} bytes")
+    try:
+        records = decode_batch(
+            body, request.headers.get("content-type"), request.headers.get("content-encoding"),
+            MAX_ACTIVITY_BATCH_BYTES, MAX_ACTIVITY_BATCH_RECORDS
+        )
+    except BatchDecodeError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.message)
+
+    now = datetime.now(timezone.utc)
+    docs = {}
+    rejected = []
+    for index, record in enumerate(records):
+        try:
+            log = ActivityLogBatchRecord(**record)
+        except ValidationError as e:
+            rejected.append({"index": index, "error": e.errors()[0]["msg"]})
+            continue
+        timestamp = log.timestamp or now
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        docs[log.client_id] = {
+            "log_id": f"log_{uuid.uuid4().hex[:12]}",
+            "client_id": log.client_id,
+            "user_id": user["user_id"],
+            "company_id": user["company_id"],
+            "app_name": log.app_name,
+            "url": log.url,
+            "activity_level": log.activity_level,
+            "window_title": log.window_title,
+            "duration": log.duration,
+            "category": log.category,
+            # Clock skew must not place activity in the future
+            "timestamp": min(timestamp, now).isoformat()
+        }
+
+    # Written by the ingest buffer; records already stored by an earlier
+    # attempt are skipped by the unique (user_id, client_id) index
+    ingest_buffer.submit_many("activity_logs", docs.values())
+
+    return {
+        "received": len(records),
+        "accepted": len(docs),
+        "rejected": rejected
+    }
+
+@api_router.post("/activity/buckets")
+async def upload_activity_buckets(data: ActivityBucketUpload, user: dict = Depends(get_current_user)):
+    """
+    Merge per-minute activity buckets into the user's daily rollups
+
+    Agents aggregate their samples per minute, app and domain and upload
+    closed minutes here instead of one raw event per sample. Re-sent buckets
+    are recognised by their (user, minute, app, domain) key and merged only
+    once. The response tells the agent whether the company still wants raw
+    activity events as well.
+    """
+    if data.version not in SUPPORTED_BUCKET_VERSIONS:
+        raise HTTPException(
+            status_code=400,
+            detail={"message": f"Unsupported bucket version {data.version}", "supported": list(SUPPORTED_BUCKET_VERSIONS)}
+        )
+
+    now = datetime.now(timezone.utc)
+    rows = {}
+    rejected = 0
+    for bucket in data.buckets:
+        row = bucket_row(user, bucket.model_dump(), now)
+        if row is None:
+            rejected += 1
+        else:
+            rows[row["bucket_id"]] = row
+
+    merged = await merge_buckets(db, list(rows.values()))
+
+    company = await db.companies.find_one({"company_id": user["company_id"]})
+    policy = (company or {}).get("tracking_policy") or {}
+    return {
+        "version": data.version,
+        "received": len(data.buckets),
+        "merged": merged,
+        "duplicates": len(data.buckets) - rejected - merged,
+        "rejected": rejected,
+        "raw_events": bool(policy.get("raw_activity_events", True))
+    }
+
+MAX_ROLLUP_RANGE_DAYS = 92
+ROLLUP_PAGE_SIZE = 1000  # rows per request, PostgREST's default row cap
+
+@api_router.get("/activity/rollups")
+async def get_activity_rollups(
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    user_id: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Daily per-app activity rollups and their per-app totals (dates are UTC days, YYYY-MM-DD)"""
+    query = {"company_id": user["company_id"]}
+    if user["role"] == "employee":
+        query["user_id"] = user["user_id"]
+    elif user_id:
+        if not await can_access_user_data(user, user_id):
+            raise HTTPException(status_code=403, detail="Access denied")
+        query["user_id"] = user_id
+
+    try:
+        end_day = date.fromisoformat(end_date) if end_date else datetime.now(timezone.utc).date()
+        start_day = date.fromisoformat(start_date) if start_date else end_day - timedelta(days=6)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must be YYYY-MM-DD")
+    if start_day > end_day:
+        raise HTTPException(status_code=400, detail="start_date must not be after end_date")
+    if (end_day - start_day).days >= MAX_ROLLUP_RANGE_DAYS:
+        raise HTTPException(status_code=400, detail=f"Date range cannot exceed {MAX_ROLLUP_RANGE_DAYS} days")
+    query["day"] = {"$gte": start_day.isoformat(), "$lte": end_day.isoformat()}
+
+    rollups = []
+    while True:
+        page = await db.daily_activity_rollups.find(
+            query, sort=[("day", 1), ("id", 1)], limit=ROLLUP_PAGE_SIZE, skip=len(rollups)
+        )
+        rollups.extend(page)
+        if len(page) < ROLLUP_PAGE_SIZE:
+            break
+    return {
+        "start_date": start_day.isoformat(),
+        "end_date": end_day.isoformat(),
+        "days": rollups,
+        "apps": summarize_rollups(rollups)
+    }
+
 @api_router.get("/activity-logs")
 async def get_activity_logs(
     start_date: Optional[str] = None,
@@ -1214,40 +1527,47 @@ async def get_timesheets(
 @api_router.post("/timesheets/generate")
 async def generate_timesheet(user: dict = Depends(get_current_user)):
     """Generate timesheet for current week"""
-    today = datetime.now(timezone.utc)
-    week_start = today - timedelta(days=today.weekday())
-    week_start = week_start.replace(hour=0, minute=0, second=0, microsecond=0)
-    week_end = week_start + timedelta(days=7)
+    company = await db.companies.find_one({"company_id": user["company_id"]})
+    week_start = local_week_start(company)
     
-    # Get time entries for the week
-    entries = await db.time_entries.find({
-        "user_id": user["user_id"],
-        "start_time": {"$gte": week_start.isoformat(), "$lt": week_end.isoformat()}
-    }, {"_id": 0}).to_list(1000)
-    
-    total_hours = sum(e.get("duration", 0) for e in entries) / 3600
-    
-    timesheet_id = f"timesheet_{uuid.uuid4().hex[:12]}"
-    timesheet = {
-        "timesheet_id": timesheet_id,
-        "user_id": user["user_id"],
-        "user_name": user["name"],
-        "company_id": user["company_id"],
-        "week_start": week_start.isoformat(),
-        "total_hours": round(total_hours, 2),
-        "billable_hours": round(total_hours, 2),
-        "status": "pending",
-        "entries": [{"entry_id": e["entry_id"], "duration": e.get("duration", 0)} for e in entries],
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
+    # Approved timesheets are kept as they are
+    await generate_timesheets(db, user["company_id"], week_start, user["user_id"])
+    timesheet = await db.timesheets.find_one({"user_id": user["user_id"], "week_start": week_start.isoformat()})
+    if not timesheet:
+        return {"timesheet_id": None, "total_hours": 0}
     
-    await db.timesheets.update_one(
-        {"user_id": user["user_id"], "week_start": week_start.isoformat()},
-        {"$set": timesheet},
-        upsert=True
-    )
+    return {"timesheet_id": timesheet["timesheet_id"], "total_hours": float(timesheet.get("total_hours") or 0)}
+
+class TimesheetBatchRequest(BaseModel):
+    week_start: Optional[str] = None  # YYYY-MM-DD, a Monday; defaults to the current week
+
+@api_router.post("/timesheets/generate/company")
+async def generate_company_timesheets(data: TimesheetBatchRequest, user: dict = Depends(get_current_user)):
+    """Generate a week's timesheets for every employee of the company in the background"""
+    if user["role"] not in ["admin", "hr"]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    if data.week_start:
+        try:
+            week_start = week_start_of(date.fromisoformat(data.week_start))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="week_start must be YYYY-MM-DD")
+    else:
+        company = await db.companies.find_one({"company_id": user["company_id"]})
+        week_start = local_week_start(company)
     
-    return {"timesheet_id": timesheet_id, "total_hours": round(total_hours, 2)}
+    if not await timesheet_batch_engine.trigger(db, user["company_id"], week_start):
+        raise HTTPException(status_code=409, detail="A timesheet batch is already running")
+    return {"message": "Timesheet generation started", "week_start": week_start.isoformat()}
+
+@api_router.get("/timesheets/generate/company")
+async def get_company_timesheets_status(user: dict = Depends(get_current_user)):
+    """Progress of the most recent timesheet batch of the company"""
+    if user["role"] not in ["admin", "hr"]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    progress = await read_progress(db, TIMESHEET_BATCH_JOB)
+    if progress and progress["company_id"] == user["company_id"]:
+        return progress
+    return {"status": "idle"}
 
 @api_router.put("/timesheets/{timesheet_id}/approve")
 async def approve_timesheet(timesheet_id: str, user: dict = Depends(get_current_user)):
@@ -1397,46 +1717,38 @@ async def generate_payroll(
             detail={"error": "feature_not_available", "feature": "payroll", "required_plan": "Pro", "message": "Payroll requires the Pro plan or higher."}
         )
     
-    # Get all approved timesheets in period
-    timesheets = await db.timesheets.find({
-        "company_id": user["company_id"],
-        "status": "approved",
-        "week_start": {"$gte": period_start, "$lte": period_end}
-    }, {"_id": 0}).to_list(1000)
-    
-    # Group by user
-    user_hours = {}
-    for ts in timesheets:
-        uid = ts["user_id"]
-        if uid not in user_hours:
-            user_hours[uid] = {"hours": 0, "name": ts.get("user_name", "")}
-        user_hours[uid]["hours"] += ts.get("total_hours", 0)
-    
-    # Generate payroll entries
-    payroll_entries = []
-    for uid, data in user_hours.items():
-        user_doc = await db.users.find_one({"user_id": uid}, {"_id": 0})
-        rate = user_doc.get("hourly_rate", 0) if user_doc else 0
-        
-        payroll_id = f"payroll_{uuid.uuid4().hex[:12]}"
-        entry = {
-            "payroll_id": payroll_id,
-            "user_id": uid,
-            "user_name": data["name"],
-            "company_id": user["company_id"],
-            "period_start": period_start,
-            "period_end": period_end,
-            "period": f"{period_start[:7]}",
-            "hours": round(data["hours"], 2),
-            "rate": rate,
-            "amount": round(data["hours"] * rate, 2),
-            "status": "pending",
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        await db.payroll.insert_one(entry)
-        payroll_entries.append(entry)
-    
-    return {"message": f"Generated {len(payroll_entries)} payroll entries", "entries": payroll_entries}
+    try:
+        start_day = date.fromisoformat(period_start[:10])
+        end_day = date.fromisoformat(period_end[:10])
+    except ValueError:
+        raise HTTPException(status_code=400, detail="period_start and period_end must be YYYY-MM-DD")
+    if end_day < start_day:
+        raise HTTPException(status_code=400, detail="period_end is before period_start")
+    
+    # Hours, rates, amounts and every payroll row in one statement
+    started = time.monotonic()
+    rows = await db.rpc("generate_payroll", {
+        "p_company_id": user["company_id"],
+        "p_period_start": start_day.isoformat(),
+        "p_period_end": end_day.isoformat()
+    })
+    run = rows[0] if rows else {}
+    
+    summary = {
+        "period_start": start_day.isoformat(),
+        "period_end": end_day.isoformat(),
+        "employees": run.get("employees") or 0,
+        "timesheets": run.get("timesheets") or 0,
+        "total_hours": float(run.get("total_hours") or 0),
+        "total_amount": float(run.get("total_amount") or 0),
+        "employees_without_rate": run.get("employees_without_rate") or 0,
+        "duration_ms": round((time.monotonic() - started) * 1000)
+    }
+    logger.info(
+        f"Generated payroll for {summary['employees']} employees of {user['company_id']} "
+        f"({summary['period_start']} to {summary['period_end']}) in {summary['duration_ms']}ms"
+    )
+    return {"message": f"Generated {summary['employees']} payroll entries", "summary": summary}
 
 @api_router.put("/payroll/{payroll_id}/process")
 async def process_payroll(payroll_id: str, user: dict = Depends(get_current_user)):
@@ -1452,70 +1764,30 @@ async def process_payroll(payroll_id: str, user: dict = Depends(get_current_user
 # ==================== DASHBOARD / STATS ROUTES ====================
 @api_router.get("/dashboard/stats")
 async def get_dashboard_stats(user: dict = Depends(get_current_user)):
-    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-    week_start = today - timedelta(days=today.weekday())
-    month_start = today.replace(day=1)
-    
-    query_base = {"company_id": user["company_id"]}
-    if user["role"] == "employee":
-        query_base["user_id"] = user["user_id"]
-    
-    # Today's hours
-    today_entries = await db.time_entries.find({
-        **query_base,
-        "start_time": {"$gte": today.isoformat()}
-    }, {"_id": 0}).to_list(1000)
-    today_hours = sum(e.get("duration", 0) for e in today_entries) / 3600
-    
-    # Week hours
-    week_entries = await db.time_entries.find({
-        **query_base,
-        "start_time": {"$gte": week_start.isoformat()}
-    }, {"_id": 0}).to_list(1000)
-    week_hours = sum(e.get("duration", 0) for e in week_entries) / 3600
-    
-    # Month hours
-    month_entries = await db.time_entries.find({
-        **query_base,
-        "start_time": {"$gte": month_start.isoformat()}
-    }, {"_id": 0}).to_list(1000)
-    month_hours = sum(e.get("duration", 0) for e in month_entries) / 3600
-    
-    # Activity stats
-    activity_logs = await db.activity_logs.find({
-        **query_base,
-        "timestamp": {"$gte": today.isoformat()}
-    }, {"_id": 0}).to_list(1000)
-    avg_activity = sum(l.get("activity_level", 0) for l in activity_logs) / max(len(activity_logs), 1)
-    
-    # Team stats (for managers/admins)
-    team_online = 0
-    team_total = 0
-    if user["role"] in ["admin", "manager", "hr"]:
-        team_total = await db.users.count_documents({"company_id": user["company_id"]})
-        # Count active time entries in last 15 minutes
-        recent_cutoff = (datetime.now(timezone.utc) - timedelta(minutes=15)).isoformat()
-        team_online = len(set([
-            e["user_id"] for e in await db.time_entries.find({
-                "company_id": user["company_id"],
-                "status": "active"
-            }, {"user_id": 1, "_id": 0}).to_list(1000)
-        ]))
+    is_reviewer = user["role"] in ["admin", "manager", "hr"]
+    
+    # Hours for today, week and month (company local days, from daily_user_stats)
+    # plus the counts, in one round trip
+    rows = await db.rpc("dashboard_stats", {
+        "p_company_id": user["company_id"],
+        "p_user_id": user["user_id"] if user["role"] == "employee" else None,
+        "p_include_team": is_reviewer
+    })
+    stats = rows[0] if rows else {}
     
     # Pending approvals
-    pending_leaves = await db.leaves.count_documents({**query_base, "status": "pending"}) if user["role"] in ["admin", "manager", "hr"] else 0
-    pending_timesheets = await db.timesheets.count_documents({**query_base, "status": "pending"}) if user["role"] in ["admin", "manager", "hr"] else 0
+    pending_leaves = await db.leaves.count_documents({"company_id": user["company_id"], "status": "pending"}) if is_reviewer else 0
     
     return {
-        "today_hours": round(today_hours, 2),
-        "week_hours": round(week_hours, 2),
-        "month_hours": round(month_hours, 2),
-        "avg_activity": round(avg_activity, 1),
-        "team_online": team_online,
-        "team_total": team_total,
+        "today_hours": round((stats.get("today_seconds") or 0) / 3600, 2),
+        "week_hours": round((stats.get("week_seconds") or 0) / 3600, 2),
+        "month_hours": round((stats.get("month_seconds") or 0) / 3600, 2),
+        "avg_activity": round(float(stats.get("avg_activity") or 0), 1),
+        "team_online": stats.get("team_online") or 0,
+        "team_total": stats.get("team_total") or 0,
         "pending_leaves": pending_leaves,
-        "pending_timesheets": pending_timesheets,
-        "screenshots_today": await db.screenshots.count_documents({**query_base, "taken_at": {"$gte": today.isoformat()}})
+        "pending_timesheets": stats.get("pending_timesheets") or 0,
+        "screenshots_today": stats.get("screenshots_today") or 0
     }
 
 @api_router.get("/dashboard/team-status")
@@ -1523,78 +1795,46 @@ async def get_team_status(user: dict = Depends(get_current_user)):
     if user["role"] not in ["admin", "manager", "hr"]:
         raise HTTPException(status_code=403, detail="Not authorized")
     
-    team = await db.users.find(
-        {"company_id": user["company_id"]},
-        {"_id": 0, "password_hash": 0}
-    ).to_list(1000)
-    
-    result = []
-    for member in team:
-        # Get active time entry
-        active_entry = await db.time_entries.find_one(
-            {"user_id": member["user_id"], "status": "active"},
-            {"_id": 0}
-        )
-        
-        # Get latest activity
-        latest_activity = await db.activity_logs.find_one(
-            {"user_id": member["user_id"]},
-            {"_id": 0},
-            sort=[("timestamp", -1)]
-        )
-        
-        # Get today's hours
-        today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-        today_entries = await db.time_entries.find({
-            "user_id": member["user_id"],
-            "start_time": {"$gte": today.isoformat()}
-        }, {"_id": 0}).to_list(100)
-        today_hours = sum(e.get("duration", 0) for e in today_entries) / 3600
-        
-        status = "offline"
-        if active_entry:
-            status = "active"
-            if latest_activity:
-                activity_time = datetime.fromisoformat(latest_activity["timestamp"].replace('Z', '+00:00'))
-                if datetime.now(timezone.utc) - activity_time > timedelta(minutes=5):
-                    status = "idle"
-        
-        result.append({
-            "user_id": member["user_id"],
-            "name": member["name"],
-            "email": member["email"],
-            "role": member["role"],
-            "picture": member.get("picture"),
-            "status": status,
-            "today_hours": round(today_hours, 2),
-            "current_app": latest_activity.get("app_name") if latest_activity else None,
-            "activity_level": latest_activity.get("activity_level", 0) if latest_activity else 0
-        })
-    
-    return result
+    # Answered from the in-memory presence index; a cold company is loaded with one query
+    return await presence_index.team_status(db, user["company_id"])
+
+@api_router.post("/presence/heartbeat")
+async def presence_heartbeat(data: PresenceHeartbeat, user: dict = Depends(get_current_user)):
+    """Agents report presence every 30 seconds; without a heartbeat the user goes offline after the presence TTL"""
+    return await presence_service.heartbeat(user, data.status, data.app_name, data.activity_level)
+
+@api_router.get("/presence")
+async def get_presence(user: dict = Depends(get_current_user)):
+    """Everyone in the company currently online or idle; changes are pushed over the websocket"""
+    if user["role"] not in ["admin", "manager", "hr"]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return await presence_service.snapshot(user["company_id"])
 
 @api_router.get("/dashboard/activity-chart")
 async def get_activity_chart(days: int = 7, user: dict = Depends(get_current_user)):
-    start_date = datetime.now(timezone.utc) - timedelta(days=days)
+    company = await db.companies.find_one({"company_id": user["company_id"]})
+    today = datetime.now(resolve_timezone((company or {}).get("timezone"))).date()
+    start_day = today - timedelta(days=days - 1)
     
-    query = {"company_id": user["company_id"], "start_time": {"$gte": start_date.isoformat()}}
+    query = {"company_id": user["company_id"]}
     if user["role"] == "employee":
         query["user_id"] = user["user_id"]
     
-    entries = await db.time_entries.find(query, {"_id": 0}).to_list(10000)
+    # One rollup row per user and day instead of every time entry
+    stats = await read_daily_stats(db, query, start_day, today)
     
     # Group by date
     daily_data = {}
-    for e in entries:
-        date = e["start_time"][:10]
+    for row in stats:
+        date = row["day"]
         if date not in daily_data:
             daily_data[date] = {"hours": 0, "entries": 0}
-        daily_data[date]["hours"] += e.get("duration", 0) / 3600
-        daily_data[date]["entries"] += 1
+        daily_data[date]["hours"] += row.get("tracked_seconds", 0) / 3600
+        daily_data[date]["entries"] += row.get("entry_count", 0)
     
     result = []
     for i in range(days):
-        date = (datetime.now(timezone.utc) - timedelta(days=days-1-i)).strftime("%Y-%m-%d")
+        date = (start_day + timedelta(days=i)).isoformat()
         result.append({
             "date": date,
             "hours": round(daily_data.get(date, {"hours": 0})["hours"], 2),
@@ -1603,6 +1843,37 @@ async def get_activity_chart(days: int = 7, user: dict = Depends(get_current_use
     
     return result
 
+class DailyStatsRebuildRequest(BaseModel):
+    start_date: str  # YYYY-MM-DD, company local days
+    end_date: Optional[str] = None
+
+@api_router.post("/dashboard/daily-stats/rebuild")
+async def rebuild_daily_stats(data: DailyStatsRebuildRequest, user: dict = Depends(get_current_user)):
+    """Rebuild the company's daily user stats from its time entries in the background (admin only)"""
+    if user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Only admins can rebuild daily stats")
+    try:
+        start_day = date.fromisoformat(data.start_date)
+        end_day = date.fromisoformat(data.end_date) if data.end_date else datetime.now(timezone.utc).date() + timedelta(days=1)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must be YYYY-MM-DD")
+    if end_day < start_day:
+        raise HTTPException(status_code=400, detail="end_date is before start_date")
+
+    if not await daily_stats_repair_engine.trigger(db, user["company_id"], start_day, end_day):
+        raise HTTPException(status_code=409, detail="A daily stats rebuild is already running")
+    return {"message": "Daily stats rebuild started", "start_date": start_day.isoformat(), "end_date": end_day.isoformat()}
+
+@api_router.get("/dashboard/daily-stats/rebuild")
+async def get_daily_stats_rebuild_status(user: dict = Depends(get_current_user)):
+    """Progress of the most recent daily stats rebuild of the company"""
+    if user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized")
+    progress = await read_progress(db, DAILY_STATS_JOB)
+    if progress and progress["company_id"] == user["company_id"]:
+        return progress
+    return {"status": "idle"}
+
 # ==================== PROJECT ROUTES ====================
 @api_router.post("/projects")
 async def create_project(project: ProjectCreate, user: dict = Depends(get_current_user)):
@@ -2034,6 +2305,22 @@ async def get_today_attendance(user: dict = Depends(get_current_user)):
     
     return attendance or {"status": "not_clocked_in"}
 
+ATTENDANCE_REPORT_PAGE_SIZE = 500  # members per attendance_report call
+
+def attendance_report_row(row: dict) -> dict:
+    records = row.get("records") or 0
+    present_days = row.get("present_days") or 0
+    return {
+        "user_id": row["user_id"],
+        "name": row["name"],
+        "total_work_hours": round(float(row.get("total_work_hours") or 0), 2),
+        "total_overtime": round(float(row.get("total_overtime") or 0), 2),
+        "present_days": present_days,
+        "late_days": row.get("late_days") or 0,
+        "absent_days": row.get("absent_days") or 0,
+        "attendance_rate": round(present_days / max(records, 1) * 100, 1)
+    }
+
 @api_router.get("/attendance/report")
 async def get_attendance_report(
     start_date: str,
@@ -2042,38 +2329,39 @@ async def get_attendance_report(
 ):
     if user["role"] not in ["admin", "hr", "manager"]:
         raise HTTPException(status_code=403, detail="Not authorized")
+    try:
+        start_day = date.fromisoformat(start_date[:10])
+        end_day = date.fromisoformat(end_date[:10])
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must be YYYY-MM-DD")
+    
+    async def fetch_page(after_user_id: Optional[str]) -> List[dict]:
+        # Every member of the page in one grouped range query
+        return await db.rpc("attendance_report", {
+            "p_company_id": user["company_id"],
+            "p_start": start_day.isoformat(),
+            "p_end": end_day.isoformat(),
+            "p_after_user_id": after_user_id,
+            "p_limit": ATTENDANCE_REPORT_PAGE_SIZE
+        })
     
-    # Get all team members
-    team = await db.users.find(
-        {"company_id": user["company_id"]},
-        {"_id": 0, "user_id": 1, "name": 1}
-    ).to_list(1000)
+    # The first page is read before streaming starts so a failure is still a proper error response
+    first_page = await fetch_page(None)
     
-    report = []
-    for member in team:
-        attendance_records = await db.attendance.find({
-            "user_id": member["user_id"],
-            "date": {"$gte": start_date, "$lte": end_date}
-        }, {"_id": 0}).to_list(100)
-        
-        total_work_hours = sum(a.get("work_hours", 0) for a in attendance_records)
-        total_overtime = sum(a.get("overtime", 0) for a in attendance_records)
-        present_days = len([a for a in attendance_records if a.get("status") in ["present", "late"]])
-        late_days = len([a for a in attendance_records if a.get("status") == "late"])
-        absent_days = len([a for a in attendance_records if a.get("status") == "absent"])
-        
-        report.append({
-            "user_id": member["user_id"],
-            "name": member["name"],
-            "total_work_hours": round(total_work_hours, 2),
-            "total_overtime": round(total_overtime, 2),
-            "present_days": present_days,
-            "late_days": late_days,
-            "absent_days": absent_days,
-            "attendance_rate": round(present_days / max(len(attendance_records), 1) * 100, 1)
-        })
+    async def stream_report():
+        page = first_page
+        separator = ""
+        yield "["
+        while True:
+            for row in page:
+                yield separator + json.dumps(attendance_report_row(row))
+                separator = ","
+            if len(page) < ATTENDANCE_REPORT_PAGE_SIZE:
+                break
+            page = await fetch_page(page[-1]["user_id"])
+        yield "]"
     
-    return report
+    return StreamingResponse(stream_report(), media_type="application/json")
 
 # ==================== INVOICE ROUTES ====================
 @api_router.post("/invoices")
@@ -2572,15 +2860,29 @@ async def get_my_users(user: dict = Depends(get_current_user)):
 # ==================== WEBSOCKET ====================
 @app.websocket("/ws/{company_id}")
 async def websocket_endpoint(websocket: WebSocket, company_id: str):
-    await manager.connect(websocket, company_id)
+    # Browsers cannot set headers on a websocket: the token comes as a query parameter or the cookie
+    token = websocket.query_params.get("token") or session_token_from(websocket)
+    user = await user_for_token(db, token) if token else None
+    if not user or user.get("company_id") != company_id:
+        await websocket.close(code=1008)
+        return
+
+    views_presence = user["role"] in ["admin", "manager", "hr"]
+    await manager.connect(websocket, company_id, views_presence)
     try:
+        if views_presence:
+            await follow_presence(company_id)
+            await websocket.send_json({"type": "presence_snapshot", "data": await presence_service.snapshot(company_id)})
         while True:
             data = await websocket.receive_json()
             # Handle incoming WebSocket messages if needed
             if data.get("type") == "ping":
                 await websocket.send_json({"type": "pong"})
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket, company_id)
+        await unfollow_presence(company_id)
 
 @api_router.get("/")
 async def root():
@@ -2772,6 +3074,7 @@ async def activate_subscription_after_payment(
 api_router.include_router(payments_router)
 api_router.include_router(ai_insights_router)
 api_router.include_router(storage_router)
+api_router.include_router(chunked_uploads_router)
 api_router.include_router(email_router)
 api_router.include_router(pdf_router)
 api_router.include_router(calendar_router)
@@ -2801,10 +3104,29 @@ api_router.include_router(idle_break_router)
 api_router.include_router(integrations_router)
 api_router.include_router(security_router)
 api_router.include_router(analytics_router)
+api_router.include_router(metrics_router)
 
 # Then include api_router into app
 app.include_router(api_router)
 
+# Conditional GETs for the endpoints the dashboard polls; every tag also covers `users`.
+# Without a shared pub/sub backend (PUBSUB_URL) every request is rendered.
+if data_versions.enabled:
+    app.add_middleware(
+        ConditionalGetMiddleware,
+        policies={
+            "/api/dashboard/stats": CachePolicy(
+                ["time_entries", "timesheets", "leaves", "screenshots", "companies"], refresh=30
+            ),
+            "/api/dashboard/team-status": CachePolicy(["time_entries", "companies"], refresh=30),
+            "/api/dashboard/activity-chart": CachePolicy(["time_entries", "companies"], refresh=60),
+            "/api/notifications": CachePolicy(["notifications"]),
+            "/api/attendance/today": CachePolicy(["attendance"], refresh=60),
+        },
+        versions=data_versions,
+        claims=jwt_claims,
+    )
+
 # CORS
 app.add_middleware(
     CORSMiddleware,
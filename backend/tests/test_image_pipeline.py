@@ -0,0 +1,99 @@
+import asyncio
+import io
+
+from PIL import Image
+
+import utils.storage_backends
+from utils.image_pipeline import ImagePipeline
+
+
+class FakeStorage:
+    storage_type = "s3"
+
+    def __init__(self):
+        self.blobs = {}
+
+    async def read_bytes(self, key):
+        return self.blobs[key]
+
+    async def save_bytes(self, data, key, content_type):
+        self.blobs[key] = data
+        return key
+
+    async def delete(self, key):
+        self.blobs.pop(key, None)
+
+    def reference(self, key):
+        return f"s3://bucket/{key}"
+
+
+class FakeCollection:
+    def __init__(self, rows=None):
+        self.rows = rows or []
+
+    def _matches(self, row, query):
+        for field, value in query.items():
+            if isinstance(value, dict):
+                if "$ne" in value and row.get(field) == value["$ne"]:
+                    return False
+                if "$gte" in value and not (row.get(field) or "") >= value["$gte"]:
+                    return False
+            elif row.get(field) != value:
+                return False
+        return True
+
+    async def find_one(self, query):
+        return next((dict(row) for row in self.rows if self._matches(row, query)), None)
+
+    async def find(self, query=None, sort=None, limit=None):
+        return [dict(row) for row in self.rows if self._matches(row, query or {})][:limit]
+
+    async def count_documents(self, query):
+        return len([row for row in self.rows if self._matches(row, query)])
+
+    async def update_one(self, query, update):
+        for row in self.rows:
+            if self._matches(row, query):
+                row.update(update["$set"])
+                return {"modified_count": 1}
+        return {"modified_count": 0}
+
+
+class FakeDB:
+    def __init__(self, screenshots, companies):
+        self.screenshots = FakeCollection(screenshots)
+        self.companies = FakeCollection(companies)
+
+
+def webp_upload() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (640, 360), (40, 120, 200)).save(buffer, "WEBP", quality=95)
+    return buffer.getvalue()
+
+
+def test_processing_a_webp_upload_keeps_the_served_image(monkeypatch):
+    storage = FakeStorage()
+    storage.blobs["screenshots/2026/01/05/shot_1.webp"] = webp_upload()
+    monkeypatch.setattr(utils.storage_backends, "get_storage", lambda storage_type=None: storage)
+
+    screenshot = {
+        "screenshot_id": "shot_1",
+        "user_id": "user_1",
+        "company_id": "company_1",
+        "storage_type": "s3",
+        "s3_key": "screenshots/2026/01/05/shot_1.webp",
+        "taken_at": "2026-01-05T09:00:00+00:00",
+        "duplicate_of": None,
+        "blurred": True
+    }
+    company = {"company_id": "company_1", "tracking_policy": {"original_retention_hours": 24}}
+    pipeline = ImagePipeline()
+    pipeline.db = FakeDB([screenshot], [company])
+
+    assert asyncio.run(pipeline.process_screenshot("shot_1")) == "ok"
+
+    row = pipeline.db.screenshots.rows[0]
+    assert row["s3_key"] != row["original_key"]
+    assert row["s3_key"] in storage.blobs
+    assert row["original_key"] in storage.blobs
+    assert row["thumbnail_key"] in storage.blobs
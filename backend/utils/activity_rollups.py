@@ -0,0 +1,72 @@
+"""
+Activity Rollups
+Per-minute activity buckets uploaded by agents, merged into per-user, per-day rollups
+"""
+import hashlib
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional
+
+SUPPORTED_BUCKET_VERSIONS = (1,)
+MAX_BUCKET_AGE = timedelta(days=7)  # older buckets are refused; their dedup keys may be purged
+BUCKET_COUNTERS = ("active_seconds", "idle_seconds", "keystrokes", "mouse_clicks", "mouse_moves")
+
+
+def bucket_id(user_id: str, minute: datetime, app_name: str, domain: Optional[str]) -> str:
+    """Deterministic id of a bucket, so a re-sent bucket is recognised and merged only once"""
+    key = f"{user_id}|{minute.isoformat()}|{app_name}|{domain or ''}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def bucket_row(user: Dict, bucket: Dict, now: datetime) -> Optional[Dict]:
+    """Row for `merge_activity_buckets`, or None when the bucket's minute is out of range"""
+    minute = bucket["minute"]
+    if minute.tzinfo is None:
+        minute = minute.replace(tzinfo=timezone.utc)
+    minute = minute.astimezone(timezone.utc).replace(second=0, microsecond=0)
+    if minute > now or now - minute > MAX_BUCKET_AGE:
+        return None
+
+    domain = bucket.get("domain") or ""
+    return {
+        "bucket_id": bucket_id(user["user_id"], minute, bucket["app_name"], domain),
+        "user_id": user["user_id"],
+        "company_id": user["company_id"],
+        "minute": minute.isoformat(),
+        "app_name": bucket["app_name"],
+        "domain": domain,
+        "category": bucket.get("category"),
+        **{counter: int(bucket.get(counter) or 0) for counter in BUCKET_COUNTERS}
+    }
+
+
+async def merge_buckets(db, rows: List[Dict]) -> int:
+    """
+    Merge bucket rows into `daily_activity_rollups` in one statement
+
+    Returns how many buckets were new; buckets merged by an earlier upload
+    are skipped.
+    """
+    if not rows:
+        return 0
+    result = await db.rpc("merge_activity_buckets", {"p_buckets": rows})
+    return int(result[0]["merged"]) if result else 0
+
+
+def summarize_rollups(rollups: List[Dict]) -> List[Dict]:
+    """Totals per app (and domain) across days, most active first"""
+    totals: Dict[tuple, Dict] = {}
+    for row in rollups:
+        key = (row["app_name"], row.get("domain") or "")
+        total = totals.get(key)
+        if total is None:
+            total = totals[key] = {
+                "app_name": row["app_name"],
+                "domain": row.get("domain") or None,
+                "category": row.get("category"),
+                "minutes": 0,
+                **{counter: 0 for counter in BUCKET_COUNTERS}
+            }
+        total["minutes"] += row.get("minutes") or 0
+        for counter in BUCKET_COUNTERS:
+            total[counter] += row.get(counter) or 0
+    return sorted(totals.values(), key=lambda total: total["active_seconds"], reverse=True)
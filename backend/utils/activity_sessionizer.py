@@ -0,0 +1,229 @@
+"""
+Activity Sessionizer
+Merges consecutive activity log samples of the same app (or window) into compact session rows
+"""
+import os
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional
+import logging
+
+from utils.id_generator import generate_id
+from utils.ingest_buffer import ingest_buffer
+from utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+SESSION_GAP_SECONDS = int(os.environ.get('SESSION_GAP_SECONDS', 120))
+# Time a sample without its own `duration` stands for; the desktop tracker samples once a minute
+SESSION_SAMPLE_SECONDS = int(os.environ.get('SESSION_SAMPLE_SECONDS', 60))
+SESSION_GROUPING = os.environ.get('SESSION_GROUPING', 'app')  # app or window
+# Times a user's samples are re-merged when another worker changed their open session meanwhile
+SESSION_UPDATE_ATTEMPTS = 3
+
+
+def _parse_time(value) -> datetime:
+    if isinstance(value, datetime):
+        moment = value
+    else:
+        moment = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment
+
+
+class ActivitySessionizer:
+    """
+    Turns the stream of `activity_logs` samples into `activity_sessions`
+    intervals (start, end, sample count, mean activity level)
+
+    Samples are fed as the ingest buffer writes them. A sample extends the
+    user's open session when it has the same app (or app and window title,
+    with SESSION_GROUPING=window) and starts within `gap_seconds` of the
+    session's end; otherwise the open session is closed and a new one opened.
+    The open session of each user lives in the database, so sessionizing
+    resumes across restarts and workers. Existing sessions are only
+    updated if their `updated_at` is still the one read: when another
+    worker changed a user's open session in between, that user's samples
+    are merged again from a fresh read. New sessions are written in one
+    bulk upsert per flush.
+
+    Samples older than the user's open session (late batch uploads) are
+    sessionized among themselves into closed sessions.
+    """
+
+    def __init__(self, gap_seconds: int = SESSION_GAP_SECONDS,
+                 sample_seconds: int = SESSION_SAMPLE_SECONDS,
+                 grouping: str = SESSION_GROUPING):
+        self.gap = timedelta(seconds=gap_seconds)
+        self.sample_seconds = sample_seconds
+        self.grouping = grouping
+        self.db = None
+
+        self.samples = registry.counter("activity_sessionizer_samples_total", "Activity samples sessionized")
+        self.sessions_opened = registry.counter(
+            "activity_sessions_opened_total", "Activity sessions opened", ["kind"]
+        )
+        self.errors = registry.counter("activity_sessionizer_errors_total", "Failed sessionizer batches")
+
+    async def start(self, db):
+        """Sessionize activity logs as the ingest buffer writes them"""
+        self.db = db
+        ingest_buffer.subscribe("activity_logs", self.feed)
+        logger.info(f"Activity sessionizer started (gap {int(self.gap.total_seconds())}s, by {self.grouping})")
+
+    def _key(self, sample: Dict) -> tuple:
+        if self.grouping == "window":
+            return (sample.get("app_name") or "Unknown", sample.get("window_title") or "")
+        return (sample.get("app_name") or "Unknown",)
+
+    async def feed(self, logs: List[Dict]):
+        """Merge newly written activity logs into their users' sessions"""
+        if not logs:
+            return
+        try:
+            await self._feed(logs)
+        except Exception as e:
+            self.errors.inc()
+            logger.error(f"Error sessionizing {len(logs)} activity logs: {e}")
+
+    async def _feed(self, logs: List[Dict]):
+        by_user: Dict[str, List[Dict]] = {}
+        for log in logs:
+            by_user.setdefault(log["user_id"], []).append(log)
+
+        open_rows = await self.db.activity_sessions.find(
+            {"user_id": {"$in": list(by_user)}, "status": "open"},
+            sort=[("ended_at", 1)]
+        )
+        rows_by_user: Dict[str, List[Dict]] = {}
+        for row in open_rows:
+            rows_by_user.setdefault(row["user_id"], []).append(row)
+
+        created: List[Dict] = []
+        for user_id, samples in by_user.items():
+            samples.sort(key=lambda sample: _parse_time(sample["timestamp"]))
+            rows = rows_by_user.get(user_id, [])
+            for _ in range(SESSION_UPDATE_ATTEMPTS):
+                changed = self._sessionize(rows, samples)
+                if await self._update_existing(rows, changed):
+                    break
+                rows = await self.db.activity_sessions.find(
+                    {"user_id": user_id, "status": "open"}, sort=[("ended_at", 1)]
+                )
+            else:
+                self.errors.inc()
+                logger.error(f"Open session of user {user_id} kept changing, {len(samples)} samples not sessionized")
+                continue
+
+            existing = {row["session_id"] for row in rows}
+            for session_id, session in changed.items():
+                if session_id not in existing:
+                    created.append(self._row(session))
+                    self.sessions_opened.inc(kind=session["kind"])
+            self.samples.inc(len(samples))
+
+        await self.db.activity_sessions.upsert_many(created, on_conflict="session_id")
+
+    def _sessionize(self, rows: List[Dict], samples: List[Dict]) -> Dict[str, Dict]:
+        """Merge one user's samples, oldest first, into their open session rows; returns the changed sessions"""
+        changed: Dict[str, Dict] = {}
+        session = None
+        for row in rows:
+            # Two workers may each have opened one; only the latest stays open
+            if session is not None:
+                session["status"] = "closed"
+                changed[session["session_id"]] = session
+            session = {
+                **row,
+                "started_at": _parse_time(row["started_at"]),
+                "ended_at": _parse_time(row["ended_at"])
+            }
+
+        late = None
+        for sample in samples:
+            if session is not None and _parse_time(sample["timestamp"]) < session["started_at"] - self.gap:
+                late = self._advance(late, sample, changed, "closed")
+            else:
+                session = self._advance(session, sample, changed, "open")
+        return changed
+
+    async def _update_existing(self, rows: List[Dict], changed: Dict[str, Dict]) -> bool:
+        """
+        Write the changed sessions that already exist, each only if nobody
+        updated it since `rows` were read; False on the first conflict
+
+        Sessions that were only closed go first: repeating them after a
+        conflict is harmless, while the one session that gained samples is
+        written last, so it is never written twice.
+        """
+        originals = {row["session_id"]: row for row in rows}
+        updates = [session for session_id, session in changed.items() if session_id in originals]
+        updates.sort(key=lambda session: session["sample_count"] != originals[session["session_id"]]["sample_count"])
+        for session in updates:
+            result = await self.db.activity_sessions.update_one(
+                {"session_id": session["session_id"], "updated_at": originals[session["session_id"]]["updated_at"]},
+                {"$set": self._row(session)}
+            )
+            if not result["modified_count"]:
+                return False
+        return True
+
+    def _advance(self, session: Optional[Dict], sample: Dict, changed: Dict[str, Dict],
+                 status: str) -> Dict:
+        """Add `sample` to `session`, or close `session` and return a new one holding `sample`"""
+        start = _parse_time(sample["timestamp"])
+        end = start + timedelta(seconds=sample.get("duration") or self.sample_seconds)
+        level = sample.get("activity_level") or 0
+
+        if (session is not None
+                and self._key(session) == self._key(sample)
+                and session["started_at"] - self.gap <= start <= session["ended_at"] + self.gap):
+            session["started_at"] = min(session["started_at"], start)
+            session["ended_at"] = max(session["ended_at"], end)
+            session["sample_count"] += 1
+            session["activity_sum"] += level
+            if sample.get("window_title"):
+                session["window_title"] = sample["window_title"]
+            changed[session["session_id"]] = session
+            return session
+
+        if session is not None and session["status"] == "open":
+            session["status"] = "closed"
+            changed[session["session_id"]] = session
+
+        new_session = {
+            "session_id": generate_id("session"),
+            "user_id": sample["user_id"],
+            "company_id": sample["company_id"],
+            "app_name": sample.get("app_name") or "Unknown",
+            "window_title": sample.get("window_title"),
+            "started_at": start,
+            "ended_at": end,
+            "sample_count": 1,
+            "activity_sum": level,
+            "status": status,
+            "kind": "late" if status == "closed" else "live"
+        }
+        changed[new_session["session_id"]] = new_session
+        return new_session
+
+    def _row(self, session: Dict) -> Dict:
+        return {
+            "session_id": session["session_id"],
+            "user_id": session["user_id"],
+            "company_id": session["company_id"],
+            "app_name": session["app_name"],
+            "window_title": session.get("window_title"),
+            "started_at": session["started_at"].isoformat(),
+            "ended_at": session["ended_at"].isoformat(),
+            "duration": int((session["ended_at"] - session["started_at"]).total_seconds()),
+            "sample_count": session["sample_count"],
+            "activity_sum": session["activity_sum"],
+            "avg_activity": round(session["activity_sum"] / session["sample_count"], 1),
+            "status": session["status"],
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }
+
+
+# Global sessionizer instance
+activity_sessionizer = ActivitySessionizer()
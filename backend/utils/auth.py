@@ -0,0 +1,71 @@
+"""
+Auth
+Session token resolution shared by the API routes, route modules and the websocket
+"""
+import os
+from datetime import datetime, timezone
+from typing import Optional
+import logging
+
+import jwt
+from fastapi import HTTPException, Request
+from starlette.requests import HTTPConnection
+
+logger = logging.getLogger(__name__)
+
+# JWT Configuration
+JWT_SECRET = os.environ.get('JWT_SECRET', 'workmonitor-secret-key-2024')
+JWT_ALGORITHM = 'HS256'
+
+
+def jwt_claims(token: str) -> Optional[dict]:
+    """Claims of a valid JWT, without the user lookup; None for session tokens and invalid JWTs"""
+    try:
+        return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except jwt.InvalidTokenError:
+        return None
+
+
+def session_token_from(connection: HTTPConnection) -> Optional[str]:
+    """The session token of a request or websocket: cookie first, then a bearer Authorization header"""
+    token = connection.cookies.get('session_token')
+    if not token:
+        auth_header = connection.headers.get('Authorization')
+        if auth_header and auth_header.startswith('Bearer '):
+            token = auth_header.split(' ')[1]
+    return token
+
+
+async def user_for_token(db, session_token: str) -> Optional[dict]:
+    """The user a JWT or OAuth session token belongs to; None when the token is invalid or expired"""
+    # Check if it's a JWT token
+    payload = jwt_claims(session_token)
+    if payload is not None:
+        return await db.users.find_one({"user_id": payload['user_id']}, {"_id": 0})
+
+    # Check if it's a session token from Google OAuth
+    session = await db.user_sessions.find_one({"session_token": session_token}, {"_id": 0})
+    if not session:
+        return None
+
+    expires_at = session.get("expires_at")
+    if isinstance(expires_at, str):
+        expires_at = datetime.fromisoformat(expires_at)
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    if expires_at < datetime.now(timezone.utc):
+        return None
+
+    return await db.users.find_one({"user_id": session['user_id']}, {"_id": 0})
+
+
+async def get_current_user(request: Request) -> dict:
+    """Route dependency: the authenticated user, or 401"""
+    session_token = session_token_from(request)
+    if not session_token:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    user = await user_for_token(request.app.state.db, session_token)
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid or expired session")
+    return user
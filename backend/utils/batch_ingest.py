@@ -0,0 +1,74 @@
+"""
+Batch Ingest
+Decoding of batched telemetry uploads: JSON arrays or NDJSON, optionally gzip or zstd compressed
+"""
+import io
+import json
+import zlib
+from typing import Dict, List, Optional
+
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+
+class BatchDecodeError(Exception):
+    """A batch body that cannot be decoded; `status_code` is the HTTP status to answer with"""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+def decompress(body: bytes, content_encoding: Optional[str], max_bytes: int) -> bytes:
+    """Undo Content-Encoding, refusing bodies that expand past `max_bytes`"""
+    encoding = (content_encoding or "identity").strip().lower()
+    if encoding == "identity":
+        data = body
+    elif encoding in ("gzip", "x-gzip"):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            data = decompressor.decompress(body, max_bytes + 1)
+        except zlib.error:
+            raise BatchDecodeError(400, "Invalid gzip body")
+    elif encoding == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise BatchDecodeError(415, "zstd encoding is not supported by this server")
+        try:
+            with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)) as reader:
+                data = reader.read(max_bytes + 1)
+        except zstandard.ZstdError:
+            raise BatchDecodeError(400, "Invalid zstd body")
+    else:
+        raise BatchDecodeError(415, f"Unsupported content encoding: {encoding}")
+
+    if len(data) > max_bytes:
+        raise BatchDecodeError(413, f"Decompressed batch exceeds {max_bytes} bytes")
+    return data
+
+
+def parse_records(data: bytes, content_type: Optional[str]) -> List[Dict]:
+    """Records of a JSON array (or {"records": [...]}) or of NDJSON, one object per line"""
+    media_type = (content_type or "application/json").split(";")[0].strip().lower()
+    try:
+        if media_type in NDJSON_CONTENT_TYPES:
+            records = [json.loads(line) for line in data.splitlines() if line.strip()]
+        else:
+            records = json.loads(data)
+            if isinstance(records, dict):
+                records = records.get("records")
+    except (ValueError, UnicodeDecodeError):
+        raise BatchDecodeError(400, "Malformed JSON in batch")
+
+    if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+        raise BatchDecodeError(400, "Batch must be a list of JSON objects")
+    return records
+
+
+def decode_batch(body: bytes, content_type: Optional[str], content_encoding: Optional[str],
+                 max_bytes: int, max_records: int) -> List[Dict]:
+    records = parse_records(decompress(body, content_encoding, max_bytes), content_type)
+    if len(records) > max_records:
+        raise BatchDecodeError(413, f"At most {max_records} records per batch")
+    return records
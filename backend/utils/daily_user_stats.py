@@ -0,0 +1,194 @@
+"""
+Daily User Stats
+Backfill and repair of the `daily_user_stats` rollup, and helpers for reading it
+"""
+import asyncio
+import os
+from datetime import date, datetime, timezone, timedelta
+from typing import Dict, List, Optional
+import logging
+
+from utils.job_runs import JobLease, read_progress
+from utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+DAILY_STATS_REPAIR_INTERVAL = int(os.environ.get('DAILY_STATS_REPAIR_INTERVAL', 24 * 3600))
+DAILY_STATS_REPAIR_DAYS = int(os.environ.get('DAILY_STATS_REPAIR_DAYS', 3))
+DAILY_STATS_REBUILD_CHUNK_DAYS = 31  # days rebuilt per database call
+DAILY_STATS_PAGE_SIZE = 1000  # PostgREST's default max rows per request
+DAILY_STATS_JOB = "daily_stats_rebuild"
+
+
+async def read_daily_stats(db, query: Dict, start_day: date, end_day: Optional[date] = None) -> List[Dict]:
+    """Rollup rows matching `query` for local days from `start_day` to `end_day` (inclusive), oldest first"""
+    day_range = {"$gte": start_day.isoformat()}
+    if end_day:
+        day_range["$lte"] = end_day.isoformat()
+
+    # A single request is capped at the server's max rows, which would drop the most recent days
+    rows: List[Dict] = []
+    while True:
+        page = await db.daily_user_stats.find(
+            {**query, "day": day_range},
+            sort=[("day", 1), ("user_id", 1)],
+            limit=DAILY_STATS_PAGE_SIZE,
+            skip=len(rows)
+        )
+        rows.extend(page)
+        if len(page) < DAILY_STATS_PAGE_SIZE:
+            return rows
+
+
+class DailyStatsRepairEngine:
+    """
+    Rebuilds `daily_user_stats` from `time_entries`
+
+    The rollup is maintained incrementally by database triggers; this engine
+    periodically rebuilds the last `repair_days` days of every company to
+    correct any drift, and rebuilds arbitrary ranges on demand (backfills,
+    or after a company changes timezone). Ranges are rebuilt a month at a
+    time so no single statement runs long.
+
+    Runs claim the `daily_stats_rebuild` job in `job_runs`, so one rebuild
+    runs at a time across all workers and its progress is readable from
+    any of them; the periodic repair is skipped when another worker has
+    completed one within the interval.
+    """
+
+    def __init__(self, repair_days: int = DAILY_STATS_REPAIR_DAYS,
+                 chunk_days: int = DAILY_STATS_REBUILD_CHUNK_DAYS):
+        self.repair_days = repair_days
+        self.chunk_days = chunk_days
+        self._task: Optional[asyncio.Task] = None
+        self._manual_tasks: set = set()
+
+        self.days_rebuilt = registry.counter("daily_stats_days_rebuilt_total", "Rollup rows rebuilt from time entries")
+
+    async def start(self, db, interval: int = DAILY_STATS_REPAIR_INTERVAL):
+        """Repair recent days now and then every `interval` seconds"""
+        if self._task:
+            return
+        self._task = asyncio.create_task(self._run_loop(db, interval))
+        logger.info(f"Daily stats repair engine started with interval {interval}s")
+
+    async def stop(self):
+        if not self._task:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        logger.info("Daily stats repair engine stopped")
+
+    async def trigger(self, db, company_id: str, start_day: date, end_day: date) -> bool:
+        """Rebuild a company's range in the background; returns False when a rebuild is already running on any worker"""
+        lease = JobLease(db, DAILY_STATS_JOB)
+        if not await lease.acquire():
+            return False
+        task = asyncio.create_task(self.run(db, start_day, end_day, company_id, lease))
+        self._manual_tasks.add(task)
+        task.add_done_callback(self._manual_tasks.discard)
+        return True
+
+    async def _run_loop(self, db, interval: int):
+        try:
+            while True:
+                try:
+                    if await self._repair_due(db, interval):
+                        today = datetime.now(timezone.utc).date()
+                        # One extra day covers companies whose local date is ahead of UTC
+                        await self.run(db, today - timedelta(days=self.repair_days), today + timedelta(days=1))
+                except Exception as e:
+                    logger.error(f"Error repairing daily user stats: {e}")
+                await asyncio.sleep(interval)
+        except asyncio.CancelledError:
+            logger.info("Daily stats repair loop cancelled")
+
+    async def _repair_due(self, db, interval: int) -> bool:
+        """False when a periodic repair completed, on any worker, within the last half interval"""
+        progress = await read_progress(db, DAILY_STATS_JOB)
+        if not progress or progress.get("company_id") or progress.get("status") != "completed":
+            return True
+        finished_at = datetime.fromisoformat(progress["finished_at"])
+        return datetime.now(timezone.utc) - finished_at >= timedelta(seconds=interval / 2)
+
+    async def run(self, db, start_day: date, end_day: date, company_id: Optional[str] = None,
+                  lease: Optional[JobLease] = None) -> Optional[Dict]:
+        """
+        Rebuild days `start_day`..`end_day` for every company, or only `company_id`
+
+        Returns None without rebuilding when another rebuild holds the job;
+        a `lease` already acquired by the caller is used and released.
+        """
+        if lease is None:
+            lease = JobLease(db, DAILY_STATS_JOB)
+            if not await lease.acquire():
+                logger.debug("Daily stats rebuild already running on another worker")
+                return None
+        try:
+            return await self._run_claimed(db, start_day, end_day, company_id, lease)
+        finally:
+            await lease.release()
+
+    async def _run_claimed(self, db, start_day: date, end_day: date, company_id: Optional[str],
+                           lease: JobLease) -> Dict:
+        if company_id:
+            companies = [{"company_id": company_id}]
+        else:
+            companies = await db.companies.find({}, sort=[("company_id", 1)])
+
+        progress = {
+            "company_id": company_id,
+            "start_date": start_day.isoformat(),
+            "end_date": end_day.isoformat(),
+            "status": "running",
+            "companies_total": len(companies),
+            "companies_done": 0,
+            "days_rebuilt": 0,
+            "started_at": datetime.now(timezone.utc).isoformat()
+        }
+        await lease.save_progress(progress)
+        try:
+            for company in companies:
+                if not lease.held:
+                    raise RuntimeError("Lost the daily stats rebuild claim")
+                progress["days_rebuilt"] += await self.rebuild(db, company["company_id"], start_day, end_day)
+                progress["companies_done"] += 1
+                await lease.save_progress(progress)
+            progress["status"] = "completed"
+        except Exception:
+            progress["status"] = "failed"
+            raise
+        finally:
+            progress["finished_at"] = datetime.now(timezone.utc).isoformat()
+            await lease.save_progress(progress)
+
+        logger.info(
+            f"Rebuilt {progress['days_rebuilt']} daily user stats rows for "
+            f"{progress['companies_done']} companies ({start_day} to {end_day})"
+        )
+        return progress
+
+    async def rebuild(self, db, company_id: str, start_day: date, end_day: date) -> int:
+        """Rebuild one company's rollup rows, a chunk of days per call; returns the rows written"""
+        rebuilt = 0
+        chunk_start = start_day
+        while chunk_start <= end_day:
+            chunk_end = min(chunk_start + timedelta(days=self.chunk_days - 1), end_day)
+            rows = await db.rpc("rebuild_daily_user_stats", {
+                "p_company_id": company_id,
+                "p_start": chunk_start.isoformat(),
+                "p_end": chunk_end.isoformat()
+            })
+            count = int(rows[0]["days"]) if rows else 0
+            rebuilt += count
+            self.days_rebuilt.inc(count)
+            chunk_start = chunk_end + timedelta(days=1)
+        return rebuilt
+
+
+# Global engine instance
+daily_stats_repair_engine = DailyStatsRepairEngine()
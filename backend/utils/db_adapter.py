@@ -2,11 +2,20 @@
 Database Adapter - MongoDB-like interface for Supabase
 Provides MongoDB-style operations using Supabase PostgreSQL
 """
-from typing import Dict, List, Optional, Any
+from typing import Awaitable, Callable, Dict, List, Optional, Any
 from supabase import Client
-from datetime import datetime, timezone
+from datetime import date, datetime, timezone
 import json
 
+# Called with (table, rows) after every successful insert, upsert, update or delete
+WriteListener = Callable[[str, List[Dict]], Awaitable[None]]
+_write_listeners: List[WriteListener] = []
+
+
+def add_write_listener(listener: WriteListener):
+    """Be told about the rows every collection writes"""
+    _write_listeners.append(listener)
+
 
 class SupabaseCollection:
     """MongoDB-like collection interface for Supabase tables"""
@@ -21,20 +30,7 @@ class SupabaseCollection:
             select_query = self.client.table(self.table_name).select("*")
 
             # Apply filters
-            for key, value in query.items():
-                if isinstance(value, dict):
-                    # Handle special operators like $in, $gte, etc.
-                    for op, op_value in value.items():
-                        if op == "$in":
-                            select_query = select_query.in_(key, op_value)
-                        elif op == "$gte":
-                            select_query = select_query.gte(key, op_value)
-                        elif op == "$lte":
-                            select_query = select_query.lte(key, op_value)
-                        elif op == "$ne":
-                            select_query = select_query.neq(key, op_value)
-                else:
-                    select_query = select_query.eq(key, value)
+            select_query = self._apply_filters(select_query, query)
 
             result = select_query.limit(1).execute()
 
@@ -46,30 +42,14 @@ class SupabaseCollection:
             return None
 
     async def find(self, query: Optional[Dict] = None, projection: Optional[Dict] = None,
-                   sort: Optional[List] = None, limit: Optional[int] = None) -> List[Dict]:
-        """Find multiple documents matching query"""
+                   sort: Optional[List] = None, limit: Optional[int] = None, skip: int = 0) -> List[Dict]:
+        """Find multiple documents matching query; `skip` and `limit` select a page of a sorted result"""
         try:
             select_query = self.client.table(self.table_name).select("*")
 
             # Apply filters
             if query:
-                for key, value in query.items():
-                    if isinstance(value, dict):
-                        for op, op_value in value.items():
-                            if op == "$in":
-                                select_query = select_query.in_(key, op_value)
-                            elif op == "$gte":
-                                select_query = select_query.gte(key, op_value)
-                            elif op == "$lte":
-                                select_query = select_query.lte(key, op_value)
-                            elif op == "$ne":
-                                select_query = select_query.neq(key, op_value)
-                            elif op == "$gt":
-                                select_query = select_query.gt(key, op_value)
-                            elif op == "$lt":
-                                select_query = select_query.lt(key, op_value)
-                    else:
-                        select_query = select_query.eq(key, value)
+                select_query = self._apply_filters(select_query, query)
 
             # Apply sorting
             if sort:
@@ -80,7 +60,9 @@ class SupabaseCollection:
                         select_query = select_query.order(field, desc=False)
 
             # Apply limit
-            if limit:
+            if limit and skip:
+                select_query = select_query.range(skip, skip + limit - 1)
+            elif limit:
                 select_query = select_query.limit(limit)
 
             result = select_query.execute()
@@ -95,6 +77,7 @@ class SupabaseCollection:
             # Convert datetime objects to ISO format strings
             doc = self._serialize_dates(document)
             result = self.client.table(self.table_name).insert(doc).execute()
+            await self._notify_write(result.data)
             return {"acknowledged": True, "inserted_id": result.data[0] if result.data else None}
         except Exception as e:
             print(f"Error in insert_one: {e}")
@@ -105,11 +88,34 @@ class SupabaseCollection:
         try:
             docs = [self._serialize_dates(doc) for doc in documents]
             result = self.client.table(self.table_name).insert(docs).execute()
+            await self._notify_write(result.data)
             return {"acknowledged": True, "inserted_ids": result.data}
         except Exception as e:
             print(f"Error in insert_many: {e}")
             raise
 
+    async def upsert_many(self, documents: List[Dict], on_conflict: str,
+                          ignore_duplicates: bool = False) -> Dict:
+        """Insert or update multiple documents in a single request
+
+        Rows that collide on the `on_conflict` column(s) are updated in place,
+        or skipped entirely when `ignore_duplicates` is set.
+        """
+        if not documents:
+            return {"acknowledged": True, "upserted": []}
+        try:
+            docs = [self._serialize_dates(doc) for doc in documents]
+            result = self.client.table(self.table_name).upsert(
+                docs,
+                on_conflict=on_conflict,
+                ignore_duplicates=ignore_duplicates
+            ).execute()
+            await self._notify_write(result.data)
+            return {"acknowledged": True, "upserted": result.data or []}
+        except Exception as e:
+            print(f"Error in upsert_many: {e}")
+            raise
+
     async def update_one(self, query: Dict, update: Dict) -> Dict:
         """Update a single document"""
         try:
@@ -127,10 +133,10 @@ class SupabaseCollection:
             update_query = self.client.table(self.table_name).update(update_data)
 
             # Apply filters
-            for key, value in query.items():
-                update_query = update_query.eq(key, value)
+            update_query = self._apply_filters(update_query, query)
 
             result = update_query.execute()
+            await self._notify_write(result.data)
             return {"acknowledged": True, "modified_count": len(result.data) if result.data else 0}
         except Exception as e:
             print(f"Error in update_one: {e}")
@@ -146,10 +152,10 @@ class SupabaseCollection:
             delete_query = self.client.table(self.table_name).delete()
 
             # Apply filters
-            for key, value in query.items():
-                delete_query = delete_query.eq(key, value)
+            delete_query = self._apply_filters(delete_query, query)
 
             result = delete_query.execute()
+            await self._notify_write(result.data)
             return {"acknowledged": True, "deleted_count": len(result.data) if result.data else 0}
         except Exception as e:
             print(f"Error in delete_one: {e}")
@@ -165,8 +171,7 @@ class SupabaseCollection:
             select_query = self.client.table(self.table_name).select("*", count="exact")
 
             if query:
-                for key, value in query.items():
-                    select_query = select_query.eq(key, value)
+                select_query = self._apply_filters(select_query, query)
 
             result = select_query.execute()
             return result.count if hasattr(result, 'count') else 0
@@ -184,11 +189,45 @@ class SupabaseCollection:
         """Create index (no-op for Supabase, indexes created in migrations)"""
         pass
 
+    async def _notify_write(self, rows: Optional[List[Dict]]):
+        """Pass written rows to the write listeners; a failing listener never fails the write"""
+        if not rows:
+            return
+        for listener in _write_listeners:
+            try:
+                await listener(self.table_name, rows)
+            except Exception as e:
+                print(f"Error in write listener for {self.table_name}: {e}")
+
+    def _apply_filters(self, builder, query: Dict):
+        """Translate a MongoDB-style filter into PostgREST filters"""
+        for key, value in query.items():
+            if isinstance(value, dict):
+                # Handle special operators like $in, $gte, etc.
+                for op, op_value in value.items():
+                    if op == "$in":
+                        builder = builder.in_(key, op_value)
+                    elif op == "$gte":
+                        builder = builder.gte(key, op_value)
+                    elif op == "$lte":
+                        builder = builder.lte(key, op_value)
+                    elif op == "$gt":
+                        builder = builder.gt(key, op_value)
+                    elif op == "$lt":
+                        builder = builder.lt(key, op_value)
+                    elif op == "$ne":
+                        builder = builder.neq(key, op_value)
+            elif value is None:
+                builder = builder.is_(key, "null")
+            else:
+                builder = builder.eq(key, value)
+        return builder
+
     def _serialize_dates(self, doc: Dict) -> Dict:
-        """Convert datetime objects to ISO format strings"""
+        """Convert datetime and date objects to ISO format strings"""
         result = {}
         for key, value in doc.items():
-            if isinstance(value, datetime):
+            if isinstance(value, (datetime, date)):
                 result[key] = value.isoformat()
             elif isinstance(value, dict):
                 result[key] = self._serialize_dates(value)
@@ -209,6 +248,15 @@ class SupabaseDatabase:
         self.client = client
         self._collections = {}
 
+    async def rpc(self, function_name: str, params: Optional[Dict] = None) -> List[Dict]:
+        """Call a PostgreSQL function and return its rows"""
+        try:
+            result = self.client.rpc(function_name, params or {}).execute()
+            return result.data if result.data else []
+        except Exception as e:
+            print(f"Error in rpc {function_name}: {e}")
+            raise
+
     def __getitem__(self, collection_name: str) -> SupabaseCollection:
         """Get collection by name"""
         if collection_name not in self._collections:
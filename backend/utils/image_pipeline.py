@@ -0,0 +1,433 @@
+"""
+Image Pipeline
+Post-upload screenshot processing: blurring, WebP re-encoding and thumbnails in a process pool
+"""
+import asyncio
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Optional, Sequence
+import logging
+
+from utils.job_runs import JobLease, read_progress
+from utils.metrics import registry
+from utils.perceptual_hash import (
+    phash_index, dhash, find_match, format_hash, DUPLICATE_THRESHOLD
+)
+
+logger = logging.getLogger(__name__)
+
+WEBP_QUALITY = int(os.environ.get('SCREENSHOT_WEBP_QUALITY', 80))
+THUMBNAIL_SIZE = (
+    int(os.environ.get('SCREENSHOT_THUMBNAIL_WIDTH', 320)),
+    int(os.environ.get('SCREENSHOT_THUMBNAIL_HEIGHT', 180))
+)
+# Defaults for companies whose tracking_policy does not set them
+BLUR_MODE = os.environ.get('SCREENSHOT_BLUR_MODE', 'blur')  # 'blur' or 'pixelate'
+BLUR_STRENGTH = int(os.environ.get('SCREENSHOT_BLUR_STRENGTH', 24))
+ORIGINAL_RETENTION_HOURS = int(os.environ.get('SCREENSHOT_ORIGINAL_RETENTION_HOURS', 0))
+ORIGINAL_PURGE_INTERVAL = int(os.environ.get('SCREENSHOT_ORIGINAL_PURGE_INTERVAL', 600))
+# Screenshots left unprocessed (queue full, worker restarted) are queued again by a periodic sweep
+RECOVERY_INTERVAL = int(os.environ.get('IMAGE_PIPELINE_RECOVERY_INTERVAL', 300))
+RECOVERY_GRACE_SECONDS = 600  # leave recent uploads to the worker that queued them
+RECOVERY_WINDOW_HOURS = 24  # screenshots still failing after this are left alone
+RECOVERY_JOB = "image_pipeline_recovery"
+POLICY_CACHE_SECONDS = 60
+
+
+def apply_blur(image, mode: str, strength: int):
+    """Blur (Gaussian radius `strength`) or pixelate (blocks of `strength` px) a PIL image"""
+    from PIL import Image, ImageFilter
+
+    width, height = image.size
+    if mode == "pixelate":
+        block = max(2, strength)
+        small = image.resize((max(1, width // block), max(1, height // block)), Image.Resampling.BILINEAR)
+        return small.resize((width, height), Image.Resampling.NEAREST)
+
+    # Blurring a quarter-size copy and scaling it back costs about 1/16 of a full-size blur
+    small = image.reduce(4).filter(ImageFilter.GaussianBlur(max(1, strength / 4)))
+    return small.resize((width, height), Image.Resampling.BILINEAR)
+
+
+def blur_settings(tracking_policy: Dict) -> Dict:
+    return {
+        "mode": tracking_policy.get("blur_mode", BLUR_MODE),
+        "strength": int(tracking_policy.get("blur_strength", BLUR_STRENGTH))
+    }
+
+
+def transcode_screenshot(data: bytes, quality: int, thumbnail_size: tuple,
+                         recent_hashes: Sequence[int] = (), threshold: int = DUPLICATE_THRESHOLD,
+                         blur: Optional[Dict] = None) -> Dict:
+    """
+    Re-encode an image to WebP and render a fixed-size WebP thumbnail,
+    blurring or pixelating it first when `blur` settings are given
+
+    The image's dHash is computed first; when it is within `threshold` bits of
+    one of `recent_hashes` the index of that hash is returned as `match` and
+    nothing is encoded. Runs in a worker process, so it only takes and returns
+    picklable values.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        width, height = image.size
+        image_hash = dhash(image)
+        match = find_match(image_hash, list(recent_hashes), threshold)
+        if match is not None:
+            return {"width": width, "height": height, "dhash": image_hash, "match": match}
+
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        if blur:
+            image = apply_blur(image, blur["mode"], blur["strength"])
+
+        encoded = io.BytesIO()
+        image.save(encoded, format="WEBP", quality=quality, method=4)
+
+        thumbnail = ImageOps.fit(image, thumbnail_size, method=Image.Resampling.LANCZOS)
+        thumbnail_encoded = io.BytesIO()
+        thumbnail.save(thumbnail_encoded, format="WEBP", quality=quality, method=4)
+
+    return {
+        "width": width,
+        "height": height,
+        "dhash": image_hash,
+        "match": None,
+        "image": encoded.getvalue(),
+        "thumbnail": thumbnail_encoded.getvalue()
+    }
+
+
+def duplicate_blob_fields(earlier: Dict) -> Dict:
+    """Fields that make a screenshot row reuse an earlier screenshot's stored blob"""
+    return {
+        "duplicate_of": earlier["screenshot_id"],
+        "s3_key": earlier["s3_key"],
+        "s3_url": earlier["s3_url"],
+        "thumbnail_key": earlier["thumbnail_key"],
+        "blurred": earlier["blurred"],
+        "storage_type": earlier["storage_type"],
+        "content_type": earlier["content_type"],
+        "file_size": earlier["file_size"],
+        "width": earlier["width"],
+        "height": earlier["height"]
+    }
+
+
+class ImagePipeline:
+    """Queue of uploaded screenshots processed by a pool of worker processes"""
+
+    def __init__(self, workers: Optional[int] = None, queue_size: int = 10000):
+        # Every API worker runs its own pool: share the CPUs between the WEB_CONCURRENCY workers
+        web_workers = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+        default_workers = max(1, (os.cpu_count() or 2) // web_workers)
+        self.workers = workers or int(os.environ.get('IMAGE_PIPELINE_WORKERS', default_workers))
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.consumers = []
+        self.purge_task: Optional[asyncio.Task] = None
+        self.recovery_task: Optional[asyncio.Task] = None
+        self._queued: set = set()
+        self.db = None
+        self._policies: Dict[str, tuple] = {}  # company_id -> (tracking_policy, fetched_at)
+
+        self.queue_depth = registry.gauge("image_pipeline_queue_depth", "Screenshots waiting for processing")
+        self.processed = registry.counter(
+            "image_pipeline_processed_total", "Screenshots processed by the image pipeline", ["result"]
+        )
+        self.duration = registry.histogram(
+            "image_pipeline_duration_seconds", "Time to process one screenshot"
+        )
+        self.bytes_saved = registry.counter(
+            "image_pipeline_bytes_saved_total", "Bytes saved by re-encoding screenshots"
+        )
+        self.blurred = registry.counter(
+            "image_pipeline_blurred_total", "Screenshots blurred or pixelated", ["mode"]
+        )
+        self.originals_purged = registry.counter(
+            "image_pipeline_originals_purged_total", "Unblurred originals deleted after their retention period"
+        )
+        self.queue_depth.set_function(self.queue.qsize)
+
+    async def start(self, db):
+        """Start the worker processes and queue consumers"""
+        if self.pool:
+            return
+        self.db = db
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        # A consumer per worker keeps every process busy while others wait on S3
+        self.consumers = [asyncio.create_task(self._consume()) for _ in range(self.workers * 2)]
+        self.purge_task = asyncio.create_task(self._purge_loop())
+        self.recovery_task = asyncio.create_task(self._recovery_loop())
+        logger.info(f"Image pipeline started with {self.workers} worker processes")
+
+    async def stop(self):
+        """Stop consuming; queued screenshots stay unprocessed until a recovery sweep queues them again"""
+        tasks = self.consumers + [task for task in (self.purge_task, self.recovery_task) if task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.consumers = []
+        self.purge_task = None
+        self.recovery_task = None
+        if self.pool:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
+        logger.info("Image pipeline stopped")
+
+    def enqueue(self, screenshot_id: str) -> bool:
+        """Queue a stored screenshot for processing; returns False when the queue is full"""
+        if screenshot_id in self._queued:
+            return True
+        try:
+            self.queue.put_nowait(screenshot_id)
+            self._queued.add(screenshot_id)
+            return True
+        except asyncio.QueueFull:
+            logger.warning(f"Image pipeline queue full, skipping screenshot {screenshot_id}")
+            self.processed.inc(result="dropped")
+            return False
+
+    async def _consume(self):
+        while True:
+            screenshot_id = await self.queue.get()
+            started = time.monotonic()
+            try:
+                outcome = await self.process_screenshot(screenshot_id)
+                self.processed.inc(result=outcome)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.processed.inc(result="error")
+                logger.error(f"Image pipeline failed for screenshot {screenshot_id}: {e}")
+            finally:
+                self._queued.discard(screenshot_id)
+                self.duration.observe(time.monotonic() - started)
+                self.queue.task_done()
+
+    async def tracking_policy(self, company_id: Optional[str]) -> Dict:
+        """Company tracking policy, cached briefly since every screenshot needs it"""
+        if not company_id:
+            return {}
+        cached = self._policies.get(company_id)
+        if cached and time.monotonic() - cached[1] < POLICY_CACHE_SECONDS:
+            return cached[0]
+        company = await self.db.companies.find_one({"company_id": company_id})
+        policy = (company or {}).get("tracking_policy") or {}
+        self._policies[company_id] = (policy, time.monotonic())
+        return policy
+
+    async def process_screenshot(self, screenshot_id: str) -> str:
+        """
+        Blur (when required), re-encode one stored screenshot, store its
+        thumbnail and record the result
+
+        A screenshot that looks the same as one of the user's recent ones is
+        pointed at the earlier blob and its own upload is deleted. When a
+        blurred screenshot's policy allows keeping the unblurred original for
+        a while, it stays under `original_key` until `original_expires_at`.
+        Returns "ok", "duplicate" or "skipped".
+        """
+        from utils.storage_backends import get_storage
+
+        screenshot = await self.db.screenshots.find_one({"screenshot_id": screenshot_id})
+        if not screenshot or screenshot.get("storage_type") not in ("s3", "local"):
+            return "skipped"
+        if screenshot.get("thumbnail_key"):
+            return "skipped"
+        storage = get_storage(screenshot["storage_type"])
+        if not storage:
+            return "skipped"
+
+        original_key = screenshot["s3_key"]
+        original = await storage.read_bytes(original_key)
+
+        policy = await self.tracking_policy(screenshot.get("company_id"))
+        blur = None
+        if screenshot.get("blurred") or policy.get("blur_screenshots"):
+            blur = blur_settings(policy)
+
+        user_id = screenshot.get("user_id")
+        recent = await phash_index.recent(self.db, user_id) if user_id else []
+        # Only reuse blobs that were blurred the same way this one must be
+        recent = [entry for entry in recent if bool(entry["blurred"]) == bool(blur)]
+
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(
+            self.pool, transcode_screenshot, original, WEBP_QUALITY, THUMBNAIL_SIZE,
+            [entry["hash"] for entry in recent], DUPLICATE_THRESHOLD, blur
+        )
+
+        if result["match"] is not None:
+            await self._store_as_duplicate(screenshot, recent[result["match"]], result, len(original))
+            await self._delete_unshared(storage, original_key, screenshot_id)
+            self.bytes_saved.inc(len(original))
+            return "duplicate"
+
+        base_key = original_key.rsplit(".", 1)[0]
+        thumbnail_key = await storage.save_bytes(result["thumbnail"], f"{base_key}_thumb.webp", "image/webp")
+
+        update = {
+            "width": result["width"],
+            "height": result["height"],
+            "perceptual_hash": format_hash(result["dhash"]),
+            "thumbnail_key": thumbnail_key,
+            "blurred": bool(blur),
+            "original_size": len(original),
+            "processed_at": datetime.now(timezone.utc).isoformat()
+        }
+
+        # Keep the original when WebP does not actually make it smaller, unless it had to be blurred.
+        # The re-encoded image gets its own key: a WebP upload's original is already at `{base_key}.webp`
+        if blur or len(result["image"]) < len(original):
+            image_key = await storage.save_bytes(result["image"], f"{base_key}_processed.webp", "image/webp")
+            update.update({
+                "s3_key": image_key,
+                "s3_url": storage.reference(image_key),
+                "content_type": "image/webp",
+                "file_size": len(result["image"]),
+                "bytes_saved": max(len(original) - len(result["image"]), 0)
+            })
+        else:
+            update.update({"file_size": len(original), "bytes_saved": 0})
+
+        retention_hours = int(policy.get("original_retention_hours", ORIGINAL_RETENTION_HOURS))
+        keep_original = bool(blur) and retention_hours > 0
+        if keep_original:
+            update["original_key"] = original_key
+            update["original_expires_at"] = (
+                datetime.now(timezone.utc) + timedelta(hours=retention_hours)
+            ).isoformat()
+
+        await self.db.screenshots.update_one({"screenshot_id": screenshot_id}, {"$set": update})
+
+        if "s3_key" in update and not keep_original:
+            await self._delete_unshared(storage, original_key, screenshot_id)
+        if blur:
+            self.blurred.inc(mode=blur["mode"])
+        self.bytes_saved.inc(update["bytes_saved"])
+        return "ok"
+
+    async def _delete_unshared(self, storage, key: str, screenshot_id: str):
+        """Delete a blob unless another screenshot row still points at it"""
+        shared = await self.db.screenshots.count_documents({
+            "s3_key": key, "screenshot_id": {"$ne": screenshot_id}
+        })
+        if not shared:
+            await storage.delete(key)
+
+    async def _store_as_duplicate(self, screenshot: Dict, earlier: Dict, result: Dict, original_size: int):
+        await self.db.screenshots.update_one(
+            {"screenshot_id": screenshot["screenshot_id"]},
+            {"$set": {
+                **duplicate_blob_fields(earlier),
+                "perceptual_hash": format_hash(result["dhash"]),
+                "original_size": original_size,
+                "bytes_saved": original_size,
+                "processed_at": datetime.now(timezone.utc).isoformat()
+            }}
+        )
+
+    async def _recovery_loop(self):
+        try:
+            while True:
+                try:
+                    await self.recover_unprocessed()
+                except Exception as e:
+                    logger.error(f"Error recovering unprocessed screenshots: {e}")
+                await asyncio.sleep(RECOVERY_INTERVAL)
+        except asyncio.CancelledError:
+            pass
+
+    async def recover_unprocessed(self, batch_size: int = 500) -> int:
+        """
+        Queue stored screenshots of the last RECOVERY_WINDOW_HOURS that were
+        never processed; one worker sweeps per interval, claimed in `job_runs`
+
+        Runs at start, so screenshots queued in a worker that stopped or
+        dropped by a full queue are processed after all.
+        """
+        lease = JobLease(self.db, RECOVERY_JOB)
+        if not await lease.acquire():
+            return 0
+        try:
+            now = datetime.now(timezone.utc)
+            last = await read_progress(self.db, RECOVERY_JOB)
+            if last and last.get("finished_at") and \
+                    now - datetime.fromisoformat(last["finished_at"]) < timedelta(seconds=RECOVERY_INTERVAL / 2):
+                return 0  # another worker swept moments ago
+
+            rows = await self.db.screenshots.find(
+                {
+                    "processed_at": None,
+                    "storage_type": {"$in": ["s3", "local"]},
+                    "created_at": {
+                        "$gte": (now - timedelta(hours=RECOVERY_WINDOW_HOURS)).isoformat(),
+                        "$lt": (now - timedelta(seconds=RECOVERY_GRACE_SECONDS)).isoformat()
+                    }
+                },
+                sort=[("created_at", 1)],
+                limit=batch_size
+            )
+            queued = sum(1 for row in rows if self.enqueue(row["screenshot_id"]))
+            await lease.save_progress({"queued": queued, "finished_at": now.isoformat()})
+        finally:
+            await lease.release()
+
+        if queued:
+            logger.info(f"Queued {queued} unprocessed screenshots for processing")
+        return queued
+
+    async def _purge_loop(self):
+        try:
+            while True:
+                try:
+                    await self.purge_expired_originals()
+                except Exception as e:
+                    logger.error(f"Error purging screenshot originals: {e}")
+                await asyncio.sleep(ORIGINAL_PURGE_INTERVAL)
+        except asyncio.CancelledError:
+            pass
+
+    async def purge_expired_originals(self, batch_size: int = 500) -> int:
+        """Delete unblurred originals whose retention period has ended"""
+        from utils.storage_backends import get_storage
+
+        purged = 0
+        while True:
+            now = datetime.now(timezone.utc).isoformat()
+            rows = await self.db.screenshots.find(
+                {"original_expires_at": {"$lte": now}}, limit=batch_size
+            )
+            if not rows:
+                break
+
+            keys_by_type: Dict[str, list] = {}
+            for row in rows:
+                keys_by_type.setdefault(row.get("storage_type"), []).append(row["original_key"])
+            for storage_type, keys in keys_by_type.items():
+                storage = get_storage(storage_type) if storage_type in ("s3", "local") else None
+                if storage:
+                    await storage.delete_many(keys)
+
+            await self.db.screenshots.update_many(
+                {"screenshot_id": {"$in": [row["screenshot_id"] for row in rows]}},
+                {"$set": {"original_key": None, "original_expires_at": None}}
+            )
+            purged += len(rows)
+            if len(rows) < batch_size:
+                break
+
+        if purged:
+            self.originals_purged.inc(purged)
+            logger.info(f"Purged {purged} screenshot originals past retention")
+        return purged
+
+
+# Global pipeline instance
+image_pipeline = ImagePipeline()
@@ -0,0 +1,236 @@
+"""
+Ingest Buffer
+Write-behind buffering of high-volume telemetry rows, flushed to the database in bulk
+"""
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+import logging
+
+from utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+INGEST_FLUSH_INTERVAL_MS = int(os.environ.get('INGEST_FLUSH_INTERVAL_MS', 250))
+INGEST_FLUSH_MAX_RECORDS = int(os.environ.get('INGEST_FLUSH_MAX_RECORDS', 500))
+INGEST_BUFFER_CAPACITY = int(os.environ.get('INGEST_BUFFER_CAPACITY', 20000))
+# Failed single-row writes after which a row is dropped
+INGEST_MAX_ATTEMPTS = int(os.environ.get('INGEST_MAX_ATTEMPTS', 5))
+# Longest wait before retrying a table whose writes keep failing
+INGEST_MAX_BACKOFF_SECONDS = 30
+
+# Buffered tables; rows of tables with `on_conflict` are upserted ignoring duplicates
+INGEST_TABLES = {
+    "activity_logs": {"on_conflict": "user_id,client_id"},
+    "app_usage": {},
+    "website_usage": {},
+    "gps_locations": {},
+    "idle_periods": {},
+    "usb_events": {}
+}
+
+
+class IngestBufferFull(Exception):
+    """The table's buffer is at capacity; the client should retry after `retry_after` seconds"""
+
+    def __init__(self, table: str, retry_after: int):
+        super().__init__(f"Ingest buffer for {table} is full")
+        self.table = table
+        self.retry_after = retry_after
+
+
+class IngestBuffer:
+    """
+    Per-table in-memory queues of rows that are acknowledged on receipt and
+    written in bulk every `flush_interval_ms`, or as soon as a table has
+    `flush_max_records` rows waiting
+
+    A failed write is retried at once with half as many rows, down to a
+    single row, so the rows around a bad one are still stored; batches grow
+    back after each successful write. Rows left unwritten are put back at
+    the front of their queue and the table is retried after a backoff that
+    doubles with every failing flush. A row whose own write has failed
+    `max_attempts` times is logged and dropped.
+
+    Rows still buffered when the process stops are flushed by `stop()`; a
+    crash loses every row still buffered, up to `capacity` rows per table.
+    """
+
+    def __init__(self, flush_interval_ms: int = INGEST_FLUSH_INTERVAL_MS,
+                 flush_max_records: int = INGEST_FLUSH_MAX_RECORDS,
+                 capacity: int = INGEST_BUFFER_CAPACITY,
+                 max_attempts: int = INGEST_MAX_ATTEMPTS):
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_max_records = flush_max_records
+        self.capacity = capacity
+        self.max_attempts = max_attempts
+        self.db = None
+        self._queues: Dict[str, deque] = {table: deque() for table in INGEST_TABLES}
+        self._listeners: Dict[str, List[Callable[[List[Dict]], Awaitable[None]]]] = {
+            table: [] for table in INGEST_TABLES
+        }
+        self._batch_sizes: Dict[str, int] = {table: flush_max_records for table in INGEST_TABLES}
+        self._backoff: Dict[str, float] = {table: 0.0 for table in INGEST_TABLES}
+        self._retry_at: Dict[str, float] = {table: 0.0 for table in INGEST_TABLES}
+        # Failed single-row writes of buffered rows, by id() of the row
+        self._attempts: Dict[int, int] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+        self.depth = registry.gauge("ingest_buffer_depth", "Rows waiting in the ingest buffer", ["table"])
+        self.flushed = registry.counter("ingest_rows_flushed_total", "Rows written by the ingest buffer", ["table"])
+        self.rejected = registry.counter(
+            "ingest_rows_rejected_total", "Rows refused because the ingest buffer was full", ["table"]
+        )
+        self.flush_errors = registry.counter("ingest_flush_errors_total", "Failed ingest buffer flushes", ["table"])
+        self.dropped = registry.counter(
+            "ingest_rows_dropped_total", "Rows dropped after failing to be written", ["table"]
+        )
+        self.flush_duration = registry.histogram(
+            "ingest_flush_duration_seconds", "Time to write one bulk flush", ["table"]
+        )
+        for table, queue in self._queues.items():
+            self.depth.set_function(queue.__len__, table=table)
+
+    async def start(self, db):
+        if self._task:
+            return
+        self.db = db
+        self._task = asyncio.create_task(self._flush_loop())
+        logger.info(
+            f"Ingest buffer started (flush every {int(self.flush_interval * 1000)}ms "
+            f"or {self.flush_max_records} rows, capacity {self.capacity} rows per table)"
+        )
+
+    async def stop(self):
+        """Stop the flush loop and write everything still buffered"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.db is not None:
+            await self.flush(retry_now=True)
+        logger.info("Ingest buffer stopped")
+
+    def submit(self, table: str, record: Dict):
+        self.submit_many(table, [record])
+
+    def submit_many(self, table: str, records: Iterable[Dict]):
+        """
+        Buffer rows for `table`; all or none are accepted
+
+        Raises IngestBufferFull when they do not fit.
+        """
+        records = list(records)
+        queue = self._queues[table]
+        if len(queue) + len(records) > self.capacity:
+            self.rejected.inc(len(records), table=table)
+            raise IngestBufferFull(table, self.retry_after())
+        queue.extend(records)
+        if len(queue) >= self.flush_max_records:
+            self._wakeup.set()
+
+    def subscribe(self, table: str, listener: Callable[[List[Dict]], Awaitable[None]]):
+        """
+        Call `await listener(rows)` with the rows of `table` each bulk write
+        stored; duplicates skipped by the table's `on_conflict` are left out
+        """
+        self._listeners[table].append(listener)
+
+    def retry_after(self) -> int:
+        """Seconds a rejected client should wait: a few flush intervals, at least one second"""
+        return max(1, math.ceil(self.flush_interval * 4))
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing ingest buffer: {e}")
+
+    async def flush(self, retry_now: bool = False):
+        """
+        Write every buffered row in bulk requests of at most `flush_max_records`
+        rows; tables still backing off after a failure are skipped unless `retry_now`
+        """
+        async with self._flush_lock:
+            for table, queue in self._queues.items():
+                if not retry_now and time.monotonic() < self._retry_at[table]:
+                    continue
+                while queue:
+                    batch = [queue.popleft() for _ in range(min(len(queue), self._batch_sizes[table]))]
+                    written = await self._write(table, batch)
+                    if written is None:
+                        if self._write_failed(table, batch):
+                            continue
+                        # Put the rows back in order and leave the rest for the next flush
+                        queue.extendleft(reversed(batch))
+                        self._backoff[table] = min(
+                            max(self.flush_interval, self._backoff[table] * 2), INGEST_MAX_BACKOFF_SECONDS
+                        )
+                        self._retry_at[table] = time.monotonic() + self._backoff[table]
+                        break
+                    for row in batch:
+                        self._attempts.pop(id(row), None)
+                    self._batch_sizes[table] = min(self._batch_sizes[table] * 2, self.flush_max_records)
+                    self._backoff[table] = 0.0
+                    for listener in self._listeners[table]:
+                        try:
+                            await listener(written)
+                        except Exception as e:
+                            logger.error(f"Ingest listener for {table} failed: {e}")
+
+    def _write_failed(self, table: str, batch: List[Dict]) -> bool:
+        """
+        Handle a failed write of `batch`; True when the flush should go on
+        with smaller batches, False when the rows should wait for a retry
+        """
+        if len(batch) > 1:
+            self._batch_sizes[table] = max(1, len(batch) // 2)
+            self._queues[table].extendleft(reversed(batch))
+            return True
+        row = batch[0]
+        attempts = self._attempts.get(id(row), 0) + 1
+        if attempts < self.max_attempts:
+            self._attempts[id(row)] = attempts
+            return False
+        self._attempts.pop(id(row), None)
+        self.dropped.inc(table=table)
+        logger.error(f"Dropped a {table} row after {attempts} failed writes: {row}")
+        return True
+
+    async def _write(self, table: str, rows: List[Dict]) -> Optional[List[Dict]]:
+        """Write `rows` in one request; returns the rows stored, or None when the write failed"""
+        started = time.monotonic()
+        try:
+            on_conflict = INGEST_TABLES[table].get("on_conflict")
+            if on_conflict:
+                result = await self.db[table].upsert_many(rows, on_conflict=on_conflict, ignore_duplicates=True)
+                written = result["upserted"]
+            else:
+                await self.db[table].insert_many(rows)
+                written = rows
+            self.flushed.inc(len(rows), table=table)
+            return written
+        except Exception as e:
+            self.flush_errors.inc(table=table)
+            logger.error(f"Failed to flush {len(rows)} {table} rows: {e}")
+            return None
+        finally:
+            self.flush_duration.observe(time.monotonic() - started, table=table)
+
+
+# Global buffer instance
+ingest_buffer = IngestBuffer()
@@ -0,0 +1,100 @@
+"""
+Job Runs
+Cluster-wide claims and progress for background jobs, kept in the `job_runs` table
+"""
+import asyncio
+import os
+import secrets
+import socket
+from datetime import datetime, timezone
+from typing import Dict, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+# A claim not renewed for this long is free to take over (its worker died)
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 120))
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class JobLease:
+    """
+    Exclusive claim on a (job, scope) across every worker and replica
+
+    `acquire` claims the scope's `job_runs` row unless another claim on it
+    is still live; while held, the claim is renewed in the background, so
+    a worker that dies mid-run loses it after `ttl` seconds. Every lease
+    has its own owner id, so two runs in one worker exclude each other
+    too, and a run should stop once `held` turns False. Progress saved
+    through the lease is readable from any worker with `read_progress`.
+    """
+
+    def __init__(self, db, job: str, scope: str = "*", ttl: int = JOB_LEASE_SECONDS):
+        self.db = db
+        self.job = job
+        self.scope = scope
+        self.ttl = ttl
+        self.owner = f"{WORKER_ID}:{secrets.token_hex(4)}"
+        self._renewer: Optional[asyncio.Task] = None
+        self.held = False
+
+    async def acquire(self) -> bool:
+        """Claim the job; False when another run holds it"""
+        if not await self._claim():
+            return False
+        self.held = True
+        self._renewer = asyncio.create_task(self._renew_loop())
+        return True
+
+    async def save_progress(self, progress: Dict):
+        await self.db.job_runs.update_one(
+            {"job": self.job, "scope": self.scope, "owner": self.owner},
+            {"$set": {"progress": progress, "updated_at": datetime.now(timezone.utc)}}
+        )
+
+    async def release(self):
+        """Give up the claim, keeping the last saved progress"""
+        self.held = False
+        if self._renewer:
+            self._renewer.cancel()
+            self._renewer = None
+        await self.db.job_runs.update_one(
+            {"job": self.job, "scope": self.scope, "owner": self.owner},
+            {"$set": {"owner": None, "lease_expires_at": None}}
+        )
+
+    async def _claim(self) -> bool:
+        rows = await self.db.rpc("claim_job_run", {
+            "p_job": self.job,
+            "p_scope": self.scope,
+            "p_owner": self.owner,
+            "p_lease_seconds": self.ttl
+        })
+        return bool(rows and rows[0].get("claimed"))
+
+    async def _renew_loop(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                if not await self._claim():
+                    self.held = False
+                    logger.warning(f"Lost the claim on job {self.job} ({self.scope})")
+                    return
+            except Exception as e:
+                logger.error(f"Error renewing the claim on job {self.job}: {e}")
+
+
+async def read_progress(db, job: str, scope: str = "*") -> Optional[Dict]:
+    """Last saved progress of a job; a run whose claim lapsed while running reads as interrupted"""
+    row = await db.job_runs.find_one({"job": job, "scope": scope})
+    if not row or not row.get("progress"):
+        return None
+    progress = dict(row["progress"])
+    if progress.get("status") == "running" and not row.get("owner"):
+        progress["status"] = "interrupted"
+    elif progress.get("status") == "running":
+        expires_at = datetime.fromisoformat(str(row["lease_expires_at"]).replace("Z", "+00:00"))
+        if expires_at < datetime.now(timezone.utc):
+            progress["status"] = "interrupted"
+    return progress
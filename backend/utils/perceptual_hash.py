@@ -0,0 +1,114 @@
+"""
+Perceptual Hash Index
+dHash of screenshots and lookup of a user's recent hashes for duplicate detection
+"""
+import os
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_THRESHOLD = int(os.environ.get('PHASH_DUPLICATE_THRESHOLD', 4))
+RECENT_PER_USER = int(os.environ.get('PHASH_RECENT_PER_USER', 5))
+# Only screenshots taken this recently are reused, well clear of any retention purge
+MATCH_WINDOW_SECONDS = int(os.environ.get('PHASH_MATCH_WINDOW_SECONDS', 6 * 3600))
+
+
+def dhash(image, hash_size: int = 8) -> int:
+    """64-bit difference hash of a PIL image: brighter-than-right-neighbour bits of a 9x8 grayscale"""
+    from PIL import Image
+
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def format_hash(value: int) -> str:
+    return f"{value:016x}"
+
+
+def parse_hash(value: Optional[str]) -> Optional[int]:
+    if not value:
+        return None
+    try:
+        return int(value, 16)
+    except ValueError:
+        return None
+
+
+def find_match(value: int, candidates: List[int], threshold: int = DUPLICATE_THRESHOLD) -> Optional[int]:
+    """Index of the first candidate within `threshold` bits of `value`, or None"""
+    for index, candidate in enumerate(candidates):
+        if hamming_distance(value, candidate) <= threshold:
+            return index
+    return None
+
+
+class PerceptualHashIndex:
+    """
+    Most recent distinct screenshot blobs per user, newest first
+
+    Read from the database on every lookup, so every worker sees the same
+    blobs and a deleted or purged screenshot is never matched again. Only
+    processed originals count: their hash was computed by the server from
+    the stored image.
+    """
+
+    def __init__(self, per_user: int = RECENT_PER_USER, window_seconds: int = MATCH_WINDOW_SECONDS):
+        self.per_user = per_user
+        self.window_seconds = window_seconds
+
+    async def recent(self, db, user_id: str, window_seconds: Optional[int] = None) -> List[Dict]:
+        """The user's recent entries taken within the last `window_seconds` (default: the index's window)"""
+        since = datetime.now(timezone.utc) - timedelta(seconds=window_seconds or self.window_seconds)
+        rows = await db.screenshots.find(
+            {"user_id": user_id, "duplicate_of": None, "taken_at": {"$gte": since.isoformat()}},
+            sort=[("taken_at", -1)],
+            limit=self.per_user * 2
+        )
+        entries = []
+        for row in rows:
+            if len(entries) == self.per_user:
+                break
+            value = parse_hash(row.get("perceptual_hash"))
+            if value is not None and row.get("s3_key") and row.get("processed_at"):
+                entries.append(self._entry(row, value))
+        return entries
+
+    async def match(self, db, user_id: str, value: int, blurred: bool = False,
+                    window_seconds: Optional[int] = None) -> Optional[Dict]:
+        """Recent entry visually identical to `value` and blurred the same way, if any"""
+        entries = [entry for entry in await self.recent(db, user_id, window_seconds)
+                   if bool(entry["blurred"]) == blurred]
+        index = find_match(value, [entry["hash"] for entry in entries])
+        return entries[index] if index is not None else None
+
+    @staticmethod
+    def _entry(screenshot: Dict, value: int) -> Dict:
+        return {
+            "hash": value,
+            "screenshot_id": screenshot["screenshot_id"],
+            "s3_key": screenshot.get("s3_key"),
+            "s3_url": screenshot.get("s3_url"),
+            "thumbnail_key": screenshot.get("thumbnail_key"),
+            "blurred": screenshot.get("blurred", False),
+            "storage_type": screenshot.get("storage_type"),
+            "content_type": screenshot.get("content_type"),
+            "file_size": screenshot.get("file_size"),
+            "width": screenshot.get("width"),
+            "height": screenshot.get("height")
+        }
+
+
+# Global index instance
+phash_index = PerceptualHashIndex()
@@ -0,0 +1,179 @@
+"""
+Presence Index
+In-memory, per-company view of who is working, on what, and for how long today
+"""
+import asyncio
+import os
+import time
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional
+import logging
+
+from utils.ingest_buffer import ingest_buffer
+from utils.metrics import registry
+from utils.timer_schedule_engine import resolve_timezone
+
+logger = logging.getLogger(__name__)
+
+# Seconds a company's index is trusted before it is reloaded; bounds drift from
+# writes this process does not see (other workers, direct database changes)
+PRESENCE_INDEX_TTL = int(os.environ.get('PRESENCE_INDEX_TTL', 60))
+PRESENCE_IDLE_AFTER = timedelta(minutes=5)
+
+
+def _parse_time(value) -> Optional[datetime]:
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        moment = value
+    else:
+        moment = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment
+
+
+class PresenceIndex:
+    """
+    Team status per company: active time entry, latest activity and
+    tracked seconds today for every member
+
+    A company is loaded with one `team_presence` database call the first
+    time its status is requested, then kept current by time entry start and
+    stop events and by activity logs as the ingest buffer writes them. It is
+    reloaded after `ttl` seconds, at the company's local midnight, or when
+    invalidated.
+    """
+
+    def __init__(self, ttl: int = PRESENCE_INDEX_TTL):
+        self.ttl = ttl
+        self._companies: Dict[str, Dict] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+        self.lookups = registry.counter("presence_index_lookups_total", "Team status lookups", ["result"])
+        self.companies_loaded = registry.gauge("presence_index_companies", "Companies held in the presence index")
+        self.companies_loaded.set_function(self._companies.__len__)
+
+    async def start(self, db):
+        """Follow activity logs as the ingest buffer writes them"""
+        ingest_buffer.subscribe("activity_logs", self.activity_written)
+        logger.info(f"Presence index started (reload after {self.ttl}s)")
+
+    async def team_status(self, db, company_id: str) -> List[Dict]:
+        """Status of every member of the company, answered from memory when the index is warm"""
+        company = self._companies.get(company_id)
+        if company is None or self._is_stale(company):
+            self.lookups.inc(result="miss")
+            lock = self._locks.setdefault(company_id, asyncio.Lock())
+            async with lock:
+                company = self._companies.get(company_id)
+                if company is None or self._is_stale(company):
+                    company = await self._load(db, company_id)
+        else:
+            self.lookups.inc(result="hit")
+
+        now = datetime.now(timezone.utc)
+        return [self._status(company, member, now) for member in company["members"].values()]
+
+    def _is_stale(self, company: Dict) -> bool:
+        if time.monotonic() - company["loaded_at"] > self.ttl:
+            return True
+        return datetime.now(company["tz"]).date() != company["day"]
+
+    async def _load(self, db, company_id: str) -> Dict:
+        rows = await db.rpc("team_presence", {"p_company_id": company_id})
+        tz = resolve_timezone(rows[0].get("timezone") if rows else None)
+
+        members = {}
+        for row in rows:
+            members[row["user_id"]] = {
+                "user_id": row["user_id"],
+                "name": row["name"],
+                "email": row["email"],
+                "role": row["role"],
+                "picture": row.get("picture"),
+                "active_entry_id": row.get("active_entry_id"),
+                "active_since": _parse_time(row.get("active_since")),
+                "last_activity_at": _parse_time(row.get("last_activity_at")),
+                "current_app": row.get("current_app"),
+                "activity_level": row.get("activity_level") or 0,
+                "today_seconds": row.get("today_seconds") or 0
+            }
+
+        company = {
+            "tz": tz,
+            "day": datetime.now(tz).date(),
+            "loaded_at": time.monotonic(),
+            "members": members
+        }
+        self._companies[company_id] = company
+        return company
+
+    def _status(self, company: Dict, member: Dict, now: datetime) -> Dict:
+        today_seconds = member["today_seconds"]
+        status = "offline"
+        if member["active_entry_id"]:
+            status = "active"
+            last_activity = member["last_activity_at"]
+            if last_activity and now - last_activity > PRESENCE_IDLE_AFTER:
+                status = "idle"
+            # Count the running entry's time since it started, or since local midnight
+            midnight = datetime.combine(company["day"], datetime.min.time(), company["tz"])
+            since = max(member["active_since"] or now, midnight)
+            today_seconds += max(0, (now - since).total_seconds())
+
+        return {
+            "user_id": member["user_id"],
+            "name": member["name"],
+            "email": member["email"],
+            "role": member["role"],
+            "picture": member["picture"],
+            "status": status,
+            "today_hours": round(today_seconds / 3600, 2),
+            "current_app": member["current_app"],
+            "activity_level": member["activity_level"]
+        }
+
+    def _member(self, company_id: str, user_id: str) -> Optional[Dict]:
+        company = self._companies.get(company_id)
+        return company["members"].get(user_id) if company else None
+
+    def entry_started(self, company_id: str, user_id: str, entry_id: str, start_time):
+        member = self._member(company_id, user_id)
+        if member is not None:
+            member["active_entry_id"] = entry_id
+            member["active_since"] = _parse_time(start_time)
+
+    def entry_stopped(self, company_id: str, user_id: str, entry_id: str, start_time, duration: int):
+        """A time entry ended; its duration counts towards today when it started today"""
+        company = self._companies.get(company_id)
+        member = self._member(company_id, user_id)
+        if member is None:
+            return
+        if member["active_entry_id"] == entry_id:
+            member["active_entry_id"] = None
+            member["active_since"] = None
+        started = _parse_time(start_time)
+        if started and started.astimezone(company["tz"]).date() == company["day"]:
+            member["today_seconds"] += duration or 0
+
+    def invalidate(self, company_id: str):
+        """Reload the company on its next lookup"""
+        self._companies.pop(company_id, None)
+
+    async def activity_written(self, logs: List[Dict]):
+        """Track each member's latest activity sample"""
+        for log in logs:
+            member = self._member(log["company_id"], log["user_id"])
+            if member is None:
+                continue
+            timestamp = _parse_time(log.get("timestamp"))
+            if timestamp is None or (member["last_activity_at"] and timestamp < member["last_activity_at"]):
+                continue
+            member["last_activity_at"] = timestamp
+            member["current_app"] = log.get("app_name")
+            member["activity_level"] = log.get("activity_level") or 0
+
+
+# Global index instance
+presence_index = PresenceIndex()
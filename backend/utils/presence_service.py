@@ -0,0 +1,143 @@
+"""
+Presence Service
+Online / idle / offline presence from agent heartbeats, shared across workers through pub/sub
+"""
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional
+import logging
+
+from utils.metrics import registry
+from utils.pubsub import PubSubBackend, create_pubsub
+
+logger = logging.getLogger(__name__)
+
+# A presence entry expires (the user goes offline) this long after its last heartbeat
+PRESENCE_TTL_SECONDS = int(os.environ.get('PRESENCE_TTL_SECONDS', 90))
+PRESENCE_SWEEP_INTERVAL = int(os.environ.get('PRESENCE_SWEEP_INTERVAL', 15))
+PRESENCE_STATUSES = ("online", "idle", "offline")
+
+COMPANIES_KEY = "presence:companies"
+
+
+def presence_key(company_id: str) -> str:
+    return f"presence:{company_id}"
+
+
+def presence_channel(company_id: str) -> str:
+    return f"presence-changes:{company_id}"
+
+
+class PresenceService:
+    """
+    Presence entries per company, each expiring `ttl_seconds` after the
+    user's last heartbeat
+
+    Entries live in a hash per company on the pub/sub backend, so every
+    worker sees the same presence. A change of status (or of app while
+    online) is published on the company's channel; subscribers such as the
+    dashboard websockets receive changes instead of recomputing presence.
+    Every worker sweeps expired entries; the backend's `hdel_if` lets
+    exactly one of them remove an entry, and only if no heartbeat has
+    refreshed it since it was read, and publish the offline change.
+    """
+
+    def __init__(self, backend: Optional[PubSubBackend] = None, ttl_seconds: int = PRESENCE_TTL_SECONDS,
+                 sweep_interval: int = PRESENCE_SWEEP_INTERVAL):
+        self.backend = backend or create_pubsub()
+        self.ttl = ttl_seconds
+        self.sweep_interval = sweep_interval
+        self._task: Optional[asyncio.Task] = None
+
+        self.heartbeats = registry.counter("presence_heartbeats_total", "Presence heartbeats received")
+        self.changes = registry.counter("presence_changes_total", "Presence changes published", ["status"])
+
+    async def start(self):
+        if self._task:
+            return
+        await self.backend.start()
+        self._task = asyncio.create_task(self._sweep_loop())
+        logger.info(f"Presence service started ({type(self.backend).__name__}, ttl {self.ttl}s)")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.backend.stop()
+        logger.info("Presence service stopped")
+
+    async def heartbeat(self, user: Dict, status: str = "online", app_name: Optional[str] = None,
+                        activity_level: Optional[int] = None) -> Dict:
+        """Refresh the user's presence entry; an "offline" heartbeat removes it at once"""
+        self.heartbeats.inc()
+        company_id = user["company_id"]
+        key = presence_key(company_id)
+        if status == "offline":
+            if await self.backend.hdel(key, user["user_id"]):
+                await self._publish(company_id, {"user_id": user["user_id"], "status": "offline"})
+            return {"user_id": user["user_id"], "status": "offline"}
+
+        now = time.time()
+        entry = {
+            "user_id": user["user_id"],
+            "name": user.get("name"),
+            "status": status,
+            "app_name": app_name,
+            "activity_level": activity_level,
+            "last_seen": datetime.now(timezone.utc).isoformat(),
+            "expires_at": now + self.ttl
+        }
+        previous = await self.backend.hget(key, user["user_id"])
+        await self.backend.hset(key, user["user_id"], entry)
+        await self.backend.sadd(COMPANIES_KEY, company_id)
+
+        if previous is None or previous["expires_at"] < now or previous["status"] != status \
+                or previous.get("app_name") != app_name:
+            await self._publish(company_id, self._public(entry))
+        return self._public(entry)
+
+    async def snapshot(self, company_id: str) -> List[Dict]:
+        """Everyone currently online or idle in the company"""
+        now = time.time()
+        entries = await self.backend.hgetall(presence_key(company_id))
+        return [self._public(entry) for entry in entries.values() if entry["expires_at"] >= now]
+
+    async def subscribe(self, company_id: str,
+                        handler: Callable[[Dict], Awaitable[None]]) -> Callable[[], Awaitable[None]]:
+        """Receive the company's presence changes; returns an async unsubscribe function"""
+        return await self.backend.subscribe(presence_channel(company_id), handler)
+
+    async def _publish(self, company_id: str, change: Dict):
+        self.changes.inc(status=change["status"])
+        await self.backend.publish(presence_channel(company_id), change)
+
+    def _public(self, entry: Dict) -> Dict:
+        return {field: value for field, value in entry.items() if field != "expires_at"}
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Error sweeping presence entries: {e}")
+
+    async def sweep(self):
+        """Remove expired entries and publish each user going offline"""
+        now = time.time()
+        for company_id in await self.backend.smembers(COMPANIES_KEY):
+            key = presence_key(company_id)
+            for user_id, entry in (await self.backend.hgetall(key)).items():
+                # A heartbeat landing after the read replaces the entry, which then stays
+                if entry["expires_at"] < now and await self.backend.hdel_if(key, user_id, entry):
+                    await self._publish(company_id, {"user_id": user_id, "name": entry.get("name"), "status": "offline"})
+
+
+# Global service instance
+presence_service = PresenceService()
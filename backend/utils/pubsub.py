@@ -0,0 +1,278 @@
+"""
+Pub/Sub Backends
+Message fan-out and small shared hashes across workers: in-process, Redis protocol, or a recording test double
+"""
+import asyncio
+import json
+import os
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+# redis://, rediss:// or unix:// URL of a Redis-protocol server (Redis, Valkey, KeyDB, ...);
+# unset runs everything in-process, which is only correct with a single worker
+PUBSUB_URL = os.environ.get('PUBSUB_URL')
+# "recording" selects the in-process test double
+PUBSUB_BACKEND = os.environ.get('PUBSUB_BACKEND', 'redis' if PUBSUB_URL else 'memory')
+
+Handler = Callable[[Dict], Awaitable[None]]
+
+
+class PubSubBackend:
+    """
+    Interface of the pub/sub backends
+
+    Messages are JSON objects published on named channels; every subscriber
+    of a channel, in any worker, receives each message once. Hashes give the
+    workers a shared key/field store; `hdel` reports whether this caller
+    removed the field, so exactly one worker acts on a removal; `hdel_if`
+    only removes a field still holding the value the caller read, and
+    `hsetnx` reports whether it set a field that did not exist yet.
+
+    `shared` is True for backends that every worker sees; state kept in
+    an unshared backend is private to one worker.
+    """
+
+    shared = False
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, channel: str, message: Dict):
+        raise NotImplementedError
+
+    async def subscribe(self, channel: str, handler: Handler) -> Callable[[], Awaitable[None]]:
+        """Deliver the channel's messages to `handler`; returns an async unsubscribe function"""
+        raise NotImplementedError
+
+    async def hset(self, key: str, field: str, value: Dict):
+        raise NotImplementedError
+
+    async def hsetnx(self, key: str, field: str, value: Dict) -> bool:
+        raise NotImplementedError
+
+    async def hget(self, key: str, field: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    async def hgetall(self, key: str) -> Dict[str, Dict]:
+        raise NotImplementedError
+
+    async def hdel(self, key: str, field: str) -> bool:
+        raise NotImplementedError
+
+    async def hdel_if(self, key: str, field: str, expected: Dict) -> bool:
+        raise NotImplementedError
+
+    async def sadd(self, key: str, member: str):
+        raise NotImplementedError
+
+    async def smembers(self, key: str) -> List[str]:
+        raise NotImplementedError
+
+
+class InProcessPubSub(PubSubBackend):
+    """Pub/sub and hashes held in this process; for single-worker deployments"""
+
+    def __init__(self):
+        self._handlers: Dict[str, List[Handler]] = {}
+        self._hashes: Dict[str, Dict[str, Dict]] = {}
+        self._sets: Dict[str, set] = {}
+
+    async def publish(self, channel: str, message: Dict):
+        for handler in list(self._handlers.get(channel, [])):
+            try:
+                await handler(message)
+            except Exception as e:
+                logger.error(f"Error in {channel} subscriber: {e}")
+
+    async def subscribe(self, channel: str, handler: Handler) -> Callable[[], Awaitable[None]]:
+        self._handlers.setdefault(channel, []).append(handler)
+
+        async def unsubscribe():
+            handlers = self._handlers.get(channel, [])
+            if handler in handlers:
+                handlers.remove(handler)
+            if not handlers:
+                self._handlers.pop(channel, None)
+        return unsubscribe
+
+    async def hset(self, key: str, field: str, value: Dict):
+        self._hashes.setdefault(key, {})[field] = value
+
+    async def hsetnx(self, key: str, field: str, value: Dict) -> bool:
+        fields = self._hashes.setdefault(key, {})
+        if field in fields:
+            return False
+        fields[field] = value
+        return True
+
+    async def hget(self, key: str, field: str) -> Optional[Dict]:
+        return self._hashes.get(key, {}).get(field)
+
+    async def hgetall(self, key: str) -> Dict[str, Dict]:
+        return dict(self._hashes.get(key, {}))
+
+    async def hdel(self, key: str, field: str) -> bool:
+        return self._hashes.get(key, {}).pop(field, None) is not None
+
+    async def hdel_if(self, key: str, field: str, expected: Dict) -> bool:
+        fields = self._hashes.get(key, {})
+        if field not in fields or fields[field] != expected:
+            return False
+        del fields[field]
+        return True
+
+    async def sadd(self, key: str, member: str):
+        self._sets.setdefault(key, set()).add(member)
+
+    async def smembers(self, key: str) -> List[str]:
+        return list(self._sets.get(key, set()))
+
+
+class RecordingPubSub(InProcessPubSub):
+    """In-process backend that also records every published message, for tests and CI"""
+
+    def __init__(self):
+        super().__init__()
+        self.published: List[Tuple[str, Dict]] = []
+
+    async def publish(self, channel: str, message: Dict):
+        self.published.append((channel, message))
+        await super().publish(channel, message)
+
+    def messages(self, channel: str) -> List[Dict]:
+        return [message for published_channel, message in self.published if published_channel == channel]
+
+    def clear(self):
+        self.published.clear()
+
+
+# KEYS[1] hash, ARGV[1] field, ARGV[2] the value it must still hold
+HDEL_IF_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+  return redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+
+class RedisPubSub(PubSubBackend):
+    """
+    Backend on a Redis-protocol server, shared by every worker
+
+    One connection pool serves commands; one pub/sub connection per process
+    receives the subscribed channels and dispatches to local handlers.
+    """
+
+    shared = True
+
+    def __init__(self, url: str):
+        self.url = url
+        self._redis = None
+        self._pubsub = None
+        self._reader: Optional[asyncio.Task] = None
+        self._handlers: Dict[str, List[Handler]] = {}
+
+    async def start(self):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("PUBSUB_URL is set but the redis package is not installed")
+        self._redis = redis.from_url(self.url, decode_responses=True)
+        self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        logger.info("Redis pub/sub backend connected")
+
+    async def stop(self):
+        if self._reader:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+            self._reader = None
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+        if self._redis is not None:
+            await self._redis.aclose()
+
+    async def publish(self, channel: str, message: Dict):
+        await self._redis.publish(channel, json.dumps(message))
+
+    async def subscribe(self, channel: str, handler: Handler) -> Callable[[], Awaitable[None]]:
+        if channel not in self._handlers:
+            self._handlers[channel] = []
+            await self._pubsub.subscribe(channel)
+        self._handlers[channel].append(handler)
+        if self._reader is None:
+            self._reader = asyncio.create_task(self._read_loop())
+
+        async def unsubscribe():
+            handlers = self._handlers.get(channel, [])
+            if handler in handlers:
+                handlers.remove(handler)
+            if not handlers and channel in self._handlers:
+                del self._handlers[channel]
+                await self._pubsub.unsubscribe(channel)
+        return unsubscribe
+
+    async def _read_loop(self):
+        while True:
+            try:
+                message = await self._pubsub.get_message(timeout=1.0)
+                if message is None:
+                    # get_message returns at once while nothing is subscribed
+                    await asyncio.sleep(0.1)
+                    continue
+                payload = json.loads(message["data"])
+                for handler in list(self._handlers.get(message["channel"], [])):
+                    try:
+                        await handler(payload)
+                    except Exception as e:
+                        logger.error(f"Error in {message['channel']} subscriber: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Redis pub/sub read error: {e}")
+                await asyncio.sleep(1)
+
+    async def hset(self, key: str, field: str, value: Dict):
+        await self._redis.hset(key, field, json.dumps(value))
+
+    async def hsetnx(self, key: str, field: str, value: Dict) -> bool:
+        return bool(await self._redis.hsetnx(key, field, json.dumps(value)))
+
+    async def hget(self, key: str, field: str) -> Optional[Dict]:
+        value = await self._redis.hget(key, field)
+        return json.loads(value) if value else None
+
+    async def hgetall(self, key: str) -> Dict[str, Dict]:
+        values = await self._redis.hgetall(key)
+        return {field: json.loads(value) for field, value in values.items()}
+
+    async def hdel(self, key: str, field: str) -> bool:
+        return await self._redis.hdel(key, field) == 1
+
+    async def hdel_if(self, key: str, field: str, expected: Dict) -> bool:
+        # Compare and delete in one step, so a concurrent hset is never lost
+        return await self._redis.eval(HDEL_IF_SCRIPT, 1, key, field, json.dumps(expected)) == 1
+
+    async def sadd(self, key: str, member: str):
+        await self._redis.sadd(key, member)
+
+    async def smembers(self, key: str) -> List[str]:
+        return list(await self._redis.smembers(key))
+
+
+def create_pubsub(backend: str = PUBSUB_BACKEND, url: Optional[str] = PUBSUB_URL) -> PubSubBackend:
+    """The configured backend: "redis" (needs `url`), "memory" or "recording" """
+    if backend == "redis":
+        if not url:
+            raise ValueError("PUBSUB_BACKEND=redis requires PUBSUB_URL")
+        return RedisPubSub(url)
+    if backend == "recording":
+        return RecordingPubSub()
+    return InProcessPubSub()
@@ -0,0 +1,208 @@
+"""
+Recurring Payment Processor
+Processes all due recurring payment schedules in batches
+"""
+import asyncio
+import time
+from datetime import datetime, timezone, date
+from typing import Dict, Optional
+import logging
+
+from utils.id_generator import generate_id
+
+logger = logging.getLogger(__name__)
+
+
+def payout_idempotency_key(schedule_id: str, due_date: str) -> str:
+    """One payout per schedule per due date, however many times a run is retried"""
+    return f"recurring:{schedule_id}:{due_date}"
+
+
+class RecurringPaymentProcessor:
+    """Claims due schedules with row-level locks and pays them in bulk"""
+
+    def __init__(self, batch_size: int = 500, lease_seconds: int = 300):
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self._task: Optional[asyncio.Task] = None
+        self.last_run: Optional[Dict] = None
+
+    async def start(self, db, interval: int = 3600):
+        """Process due schedules now and then every `interval` seconds"""
+        if self._task:
+            return
+        self._task = asyncio.create_task(self._run_loop(db, interval))
+        logger.info(f"Recurring payment processor started with interval {interval}s")
+
+    async def stop(self):
+        """Stop the periodic run"""
+        if not self._task:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        logger.info("Recurring payment processor stopped")
+
+    async def _run_loop(self, db, interval: int):
+        try:
+            while True:
+                try:
+                    await self.process_due(db)
+                except Exception as e:
+                    logger.error(f"Error processing recurring payments: {e}")
+                await asyncio.sleep(interval)
+        except asyncio.CancelledError:
+            logger.info("Recurring payment loop cancelled")
+
+    async def process_due(self, db, run_date: Optional[date] = None,
+                          company_id: Optional[str] = None) -> Dict:
+        """
+        Pay every active, unpaused schedule whose next_payment_date is on or
+        before `run_date` (default today, UTC), optionally for a single company
+
+        Schedules are claimed in batches through `claim_due_recurring_payments`,
+        which locks rows with FOR UPDATE SKIP LOCKED and leases them to this run,
+        so concurrent runs never pick the same schedule, and released through
+        `complete_recurring_payments`, which writes only the run's own fields.
+        Payouts carry an idempotency key per (schedule, due date); a retried
+        run inserts nothing for periods that were already paid.
+        """
+        from routes.recurring_payments import calculate_next_payment_date
+        from routes.notifications import create_notifications
+
+        today = datetime.now(timezone.utc).date()
+        run_date = run_date or today
+        if run_date > today:
+            # A claimed schedule is re-claimed while its advanced date is still due,
+            # so a future run date would pay every period up to it at once
+            raise ValueError("run_date cannot be in the future")
+        run_id = generate_id("payrun")
+        started = time.monotonic()
+        summary = {
+            "run_id": run_id,
+            "run_date": run_date.isoformat(),
+            "company_id": company_id,
+            "batches": 0,
+            "claimed": 0,
+            "payouts_created": 0,
+            "duplicates_skipped": 0,
+            "schedules_completed": 0,
+            "total_amount": {}
+        }
+
+        while True:
+            claimed = await db.rpc("claim_due_recurring_payments", {
+                "p_run_date": run_date.isoformat(),
+                "p_claim_id": run_id,
+                "p_company_id": company_id,
+                "p_limit": self.batch_size,
+                "p_lease_seconds": self.lease_seconds
+            })
+            if not claimed:
+                break
+
+            summary["batches"] += 1
+            summary["claimed"] += len(claimed)
+            now = datetime.now(timezone.utc).isoformat()
+
+            # Unknown frequencies are caught before anything is paid; their
+            # rows keep the lease so this run does not spin on them
+            due = []
+            for schedule in claimed:
+                due_date = schedule["next_payment_date"]
+                next_payment = calculate_next_payment_date(date.fromisoformat(due_date), schedule["frequency"])
+                if next_payment.isoformat() <= due_date:
+                    logger.error(f"Schedule {schedule['schedule_id']} has invalid frequency {schedule['frequency']}")
+                    continue
+                due.append((schedule, due_date, next_payment.isoformat()))
+
+            payouts = []
+            for schedule, due_date, _ in due:
+                if schedule.get("end_date") and due_date > schedule["end_date"]:
+                    continue
+                payouts.append({
+                    "payout_id": generate_id("payout"),
+                    "company_id": schedule["company_id"],
+                    "from_user_id": schedule["admin_id"],
+                    "to_user_id": schedule["employee_id"],
+                    "from_account_id": schedule.get("from_account_id"),
+                    "to_account_id": schedule.get("to_account_id"),
+                    "wage_id": schedule.get("wage_id"),
+                    "amount": schedule["amount"],
+                    "currency": schedule["currency"],
+                    "payout_type": "salary",
+                    "payment_method": "bank_transfer",
+                    "status": "approved",
+                    "is_recurring": True,
+                    "recurring_schedule_id": schedule["schedule_id"],
+                    "idempotency_key": payout_idempotency_key(schedule["schedule_id"], due_date),
+                    "scheduled_for": due_date,
+                    "notes": f"Recurring payment - {schedule['frequency']}",
+                    "metadata": {"payment_run_id": run_id},
+                    "created_by": schedule["admin_id"],
+                    "created_at": now,
+                    "updated_at": now
+                })
+
+            # Rows whose idempotency key already exists are skipped and not returned
+            result = await db.payouts.upsert_many(
+                payouts, on_conflict="idempotency_key", ignore_duplicates=True
+            )
+            created = {p["idempotency_key"]: p for p in result["upserted"]}
+            summary["payouts_created"] += len(created)
+            summary["duplicates_skipped"] += len(payouts) - len(created)
+
+            # Only the run's own fields are written, so edits made meanwhile (pausing,
+            # a new amount) are kept; rows another run has taken over are left alone
+            schedule_updates = []
+            notifications = []
+            for schedule, due_date, next_payment_date in due:
+                update = {
+                    "schedule_id": schedule["schedule_id"],
+                    "next_payment_date": next_payment_date,
+                    "payments_made": 0,
+                    "last_payment_date": None,
+                    "last_payout_id": None,
+                    "completed": bool(schedule.get("end_date") and next_payment_date > schedule["end_date"])
+                }
+
+                payout = created.get(payout_idempotency_key(schedule["schedule_id"], due_date))
+                if payout:
+                    update["payments_made"] = 1
+                    update["last_payment_date"] = due_date
+                    update["last_payout_id"] = payout["payout_id"]
+                    totals = summary["total_amount"]
+                    totals[schedule["currency"]] = round(totals.get(schedule["currency"], 0) + float(schedule["amount"]), 2)
+                    notifications.append({
+                        "company_id": schedule["company_id"],
+                        "user_id": schedule["employee_id"],
+                        "notification_type": "recurring_payment_processed",
+                        "title": "Recurring Payment Processed",
+                        "message": f"Your {schedule['frequency']} payment of {schedule['currency']} {schedule['amount']} has been processed",
+                        "data": {"schedule_id": schedule["schedule_id"], "payout_id": payout["payout_id"]},
+                        "priority": "high"
+                    })
+
+                if update["completed"]:
+                    summary["schedules_completed"] += 1
+                schedule_updates.append(update)
+
+            if schedule_updates:
+                await db.rpc("complete_recurring_payments", {"p_claim_id": run_id, "p_updates": schedule_updates})
+            await create_notifications(db, notifications)
+
+        summary["duration_ms"] = int((time.monotonic() - started) * 1000)
+        self.last_run = summary
+        if summary["claimed"]:
+            logger.info(
+                f"Recurring payment run {run_id}: {summary['payouts_created']} payouts created, "
+                f"{summary['duplicates_skipped']} duplicates skipped in {summary['duration_ms']}ms"
+            )
+        return summary
+
+
+# Global processor instance
+recurring_payment_processor = RecurringPaymentProcessor()
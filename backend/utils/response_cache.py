@@ -0,0 +1,253 @@
+"""
+Response Cache
+Strong ETags, conditional GETs and short-lived bodies for polled endpoints, keyed on per-company data versions
+"""
+import hashlib
+import os
+import secrets
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import logging
+
+from starlette.requests import HTTPConnection
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from utils.metrics import registry
+from utils.pubsub import PubSubBackend, create_pubsub
+
+logger = logging.getLogger(__name__)
+
+# Seconds a rendered body is reused for the same (company, role, user, query); 0 disables the body cache
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 5))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 10000))
+
+
+# Field of a company's versions hash holding its epoch
+EPOCH_FIELD = "_epoch"
+
+
+def versions_key(company_id: str) -> str:
+    return f"data-versions:{company_id}"
+
+
+class DataVersions:
+    """
+    A version token per (company, table), replaced on every write to the table
+
+    Tokens live in a hash per company on the pub/sub backend so every worker
+    sees a write made by any of them. Only the tables named in `tables` are
+    tracked; writes to anything else cost nothing.
+
+    The hash also holds an epoch, created whenever it is missing: when the
+    backend loses its data (a Redis restart or flush) every company gets a
+    new epoch, so tags issued before can no longer match. Versions are
+    only `enabled` on a backend shared by all workers - with per-worker
+    hashes a write seen by one worker would leave the others answering 304
+    with stale data.
+    """
+
+    def __init__(self, tables: Iterable[str] = (), backend: Optional[PubSubBackend] = None):
+        self.tables = set(tables)
+        self.backend = backend or create_pubsub()
+
+        self.bumps = registry.counter("data_version_bumps_total", "Data version changes", ["table"])
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend.shared
+
+    async def start(self):
+        await self.backend.start()
+
+    async def stop(self):
+        await self.backend.stop()
+
+    def track(self, tables: Iterable[str]):
+        self.tables.update(tables)
+
+    async def record_write(self, table: str, rows: List[Dict]):
+        """Write listener: bump the table's version for every company among the written rows"""
+        if table not in self.tables or not self.enabled:
+            return
+        for company_id in {row.get("company_id") for row in rows if row.get("company_id")}:
+            await self.bump(company_id, table)
+
+    async def bump(self, company_id: str, table: str):
+        if not self.enabled:
+            return
+        await self.backend.hset(versions_key(company_id), table, {"v": secrets.token_hex(8)})
+        self.bumps.inc(table=table)
+
+    async def current(self, company_id: str) -> Dict[str, str]:
+        """
+        Version token of every tracked table the company has written, and
+        the company's epoch under `EPOCH_FIELD`; unwritten tables are absent
+        """
+        key = versions_key(company_id)
+        entries = await self.backend.hgetall(key)
+        if EPOCH_FIELD not in entries:
+            # Only one worker creates the epoch; the others read the winner's
+            await self.backend.hsetnx(key, EPOCH_FIELD, {"v": secrets.token_hex(8)})
+            entries[EPOCH_FIELD] = await self.backend.hget(key, EPOCH_FIELD)
+        return {table: entry["v"] for table, entry in entries.items()}
+
+
+class CachePolicy:
+    """
+    How one polled endpoint is validated
+
+    `tables` are the tables its response is computed from. `refresh` bounds,
+    in seconds, how long a response may be reused for data that changes
+    without a write to those tables (running timers, activity averages, the
+    date); None means the response depends on the tables alone.
+    """
+
+    def __init__(self, tables: Iterable[str], refresh: Optional[int] = None):
+        self.tables = tuple(sorted(tables))
+        self.refresh = refresh
+
+
+class ConditionalGetMiddleware:
+    """
+    ETags and `If-None-Match` for the GET endpoints in `policies`
+
+    The ETag is computed from the caller's token claims, the endpoint and
+    query, and the company's data versions of the endpoint's tables, so a
+    matching `If-None-Match` is answered 304 before the endpoint runs - no
+    user lookup and no query. `users` is always part of the tag: a role
+    change or removal invalidates every tag the user holds, and the next
+    request goes through normal authentication. Requests without a usable
+    token pass straight through. Only install it when `versions.enabled`.
+
+    Versions are read before the endpoint runs, so a write racing with a
+    render can only make a tag older than its body, never newer; the client
+    refetches on its next poll. Bodies of successful responses are also kept
+    for `ttl` seconds per (company, role, user, endpoint, query) and reused
+    while their tag still matches.
+    """
+
+    def __init__(self, app: ASGIApp, policies: Dict[str, CachePolicy], versions: DataVersions,
+                 claims: Callable[[str], Optional[Dict]], ttl: float = RESPONSE_CACHE_TTL,
+                 max_entries: int = RESPONSE_CACHE_MAX_ENTRIES):
+        self.app = app
+        self.policies = policies
+        self.versions = versions
+        self.claims = claims
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._bodies: Dict[Tuple, Tuple[str, float, List[Tuple[bytes, bytes]], bytes]] = {}
+
+        versions.track(["users"])
+        for policy in policies.values():
+            versions.track(policy.tables)
+
+        self.responses = registry.counter("conditional_get_responses_total", "Polled endpoint responses", ["endpoint", "result"])
+        self.cached_bodies = registry.gauge("conditional_get_cached_bodies", "Response bodies held for reuse")
+        self.cached_bodies.set_function(self._bodies.__len__)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        policy = self.policies.get(scope.get("path")) if scope["type"] == "http" else None
+        if policy is None or scope["method"] not in ("GET", "HEAD"):
+            await self.app(scope, receive, send)
+            return
+
+        connection = HTTPConnection(scope)
+        claims = self._claims(connection)
+        if claims is None:
+            await self.app(scope, receive, send)
+            return
+
+        path = scope["path"]
+        try:
+            etag = await self._etag(path, policy, claims, scope.get("query_string", b""))
+        except Exception as e:
+            logger.error(f"Error reading data versions for {path}: {e}")
+            await self.app(scope, receive, send)
+            return
+
+        if self._matches(connection.headers.get("if-none-match"), etag):
+            self.responses.inc(endpoint=path, result="not_modified")
+            await self._send(send, 304, self._validator_headers(etag), b"")
+            return
+
+        key = (claims["company_id"], claims["role"], claims["user_id"], path, scope.get("query_string", b""))
+        cached = self._bodies.get(key)
+        if cached and cached[0] == etag and cached[1] > time.monotonic():
+            self.responses.inc(endpoint=path, result="cached")
+            await self._send(send, 200, cached[2], cached[3] if scope["method"] == "GET" else b"")
+            return
+
+        self.responses.inc(endpoint=path, result="rendered")
+        await self._render(scope, receive, send, key, etag)
+
+    def _claims(self, connection: HTTPConnection) -> Optional[Dict]:
+        token = connection.cookies.get("session_token")
+        if not token:
+            authorization = connection.headers.get("authorization", "")
+            if authorization.startswith("Bearer "):
+                token = authorization.split(" ")[1]
+        if not token:
+            return None
+        claims = self.claims(token)
+        if not claims or not all(claims.get(field) for field in ("user_id", "company_id", "role")):
+            return None
+        return claims
+
+    async def _etag(self, path: str, policy: CachePolicy, claims: Dict, query_string: bytes) -> str:
+        versions = await self.versions.current(claims["company_id"])
+        parts = [path, query_string.decode("latin-1"), claims["company_id"], claims["role"], claims["user_id"]]
+        parts += [f"{table}={versions.get(table, '')}" for table in (EPOCH_FIELD, "users") + policy.tables]
+        if policy.refresh:
+            parts.append(f"t={int(time.time() // policy.refresh)}")
+            parts.append(datetime.now(timezone.utc).date().isoformat())
+        return '"' + hashlib.sha256("\n".join(parts).encode()).hexdigest()[:32] + '"'
+
+    def _matches(self, header: Optional[str], etag: str) -> bool:
+        if not header:
+            return False
+        candidates = [candidate.strip() for candidate in header.split(",")]
+        return "*" in candidates or any(candidate.removeprefix("W/") == etag for candidate in candidates)
+
+    def _validator_headers(self, etag: str) -> List[Tuple[bytes, bytes]]:
+        # Clients and proxies may store the body but must revalidate before using it
+        return [(b"etag", etag.encode()), (b"cache-control", b"private, no-cache")]
+
+    async def _render(self, scope: Scope, receive: Receive, send: Send, key: Tuple, etag: str):
+        """Run the endpoint, tag its response and keep a successful body for reuse"""
+        state = {"status": None, "headers": [], "body": []}
+
+        async def tagged_send(message: Message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+                if message["status"] == 200:
+                    headers = [(name, value) for name, value in message.get("headers", [])
+                               if name.lower() not in (b"etag", b"cache-control")]
+                    headers += self._validator_headers(etag)
+                    message = {**message, "headers": headers}
+                    state["headers"] = headers
+            elif message["type"] == "http.response.body" and state["status"] == 200:
+                state["body"].append(message.get("body", b""))
+                if not message.get("more_body") and self.ttl > 0 and scope["method"] == "GET":
+                    self._store(key, etag, state["headers"], b"".join(state["body"]))
+            await send(message)
+
+        await self.app(scope, receive, tagged_send)
+
+    def _store(self, key: Tuple, etag: str, headers: List[Tuple[bytes, bytes]], body: bytes):
+        if len(self._bodies) >= self.max_entries:
+            now = time.monotonic()
+            for stale in [k for k, cached in self._bodies.items() if cached[1] <= now]:
+                del self._bodies[stale]
+            if len(self._bodies) >= self.max_entries:
+                # Dicts keep insertion order: drop the oldest body
+                del self._bodies[next(iter(self._bodies))]
+        self._bodies[key] = (etag, time.monotonic() + self.ttl, headers, body)
+
+    async def _send(self, send: Send, status: int, headers: List[Tuple[bytes, bytes]], body: bytes):
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+
+# Global version store
+data_versions = DataVersions()
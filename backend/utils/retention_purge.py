@@ -0,0 +1,291 @@
+"""
+Retention Purge Engine
+Deletes screenshots, screen recordings and video screenshots older than each company's retention period
+"""
+import asyncio
+import os
+import time
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional
+import logging
+
+from utils.id_generator import generate_id
+from utils.job_runs import JobLease
+from utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Defaults for companies whose tracking_policy does not set them; 0 keeps data forever
+SCREENSHOT_RETENTION_DAYS = int(os.environ.get('SCREENSHOT_RETENTION_DAYS', 0))
+RECORDING_RETENTION_DAYS = int(os.environ.get('RECORDING_RETENTION_DAYS', 0))
+RETENTION_PURGE_INTERVAL = int(os.environ.get('RETENTION_PURGE_INTERVAL', 6 * 3600))
+RETENTION_PURGE_BATCHES_PER_SECOND = float(os.environ.get('RETENTION_PURGE_BATCHES_PER_SECOND', 2))
+RETENTION_PURGE_BATCH_SIZE = 1000  # one S3 delete_objects call per batch of rows
+
+# What gets purged: table, primary key, timestamp column, policy key and default,
+# blob key columns (a column may hold a list of keys)
+PURGE_KINDS = {
+    "screenshots": {
+        "table": "screenshots",
+        "id_field": "screenshot_id",
+        "time_field": "taken_at",
+        "policy_key": "screenshot_retention_days",
+        "default_days": SCREENSHOT_RETENTION_DAYS,
+        "key_field": "s3_key",
+        "extra_key_fields": ["thumbnail_key"],
+        "private_key_fields": ["original_key"]
+    },
+    "recordings": {
+        "table": "screen_recordings",
+        "id_field": "recording_id",
+        "time_field": "created_at",
+        "policy_key": "recording_retention_days",
+        "default_days": RECORDING_RETENTION_DAYS,
+        "key_field": "storage_key",
+        "extra_key_fields": ["derived_keys"],
+        "private_key_fields": []
+    },
+    "videos": {
+        "table": "video_screenshots",
+        "id_field": "video_id",
+        "time_field": "captured_at",
+        "policy_key": "recording_retention_days",
+        "default_days": RECORDING_RETENTION_DAYS,
+        "key_field": "storage_key",
+        "extra_key_fields": ["derived_keys"],
+        "private_key_fields": []
+    }
+}
+
+
+def retention_cutoff(tracking_policy: Dict, kind: Dict, now: datetime) -> Optional[str]:
+    """ISO timestamp before which rows of `kind` are expired, or None when kept forever"""
+    days = int(tracking_policy.get(kind["policy_key"], kind["default_days"]) or 0)
+    if days <= 0:
+        return None
+    return (now - timedelta(days=days)).isoformat()
+
+
+class RetentionPurgeEngine:
+    """
+    Periodically purges expired screenshots and videos, company by company
+
+    Each run is recorded in `retention_purge_runs`. Companies are processed in
+    company_id order and the run's `cursor` is advanced after each one, so a
+    run interrupted by a restart resumes with the next company using the same
+    cutoff instant. Within a company, objects are deleted before their rows,
+    so a batch cut short is simply selected again.
+
+    One run at a time across all workers: a run first claims the
+    `retention_purge` job in `job_runs`, and a worker that cannot claim
+    it skips its turn.
+    """
+
+    def __init__(self, batch_size: int = RETENTION_PURGE_BATCH_SIZE,
+                 batches_per_second: float = RETENTION_PURGE_BATCHES_PER_SECOND):
+        self.batch_size = batch_size
+        self.batch_interval = 1 / batches_per_second if batches_per_second > 0 else 0
+        self._task: Optional[asyncio.Task] = None
+        self._manual_tasks: set = set()
+
+        self.rows_deleted = registry.counter(
+            "retention_purge_rows_deleted_total", "Rows deleted by the retention purge", ["kind"]
+        )
+        self.objects_deleted = registry.counter(
+            "retention_purge_objects_deleted_total", "Stored objects deleted by the retention purge", ["kind"]
+        )
+
+    async def start(self, db, interval: int = RETENTION_PURGE_INTERVAL):
+        """Resume or start a purge run now and then every `interval` seconds"""
+        if self._task:
+            return
+        self._task = asyncio.create_task(self._run_loop(db, interval))
+        logger.info(f"Retention purge engine started with interval {interval}s")
+
+    async def stop(self):
+        if not self._task:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        logger.info("Retention purge engine stopped")
+
+    async def trigger(self, db, company_id: Optional[str] = None) -> bool:
+        """Start a run in the background; returns False when one is already in progress on any worker"""
+        lease = JobLease(db, "retention_purge")
+        if not await lease.acquire():
+            return False
+        task = asyncio.create_task(self.run(db, company_id, lease))
+        self._manual_tasks.add(task)
+        task.add_done_callback(self._manual_tasks.discard)
+        return True
+
+    async def _run_loop(self, db, interval: int):
+        try:
+            while True:
+                try:
+                    await self.run(db)
+                except Exception as e:
+                    logger.error(f"Error running retention purge: {e}")
+                await asyncio.sleep(interval)
+        except asyncio.CancelledError:
+            logger.info("Retention purge loop cancelled")
+
+    async def run(self, db, company_id: Optional[str] = None, lease: Optional[JobLease] = None) -> Optional[Dict]:
+        """
+        Purge expired data for every company, or only `company_id`
+
+        An unfinished run for the same scope is resumed instead of starting
+        over. Returns None without purging when another worker's run holds
+        the job; a `lease` already acquired by the caller is used and released.
+        """
+        if lease is None:
+            lease = JobLease(db, "retention_purge")
+            if not await lease.acquire():
+                logger.debug("Retention purge already running on another worker")
+                return None
+        try:
+            return await self._run_claimed(db, company_id, lease)
+        finally:
+            await lease.release()
+
+    async def _run_claimed(self, db, company_id: Optional[str], lease: JobLease) -> Dict:
+        run = await self._resume_or_create(db, company_id)
+        started = time.monotonic()
+        now = datetime.fromisoformat(run["cutoff_at"])
+
+        if company_id:
+            companies = await db.companies.find({"company_id": company_id})
+        else:
+            companies = await db.companies.find({}, sort=[("company_id", 1)])
+        if run.get("cursor"):
+            companies = [c for c in companies if c["company_id"] > run["cursor"]]
+
+        try:
+            for company in companies:
+                policy = company.get("tracking_policy") or {}
+                for name, kind in PURGE_KINDS.items():
+                    cutoff = retention_cutoff(policy, kind, now)
+                    if cutoff:
+                        await self._purge_company(db, lease, run, company["company_id"], name, kind, cutoff)
+                run["cursor"] = company["company_id"]
+                run["companies_done"] += 1
+                await self._save(db, lease, run)
+
+            run["status"] = "completed"
+        except Exception:
+            run["status"] = "interrupted"
+            raise
+        finally:
+            run["duration_ms"] = run.get("duration_ms", 0) + int((time.monotonic() - started) * 1000)
+            run["finished_at"] = datetime.now(timezone.utc).isoformat()
+            await self._save(db, lease, run)
+
+        total = sum(run["rows_deleted"].values())
+        if total:
+            logger.info(
+                f"Retention purge {run['run_id']}: {total} rows and "
+                f"{sum(run['objects_deleted'].values())} objects deleted in {run['duration_ms']}ms"
+            )
+        return run
+
+    async def _resume_or_create(self, db, company_id: Optional[str]) -> Dict:
+        unfinished = await db.retention_purge_runs.find(
+            {"status": {"$in": ["running", "interrupted"]}, "company_id": company_id},
+            sort=[("started_at", -1)],
+            limit=1
+        )
+        if unfinished:
+            run = unfinished[0]
+            run["status"] = "running"
+            logger.info(f"Resuming retention purge {run['run_id']} after company {run.get('cursor')}")
+            return run
+
+        now = datetime.now(timezone.utc).isoformat()
+        run = {
+            "run_id": generate_id("purge"),
+            "company_id": company_id,
+            "status": "running",
+            "cutoff_at": now,
+            "cursor": None,
+            "companies_done": 0,
+            "rows_deleted": {name: 0 for name in PURGE_KINDS},
+            "objects_deleted": {name: 0 for name in PURGE_KINDS},
+            "started_at": now,
+            "finished_at": None
+        }
+        await db.retention_purge_runs.insert_one(run)
+        return run
+
+    async def _save(self, db, lease: JobLease, run: Dict):
+        await db.retention_purge_runs.upsert_many([run], on_conflict="run_id")
+        await lease.save_progress(run)
+
+    async def _purge_company(self, db, lease: JobLease, run: Dict, company_id: str, name: str, kind: Dict, cutoff: str):
+        """Delete one company's expired rows of a kind in batches, objects first, while the claim is held"""
+        from utils.storage_backends import get_storage
+
+        collection = db[kind["table"]]
+        id_field = kind["id_field"]
+        while True:
+            if not lease.held:
+                raise RuntimeError("Lost the retention purge claim")
+            rows = await collection.find(
+                {"company_id": company_id, kind["time_field"]: {"$lt": cutoff}},
+                sort=[(kind["time_field"], 1)],
+                limit=self.batch_size
+            )
+            if not rows:
+                break
+
+            ids = [row[id_field] for row in rows]
+            shared = await self._shared_keys(collection, kind, rows, set(ids))
+
+            keys_by_type: Dict[str, List[str]] = {}
+            for row in rows:
+                fields = list(kind["private_key_fields"])
+                if row.get(kind["key_field"]) not in shared:
+                    fields += [kind["key_field"]] + kind["extra_key_fields"]
+                keys = keys_by_type.setdefault(row.get("storage_type"), [])
+                for field in fields:
+                    value = row.get(field)
+                    keys.extend(value if isinstance(value, list) else [value] if value else [])
+
+            for storage_type, keys in keys_by_type.items():
+                storage = get_storage(storage_type) if storage_type in ("s3", "local") else None
+                if storage and keys:
+                    deleted = await storage.delete_many(keys)
+                    run["objects_deleted"][name] += deleted
+                    self.objects_deleted.inc(deleted, kind=name)
+
+            # One set-based delete per batch
+            await collection.delete_many({id_field: {"$in": ids}})
+
+            run["rows_deleted"][name] += len(rows)
+            self.rows_deleted.inc(len(rows), kind=name)
+            await self._save(db, lease, run)
+
+            if len(rows) < self.batch_size:
+                break
+            if self.batch_interval:
+                await asyncio.sleep(self.batch_interval)
+
+    async def _shared_keys(self, collection, kind: Dict, rows: List[Dict], batch_ids: set) -> set:
+        """Blob keys in `rows` that rows outside this batch still reference (deduplicated screenshots)"""
+        keys = list({row[kind["key_field"]] for row in rows if row.get(kind["key_field"])})
+        if not keys or kind["table"] != "screenshots":
+            return set()
+        referencing = await collection.find(
+            {kind["key_field"]: {"$in": keys}}, {"screenshot_id": 1, kind["key_field"]: 1}
+        )
+        return {
+            row[kind["key_field"]] for row in referencing
+            if row[kind["id_field"]] not in batch_ids
+        }
+
+
+# Global engine instance
+retention_purge_engine = RetentionPurgeEngine()
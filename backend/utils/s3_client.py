@@ -0,0 +1,151 @@
+"""
+S3 Client
+Process-wide S3-compatible client and a bounded executor for its blocking calls
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Optional, Tuple
+import logging
+
+import boto3
+from botocore.config import Config
+
+from utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+S3_MAX_CONNECTIONS = int(os.environ.get('S3_MAX_CONNECTIONS', 32))
+SIGNED_URL_TTL = int(os.environ.get('SIGNED_URL_TTL', 3600))
+# Cached URLs are re-signed once less than this much validity remains
+SIGNED_URL_MIN_REMAINING = int(os.environ.get('SIGNED_URL_MIN_REMAINING', 900))
+
+_client = None
+_client_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_s3_client():
+    """
+    Return the shared S3-compatible client (Contabo, MinIO, AWS S3, etc.),
+    creating it on first use. Returns None when storage is not configured.
+
+    boto3 clients are thread-safe, so one client and its connection pool are
+    shared by every request and executor thread.
+    """
+    global _client
+    if _client is not None:
+        return _client
+
+    endpoint_url = os.environ.get('S3_ENDPOINT_URL')  # e.g., https://eu2.contabostorage.com
+    access_key = os.environ.get('S3_ACCESS_KEY')
+    secret_key = os.environ.get('S3_SECRET_KEY')
+    region = os.environ.get('S3_REGION', 'eu2')
+
+    if not all([endpoint_url, access_key, secret_key]):
+        return None
+
+    with _client_lock:
+        if _client is None:
+            _client = boto3.session.Session().client(
+                's3',
+                endpoint_url=endpoint_url,
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_key,
+                region_name=region,
+                config=Config(
+                    signature_version='s3v4',
+                    s3={'addressing_style': 'path'},
+                    max_pool_connections=S3_MAX_CONNECTIONS,
+                    connect_timeout=5,
+                    read_timeout=60,
+                    retries={'max_attempts': 3, 'mode': 'standard'},
+                    tcp_keepalive=True
+                )
+            )
+            logger.info(f"S3 client created for {endpoint_url} with {S3_MAX_CONNECTIONS} pooled connections")
+    return _client
+
+
+def get_bucket_name():
+    return os.environ.get('S3_BUCKET_NAME', 'workmonitor-screenshots')
+
+
+def storage_reference(key: str) -> str:
+    """Stable, non-expiring reference to an object, persisted instead of a signed URL"""
+    return f"s3://{get_bucket_name()}/{key}"
+
+
+class SignedUrlCache:
+    """Presigned GET URLs per object key, reused until they are close to expiry"""
+
+    def __init__(self, ttl: int = SIGNED_URL_TTL, min_remaining: int = SIGNED_URL_MIN_REMAINING,
+                 max_entries: int = 100000):
+        self.ttl = ttl
+        self.min_remaining = min(min_remaining, ttl // 2)
+        self.max_entries = max_entries
+        self._urls: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.lookups = registry.counter(
+            "signed_url_cache_lookups_total", "Signed URL cache lookups", ["result"]
+        )
+
+    def get(self, s3_client, key: str) -> Tuple[str, float]:
+        """Signed URL for `key` and its expiry as a unix timestamp"""
+        now = time.time()
+        with self._lock:
+            cached = self._urls.get(key)
+            if cached and cached[1] - now > self.min_remaining:
+                self._urls.move_to_end(key)
+                self.lookups.inc(result="hit")
+                return cached
+
+        url = s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': get_bucket_name(), 'Key': key},
+            ExpiresIn=self.ttl
+        )
+        signed = (url, now + self.ttl)
+        with self._lock:
+            self._urls[key] = signed
+            self._urls.move_to_end(key)
+            while len(self._urls) > self.max_entries:
+                self._urls.popitem(last=False)
+        self.lookups.inc(result="miss")
+        return signed
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._urls.pop(key, None)
+
+
+# Global signed URL cache
+signed_url_cache = SignedUrlCache()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _client_lock:
+            if _executor is None:
+                # One worker per pooled connection; extra calls queue instead of opening sockets
+                _executor = ThreadPoolExecutor(max_workers=S3_MAX_CONNECTIONS, thread_name_prefix="s3")
+    return _executor
+
+
+async def run_s3(func, *args, **kwargs):
+    """Run a blocking S3 client call on the bounded S3 executor"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), partial(func, *args, **kwargs))
+
+
+def shutdown_s3_executor():
+    """Wait for in-flight S3 calls and release the executor threads"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
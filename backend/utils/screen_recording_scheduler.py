@@ -4,10 +4,13 @@ Manages automatic screen recording for Business plan users with random intervals
 """
 import asyncio
 import random
+import time
 from datetime import datetime, timezone
-from typing import Dict
+from typing import Dict, List
 import logging
 
+from utils.metrics import SchedulerMetrics
+
 logger = logging.getLogger(__name__)
 
 
@@ -18,6 +21,8 @@ class ScreenRecordingScheduler:
         self.active_recorders: Dict[str, Dict] = {}  # entry_id -> recorder_info
         self.tasks: Dict[str, asyncio.Task] = {}  # entry_id -> async task
         self.recording_callback = None
+        self.metrics = SchedulerMetrics("screen_recording")
+        self.metrics.bind(lambda: len(self.active_recorders), self.get_backlog)
 
     def set_recording_callback(self, callback):
         """Set the callback function to start screen recording"""
@@ -39,7 +44,13 @@ class ScreenRecordingScheduler:
         self.active_recorders[entry_id] = {
             "user_id": user_id,
             "company_id": company_id,
-            "started_at": datetime.now(timezone.utc)
+            "started_at": datetime.now(timezone.utc),
+            "next_fire_at": None,  # monotonic time of the next scheduled recording
+            "in_callback": False,
+            "fires": 0,
+            "failures": 0,
+            "last_lag": 0.0,
+            "max_lag": 0.0
         }
 
         # Start the screen recording task
@@ -75,19 +86,36 @@ class ScreenRecordingScheduler:
                 logger.info(f"Next 30s screen recording for entry {entry_id} in {random_interval}s")
 
                 # Wait for the random interval
+                scheduled_at = time.monotonic() + random_interval
+                self.active_recorders[entry_id]["next_fire_at"] = scheduled_at
                 await asyncio.sleep(random_interval)
 
                 # Check if recorder is still active
-                if entry_id not in self.active_recorders:
+                recorder_info = self.active_recorders.get(entry_id)
+                if recorder_info is None:
                     break
 
+                lag = max(time.monotonic() - scheduled_at, 0.0)
+                self.metrics.observe_lag(lag)
+                recorder_info["fires"] += 1
+                recorder_info["last_lag"] = lag
+                recorder_info["max_lag"] = max(recorder_info["max_lag"], lag)
+
                 # Trigger 30-second screen recording
                 if self.recording_callback:
+                    recorder_info["in_callback"] = True
+                    callback_started = time.monotonic()
+                    failed = False
                     try:
                         await self.recording_callback(entry_id, user_id, company_id, duration=30)
                         logger.info(f"30s screen recording started for entry {entry_id} after {random_interval}s wait")
                     except Exception as e:
+                        failed = True
+                        recorder_info["failures"] += 1
                         logger.error(f"Error starting screen recording for entry {entry_id}: {e}")
+                    finally:
+                        recorder_info["in_callback"] = False
+                        self.metrics.observe_callback(time.monotonic() - callback_started, failed)
 
         except asyncio.CancelledError:
             logger.info(f"Recording loop cancelled for entry {entry_id}")
@@ -98,6 +126,32 @@ class ScreenRecordingScheduler:
         """Get all active recorders"""
         return self.active_recorders.copy()
 
+    def get_backlog(self) -> int:
+        """Number of entries whose recording is overdue or still starting"""
+        now = time.monotonic()
+        return sum(
+            1 for info in self.active_recorders.values()
+            if info["in_callback"] or (info["next_fire_at"] is not None and info["next_fire_at"] <= now)
+        )
+
+    def get_lag_report(self, limit: int = 20) -> List[Dict]:
+        """Entries with the worst firing lag, worst first"""
+        report = [
+            {
+                "entry_id": entry_id,
+                "user_id": info["user_id"],
+                "company_id": info["company_id"],
+                "fires": info["fires"],
+                "failures": info["failures"],
+                "last_lag": round(info["last_lag"], 3),
+                "max_lag": round(info["max_lag"], 3),
+                "in_callback": info["in_callback"]
+            }
+            for entry_id, info in self.active_recorders.items()
+        ]
+        report.sort(key=lambda item: item["max_lag"], reverse=True)
+        return report[:limit]
+
     def is_recorder_active(self, entry_id: str) -> bool:
         """Check if a recorder is active for an entry"""
         return entry_id in self.active_recorders
@@ -4,10 +4,13 @@ Manages automatic screenshot capture for active time entries with random interva
 """
 import asyncio
 import random
+import time
 from datetime import datetime, timezone
-from typing import Dict, Set
+from typing import Dict, List, Set
 import logging
 
+from utils.metrics import SchedulerMetrics
+
 logger = logging.getLogger(__name__)
 
 
@@ -18,6 +21,8 @@ class ScreenshotScheduler:
         self.active_timers: Dict[str, Dict] = {}  # entry_id -> timer_info
         self.tasks: Dict[str, asyncio.Task] = {}  # entry_id -> async task
         self.screenshot_callback = None
+        self.metrics = SchedulerMetrics("screenshot")
+        self.metrics.bind(lambda: len(self.active_timers), self.get_backlog)
 
     def set_screenshot_callback(self, callback):
         """Set the callback function to capture screenshots"""
@@ -41,7 +46,13 @@ class ScreenshotScheduler:
             "user_id": user_id,
             "company_id": company_id,
             "interval": interval,
-            "started_at": datetime.now(timezone.utc)
+            "started_at": datetime.now(timezone.utc),
+            "next_fire_at": None,  # monotonic time of the next scheduled capture
+            "in_callback": False,
+            "fires": 0,
+            "failures": 0,
+            "last_lag": 0.0,
+            "max_lag": 0.0
         }
 
         # Start the screenshot capture task
@@ -77,19 +88,36 @@ class ScreenshotScheduler:
                 logger.info(f"Next screenshot for entry {entry_id} in {random_interval}s")
 
                 # Wait for the random interval
+                scheduled_at = time.monotonic() + random_interval
+                self.active_timers[entry_id]["next_fire_at"] = scheduled_at
                 await asyncio.sleep(random_interval)
 
                 # Check if timer is still active
-                if entry_id not in self.active_timers:
+                timer_info = self.active_timers.get(entry_id)
+                if timer_info is None:
                     break
 
+                lag = max(time.monotonic() - scheduled_at, 0.0)
+                self.metrics.observe_lag(lag)
+                timer_info["fires"] += 1
+                timer_info["last_lag"] = lag
+                timer_info["max_lag"] = max(timer_info["max_lag"], lag)
+
                 # Trigger screenshot capture
                 if self.screenshot_callback:
+                    timer_info["in_callback"] = True
+                    callback_started = time.monotonic()
+                    failed = False
                     try:
                         await self.screenshot_callback(entry_id, user_id, company_id)
                         logger.info(f"Screenshot captured for entry {entry_id} after {random_interval}s wait")
                     except Exception as e:
+                        failed = True
+                        timer_info["failures"] += 1
                         logger.error(f"Error capturing screenshot for entry {entry_id}: {e}")
+                    finally:
+                        timer_info["in_callback"] = False
+                        self.metrics.observe_callback(time.monotonic() - callback_started, failed)
 
         except asyncio.CancelledError:
             logger.info(f"Screenshot loop cancelled for entry {entry_id}")
@@ -100,6 +128,32 @@ class ScreenshotScheduler:
         """Get all active timers"""
         return self.active_timers.copy()
 
+    def get_backlog(self) -> int:
+        """Number of entries whose capture is overdue or still running"""
+        now = time.monotonic()
+        return sum(
+            1 for info in self.active_timers.values()
+            if info["in_callback"] or (info["next_fire_at"] is not None and info["next_fire_at"] <= now)
+        )
+
+    def get_lag_report(self, limit: int = 20) -> List[Dict]:
+        """Entries with the worst firing lag, worst first"""
+        report = [
+            {
+                "entry_id": entry_id,
+                "user_id": info["user_id"],
+                "company_id": info["company_id"],
+                "fires": info["fires"],
+                "failures": info["failures"],
+                "last_lag": round(info["last_lag"], 3),
+                "max_lag": round(info["max_lag"], 3),
+                "in_callback": info["in_callback"]
+            }
+            for entry_id, info in self.active_timers.items()
+        ]
+        report.sort(key=lambda item: item["max_lag"], reverse=True)
+        return report[:limit]
+
     def is_timer_active(self, entry_id: str) -> bool:
         """Check if a timer is active for an entry"""
         return entry_id in self.active_timers
@@ -0,0 +1,421 @@
+"""
+Storage Backends
+Pluggable blob storage for screenshots: S3-compatible buckets or a local content-addressed filesystem
+"""
+import asyncio
+import hashlib
+import hmac
+import io
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+import time
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+LOCAL_STORAGE_ROOT = os.environ.get('LOCAL_STORAGE_ROOT', os.path.join(os.getcwd(), 'storage'))
+LOCAL_URL_TTL = int(os.environ.get('SIGNED_URL_TTL', 3600))
+COPY_CHUNK_SIZE = 1024 * 1024
+S3_DELETE_BATCH = 1000  # delete_objects accepts at most 1000 keys per call
+
+EXTENSIONS = {
+    'image/png': 'png',
+    'image/jpeg': 'jpg',
+    'image/webp': 'webp',
+    'video/mp4': 'mp4',
+    'video/webm': 'webm'
+}
+
+
+def _chunks(items: List, size: int):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class StorageBackend:
+    """Common interface of the blob storage backends"""
+    storage_type = ""
+
+    async def save_file(self, fileobj: BinaryIO, key: str, content_type: str,
+                        metadata: Optional[Dict] = None) -> str:
+        """Store the contents of `fileobj` and return the key it was stored under"""
+        raise NotImplementedError
+
+    async def save_bytes(self, data: bytes, key: str, content_type: str,
+                         metadata: Optional[Dict] = None) -> str:
+        return await self.save_file(io.BytesIO(data), key, content_type, metadata)
+
+    async def read_bytes(self, key: str) -> bytes:
+        raise NotImplementedError
+
+    async def read_to_file(self, key: str, path: str):
+        """Copy an object to a local file without holding it in memory"""
+        raise NotImplementedError
+
+    async def delete_many(self, keys: Iterable[str]) -> int:
+        """Delete objects in bulk; returns how many keys were submitted"""
+        raise NotImplementedError
+
+    async def delete(self, key: str):
+        await self.delete_many([key])
+
+    def signed_url(self, key: str) -> Tuple[str, float]:
+        """Time-limited download URL and its expiry as a unix timestamp"""
+        raise NotImplementedError
+
+    def reference(self, key: str) -> str:
+        """Stable, non-expiring reference persisted instead of a signed URL"""
+        raise NotImplementedError
+
+    async def status(self) -> Dict:
+        raise NotImplementedError
+
+    # Resumable multipart uploads: begin, write parts in any order, then finish or abort
+
+    async def begin_upload(self, key: str, content_type: str) -> str:
+        """Start a multipart upload and return its handle"""
+        raise NotImplementedError
+
+    async def write_part(self, key: str, handle: str, part_number: int, offset: int, data: bytes) -> str:
+        """Store one part (rewriting it if sent again) and return its ETag"""
+        raise NotImplementedError
+
+    async def finish_upload(self, key: str, handle: str, parts: List[Dict], content_type: str) -> str:
+        """Assemble the parts into one object and return the key it was stored under"""
+        raise NotImplementedError
+
+    async def abort_upload(self, key: str, handle: str):
+        raise NotImplementedError
+
+
+class S3StorageBackend(StorageBackend):
+    """Objects in an S3-compatible bucket under caller-chosen keys"""
+    storage_type = "s3"
+
+    def __init__(self, s3_client):
+        self.client = s3_client
+
+    async def save_file(self, fileobj, key, content_type, metadata=None):
+        from utils.s3_client import get_bucket_name, run_s3
+
+        # upload_fileobj reads the file in parts instead of loading it whole
+        await run_s3(
+            self.client.upload_fileobj, fileobj, get_bucket_name(), key,
+            ExtraArgs={'ContentType': content_type, 'Metadata': metadata or {}}
+        )
+        return key
+
+    async def read_bytes(self, key):
+        from utils.s3_client import get_bucket_name, run_s3
+
+        response = await run_s3(self.client.get_object, Bucket=get_bucket_name(), Key=key)
+        return await run_s3(response["Body"].read)
+
+    async def read_to_file(self, key, path):
+        from utils.s3_client import get_bucket_name, run_s3
+
+        # download_file streams the object in parts
+        await run_s3(self.client.download_file, get_bucket_name(), key, path)
+
+    async def delete_many(self, keys):
+        from utils.s3_client import get_bucket_name, run_s3, signed_url_cache
+
+        keys = [key for key in dict.fromkeys(keys) if key]
+        for batch in _chunks(keys, S3_DELETE_BATCH):
+            for key in batch:
+                signed_url_cache.invalidate(key)
+            response = await run_s3(
+                self.client.delete_objects,
+                Bucket=get_bucket_name(),
+                Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True}
+            )
+            for error in response.get("Errors", []):
+                logger.error(f"Failed to delete object {error.get('Key')}: {error.get('Code')}")
+        return len(keys)
+
+    def signed_url(self, key):
+        from utils.s3_client import signed_url_cache
+
+        return signed_url_cache.get(self.client, key)
+
+    def reference(self, key):
+        from utils.s3_client import storage_reference
+
+        return storage_reference(key)
+
+    async def begin_upload(self, key, content_type):
+        from utils.s3_client import get_bucket_name, run_s3
+
+        response = await run_s3(
+            self.client.create_multipart_upload,
+            Bucket=get_bucket_name(), Key=key, ContentType=content_type
+        )
+        return response["UploadId"]
+
+    async def write_part(self, key, handle, part_number, offset, data):
+        from utils.s3_client import get_bucket_name, run_s3
+
+        response = await run_s3(
+            self.client.upload_part,
+            Bucket=get_bucket_name(), Key=key, UploadId=handle, PartNumber=part_number, Body=data
+        )
+        return response["ETag"]
+
+    async def finish_upload(self, key, handle, parts, content_type):
+        from utils.s3_client import get_bucket_name, run_s3
+
+        await run_s3(
+            self.client.complete_multipart_upload,
+            Bucket=get_bucket_name(), Key=key, UploadId=handle,
+            MultipartUpload={"Parts": [
+                {"PartNumber": part["part_number"], "ETag": part["etag"]}
+                for part in sorted(parts, key=lambda part: part["part_number"])
+            ]}
+        )
+        return key
+
+    async def abort_upload(self, key, handle):
+        from utils.s3_client import get_bucket_name, run_s3
+
+        await run_s3(self.client.abort_multipart_upload, Bucket=get_bucket_name(), Key=key, UploadId=handle)
+
+    async def status(self):
+        from botocore.exceptions import ClientError
+        from utils.s3_client import get_bucket_name, run_s3
+
+        bucket_name = get_bucket_name()
+        try:
+            await run_s3(self.client.head_bucket, Bucket=bucket_name)
+            return {
+                "configured": True,
+                "accessible": True,
+                "backend": self.storage_type,
+                "bucket": bucket_name,
+                "endpoint": os.environ.get('S3_ENDPOINT_URL')
+            }
+        except ClientError as e:
+            error_code = e.response.get('Error', {}).get('Code', 'Unknown')
+            return {
+                "configured": True,
+                "accessible": False,
+                "backend": self.storage_type,
+                "error": error_code,
+                "message": f"Cannot access bucket: {error_code}"
+            }
+
+
+class LocalStorageBackend(StorageBackend):
+    """
+    Content-addressed blobs on the local filesystem
+
+    A blob's key is its SHA-256, sharded two levels deep
+    (`ab/cd/abcd...ef.png`), so identical content is stored once and keys
+    never need to be chosen by callers. Writes go to a temporary file in the
+    same filesystem and are renamed into place, so readers never see partial
+    blobs. Multipart uploads are staged in one sparse file per upload under
+    `.uploads`, with each part written at its byte offset.
+    """
+    storage_type = "local"
+    KEY_PATTERN = re.compile(r"^[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64})(\.[a-z0-9]+)?$")
+
+    def __init__(self, root: str, secret: str):
+        self.root = os.path.abspath(root)
+        self.tmp_dir = os.path.join(self.root, ".tmp")
+        self.uploads_dir = os.path.join(self.root, ".uploads")
+        self.secret = secret.encode()
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        os.makedirs(self.uploads_dir, exist_ok=True)
+
+    def path_for(self, key: str) -> Optional[str]:
+        """Filesystem path of a key, or None when the key is not a valid blob key"""
+        if not self.KEY_PATTERN.match(key or ""):
+            return None
+        return os.path.join(self.root, key)
+
+    @classmethod
+    def etag_for(cls, key: str) -> str:
+        return f'"{cls.KEY_PATTERN.match(key).group(1)}"'
+
+    def _write(self, fileobj: BinaryIO, content_type: str) -> str:
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                while True:
+                    chunk = fileobj.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    tmp.write(chunk)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            return self._commit(tmp_path, digest.hexdigest(), content_type)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def _commit(self, tmp_path: str, checksum: str, content_type: str) -> str:
+        """Move a fully written file into place under its content-addressed key"""
+        extension = EXTENSIONS.get(content_type) or (mimetypes.guess_extension(content_type) or ".bin").lstrip(".")
+        key = f"{checksum[:2]}/{checksum[2:4]}/{checksum}.{extension}"
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.unlink(tmp_path)  # same content is already stored
+        else:
+            os.replace(tmp_path, path)
+        return key
+
+    async def save_file(self, fileobj, key, content_type, metadata=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._write, fileobj, content_type)
+
+    async def read_bytes(self, key):
+        path = self.path_for(key)
+        if not path:
+            raise FileNotFoundError(key)
+
+        def read():
+            with open(path, "rb") as f:
+                return f.read()
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, read)
+
+    async def read_to_file(self, key, path):
+        source = self.path_for(key)
+        if not source:
+            raise FileNotFoundError(key)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, shutil.copyfile, source, path)
+
+    async def delete_many(self, keys):
+        paths = [path for path in (self.path_for(key) for key in dict.fromkeys(keys)) if path]
+
+        def unlink_all():
+            for path in paths:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, unlink_all)
+        return len(paths)
+
+    def _staging_path(self, handle: str) -> str:
+        if not re.fullmatch(r"[0-9a-f]{32}", handle or ""):
+            raise ValueError(f"Invalid upload handle: {handle}")
+        return os.path.join(self.uploads_dir, handle)
+
+    async def begin_upload(self, key, content_type):
+        handle = os.urandom(16).hex()
+        open(self._staging_path(handle), "wb").close()
+        return handle
+
+    async def write_part(self, key, handle, part_number, offset, data):
+        path = self._staging_path(handle)
+
+        def write():
+            with open(path, "r+b") as f:
+                f.seek(offset)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, write)
+        return f'"{hashlib.md5(data).hexdigest()}"'
+
+    async def finish_upload(self, key, handle, parts, content_type):
+        path = self._staging_path(handle)
+
+        def assemble():
+            # Parts were fsynced as they arrived; hash the staged file and rename it into place
+            digest = hashlib.sha256()
+            with open(path, "rb") as staged:
+                while True:
+                    chunk = staged.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+            return self._commit(path, digest.hexdigest(), content_type)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, assemble)
+
+    async def abort_upload(self, key, handle):
+        try:
+            os.unlink(self._staging_path(handle))
+        except FileNotFoundError:
+            pass
+
+    def _signature(self, key: str, expires: int) -> str:
+        return hmac.new(self.secret, f"{key}:{expires}".encode(), hashlib.sha256).hexdigest()
+
+    def signed_url(self, key):
+        # Expiry is rounded up to a quarter of the TTL so URLs stay stable and cacheable
+        step = max(LOCAL_URL_TTL // 4, 1)
+        expires = int((time.time() + LOCAL_URL_TTL) // step * step + step)
+        return f"/api/storage/files/{key}?expires={expires}&signature={self._signature(key, expires)}", expires
+
+    def verify_signature(self, key: str, expires: int, signature: str) -> bool:
+        if expires < time.time():
+            return False
+        return hmac.compare_digest(self._signature(key, expires), signature)
+
+    def reference(self, key):
+        return f"local://{key}"
+
+    async def status(self):
+        writable = os.access(self.root, os.W_OK)
+        return {
+            "configured": True,
+            "accessible": writable,
+            "backend": self.storage_type,
+            "root": self.root
+        }
+
+
+_local_backend: Optional[LocalStorageBackend] = None
+
+
+def get_local_storage() -> LocalStorageBackend:
+    global _local_backend
+    if _local_backend is None:
+        secret = os.environ.get('STORAGE_SIGNING_SECRET') or os.environ.get('JWT_SECRET', 'workmonitor-secret-key-2024')
+        _local_backend = LocalStorageBackend(LOCAL_STORAGE_ROOT, secret)
+    return _local_backend
+
+
+def get_storage(storage_type: Optional[str] = None) -> Optional[StorageBackend]:
+    """
+    Storage backend for `storage_type` ('s3' or 'local'), or the configured
+    default when omitted: STORAGE_BACKEND, else S3 when configured, else local.
+    Returns None when the requested backend is not available.
+    """
+    from utils.s3_client import get_s3_client
+
+    storage_type = storage_type or os.environ.get('STORAGE_BACKEND')
+    if storage_type is None:
+        storage_type = "s3" if get_s3_client() else "local"
+
+    if storage_type == "s3":
+        s3_client = get_s3_client()
+        return S3StorageBackend(s3_client) if s3_client else None
+    if storage_type == "local":
+        return get_local_storage()
+    return None
+
+
+def signed_url_for(storage_type: Optional[str], key: Optional[str]) -> Optional[str]:
+    """Download URL for a stored object, or None when it cannot be served"""
+    if not key:
+        return None
+    storage = get_storage(storage_type) if storage_type in ("s3", "local") else None
+    return storage.signed_url(key)[0] if storage else None
@@ -0,0 +1,442 @@
+"""
+Scheduled Timer Engine
+Executes scheduled timers by auto-starting and auto-stopping time entries
+"""
+import asyncio
+import heapq
+import itertools
+import calendar
+from datetime import datetime, timezone, timedelta, date, time
+from typing import Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import os
+import logging
+
+from utils.id_generator import generate_entry_id, generate_id
+
+logger = logging.getLogger(__name__)
+
+ACTION_START = "start"
+ACTION_STOP = "stop"
+
+# Upper bound on how far ahead to search for the next occurrence of a schedule
+MAX_LOOKAHEAD_DAYS = 400
+
+# How often each worker reloads schedules changed through other workers
+SCHEDULE_RELOAD_INTERVAL = int(os.environ.get('TIMER_SCHEDULE_RELOAD_INTERVAL', 300))
+
+
+def parse_schedule_time(value) -> Optional[time]:
+    """Parse an HH:MM or HH:MM:SS string (or a time object) into a time"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, time):
+        return value.replace(tzinfo=None)
+    parts = [int(p) for p in str(value).split(":")]
+    while len(parts) < 3:
+        parts.append(0)
+    return time(parts[0], parts[1], parts[2])
+
+
+def resolve_timezone(name: Optional[str]) -> ZoneInfo:
+    """Get the IANA timezone for a schedule, falling back to UTC"""
+    try:
+        return ZoneInfo(name or "UTC")
+    except (ZoneInfoNotFoundError, ValueError):
+        logger.warning(f"Unknown timezone {name!r}, falling back to UTC")
+        return ZoneInfo("UTC")
+
+
+def local_to_utc(local_date: date, local_time: time, tz: ZoneInfo) -> datetime:
+    """
+    Resolve a wall-clock time in a timezone to a UTC instant
+
+    Ambiguous times (DST fall-back) resolve to the first occurrence. Times
+    that do not exist (DST spring-forward gap) are shifted forward by the
+    length of the gap, so a 02:30 schedule fires at 03:30 on that day.
+    """
+    local = datetime.combine(local_date, local_time).replace(tzinfo=tz, fold=0)
+    return local.astimezone(timezone.utc)
+
+
+def _parse_datetime(value) -> Optional[datetime]:
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        parsed = value
+    else:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def _runs_on(schedule: Dict, day: date, anchor: date) -> bool:
+    """Check whether a schedule has an occurrence on a local calendar day"""
+    schedule_type = schedule.get("schedule_type") or "daily"
+    days_of_week = schedule.get("days_of_week") or []
+
+    if day < anchor:
+        return False
+    if schedule_type == "daily":
+        return not days_of_week or day.weekday() in days_of_week
+    if schedule_type == "weekly":
+        return day.weekday() in (days_of_week or [anchor.weekday()])
+    if schedule_type == "monthly":
+        # Same day of month as the schedule was created, clamped to short months
+        last_day = calendar.monthrange(day.year, day.month)[1]
+        return day.day == min(anchor.day, last_day)
+    if schedule_type == "once":
+        return True
+    return False
+
+
+def next_fire_time(schedule: Dict, action: str, after: datetime) -> Optional[datetime]:
+    """
+    Compute the next UTC instant strictly after `after` at which a schedule
+    should start (or stop) a timer, or None if it never fires again
+    """
+    start_at = parse_schedule_time(schedule.get("start_time"))
+    end_at = parse_schedule_time(schedule.get("end_time"))
+    if start_at is None or (action == ACTION_STOP and end_at is None):
+        return None
+
+    tz = resolve_timezone(schedule.get("timezone"))
+    created_at = _parse_datetime(schedule.get("created_at")) or after
+    anchor = created_at.astimezone(tz).date()
+
+    # Shifts ending at or before their start time finish on the next day
+    overnight = end_at is not None and end_at <= start_at
+
+    def occurrence(day: date) -> datetime:
+        if action == ACTION_START:
+            return local_to_utc(day, start_at, tz)
+        return local_to_utc(day + timedelta(days=1) if overnight else day, end_at, tz)
+
+    first_day = after.astimezone(tz).date() - timedelta(days=1)
+    if schedule.get("schedule_type") == "once":
+        # Only the first start after creation counts, and its matching stop
+        for offset in range(2):
+            day = anchor + timedelta(days=offset)
+            if local_to_utc(day, start_at, tz) > created_at:
+                candidate = occurrence(day)
+                return candidate if candidate > after else None
+        return None
+
+    for offset in range(MAX_LOOKAHEAD_DAYS):
+        day = first_day + timedelta(days=offset)
+        if not _runs_on(schedule, day, anchor):
+            continue
+        candidate = occurrence(day)
+        if candidate > after:
+            return candidate
+    return None
+
+
+class ScheduledTimerEngine:
+    """
+    Fires scheduled timers from a priority queue in per-minute batches
+
+    Every worker runs the engine. Each fire is claimed first with a
+    `timer_execution_log` row, unique per schedule, instant and action, so
+    only the worker whose claim is stored starts or stops the timer. Due
+    schedules are re-read before firing, and all active schedules every
+    `reload_interval` seconds, so changes made through another worker are
+    picked up.
+    """
+
+    def __init__(self, batch_size: int = 500, reload_interval: int = SCHEDULE_RELOAD_INTERVAL):
+        self.db = None
+        self.batch_size = batch_size
+        self.reload_interval = reload_interval
+        self.schedules: Dict[str, Dict] = {}  # schedule_id -> schedule doc
+        self._queue: List[Tuple[datetime, int, str, str, int]] = []
+        self._versions: Dict[str, int] = {}  # schedule_id -> current version
+        self._sequence = itertools.count()
+        self._task: Optional[asyncio.Task] = None
+        self.start_callback = None
+        self.stop_callback = None
+
+    def set_start_callback(self, callback):
+        """Set the callback invoked with the list of time entries auto-started in a batch"""
+        self.start_callback = callback
+
+    def set_stop_callback(self, callback):
+        """Set the callback invoked with the list of time entries auto-stopped in a batch"""
+        self.stop_callback = callback
+
+    async def start(self, db):
+        """Load active schedules and start the minute-boundary loop"""
+        if self._task:
+            return
+        self.db = db
+        now = datetime.now(timezone.utc)
+        for schedule in await self._load_active():
+            self.upsert_schedule(schedule, now=now)
+        self._task = asyncio.create_task(self._run_loop())
+        logger.info(f"Scheduled timer engine started with {len(self.schedules)} schedules")
+
+    async def stop(self):
+        """Stop the engine loop"""
+        if not self._task:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        logger.info("Scheduled timer engine stopped")
+
+    def upsert_schedule(self, schedule: Dict, now: Optional[datetime] = None):
+        """Add or replace a schedule and queue its next start/stop instants"""
+        schedule_id = schedule["schedule_id"]
+        version = self._versions.get(schedule_id, 0) + 1
+        self._versions[schedule_id] = version
+
+        if not schedule.get("is_active", True):
+            self.schedules.pop(schedule_id, None)
+            return
+
+        self.schedules[schedule_id] = schedule
+        now = now or datetime.now(timezone.utc)
+        if schedule.get("auto_start_enabled", True):
+            self._push(schedule, ACTION_START, now, version)
+        if schedule.get("auto_stop_enabled") and schedule.get("end_time"):
+            self._push(schedule, ACTION_STOP, now, version)
+
+    def remove_schedule(self, schedule_id: str):
+        """Remove a schedule; its queued instants are discarded lazily"""
+        self._versions[schedule_id] = self._versions.get(schedule_id, 0) + 1
+        self.schedules.pop(schedule_id, None)
+
+    async def reload(self, now: Optional[datetime] = None):
+        """
+        Re-read the active schedules and requeue those created or changed
+        since they were loaded; deactivated ones are dropped when they next fire
+        """
+        now = now or datetime.now(timezone.utc)
+        for schedule in await self._load_active():
+            if self.schedules.get(schedule["schedule_id"]) != schedule:
+                self.upsert_schedule(schedule, now=now)
+
+    async def _load_active(self) -> List[Dict]:
+        schedules: List[Dict] = []
+        page_size = 1000
+        while True:
+            rows = await self.db.scheduled_timers.find(
+                {"is_active": True}, sort=[("schedule_id", 1)], limit=page_size, skip=len(schedules)
+            )
+            schedules.extend(rows)
+            if len(rows) < page_size:
+                return schedules
+
+    def get_upcoming(self, limit: int = 50) -> List[Dict]:
+        """Get the next queued fire instants"""
+        upcoming = []
+        for fire_at, _, schedule_id, action, version in heapq.nsmallest(limit * 2, self._queue):
+            if self._versions.get(schedule_id) != version:
+                continue
+            upcoming.append({"schedule_id": schedule_id, "action": action, "fire_at": fire_at.isoformat()})
+            if len(upcoming) >= limit:
+                break
+        return upcoming
+
+    def _push(self, schedule: Dict, action: str, after: datetime, version: int):
+        try:
+            fire_at = next_fire_time(schedule, action, after)
+        except (TypeError, ValueError) as e:
+            logger.error(f"Invalid schedule {schedule.get('schedule_id')}: {e}")
+            return
+        if fire_at is not None:
+            heapq.heappush(self._queue, (fire_at, next(self._sequence), schedule["schedule_id"], action, version))
+
+    def _pop_due(self, now: datetime) -> Dict[str, List[Tuple[Dict, datetime]]]:
+        due = {ACTION_START: [], ACTION_STOP: []}
+        while self._queue and self._queue[0][0] <= now:
+            fire_at, _, schedule_id, action, version = heapq.heappop(self._queue)
+            if self._versions.get(schedule_id) != version:
+                continue  # schedule was updated or removed since this was queued
+            schedule = self.schedules.get(schedule_id)
+            if not schedule:
+                continue
+            due[action].append((schedule, fire_at))
+            self._push(schedule, action, fire_at, version)
+        return due
+
+    async def _run_loop(self):
+        """Wake at each minute boundary and fire everything that is due"""
+        loop = asyncio.get_running_loop()
+        reloaded_at = loop.time()
+        try:
+            while True:
+                now = datetime.now(timezone.utc)
+                next_minute = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+                await asyncio.sleep((next_minute - now).total_seconds())
+                now = datetime.now(timezone.utc)
+                try:
+                    await self.run_due(now)
+                except Exception as e:
+                    logger.error(f"Error running scheduled timers: {e}")
+                if loop.time() - reloaded_at >= self.reload_interval:
+                    reloaded_at = loop.time()
+                    try:
+                        # Queued from `now`, so no instant between the two calls is skipped
+                        await self.reload(now)
+                    except Exception as e:
+                        logger.error(f"Error reloading scheduled timers: {e}")
+        except asyncio.CancelledError:
+            logger.info("Scheduled timer loop cancelled")
+
+    async def run_due(self, now: datetime) -> Dict[str, int]:
+        """Execute all start/stop instants due at or before `now`"""
+        due = self._pop_due(now)
+        started = stopped = 0
+        for i in range(0, len(due[ACTION_START]), self.batch_size):
+            batch = await self._claim(due[ACTION_START][i:i + self.batch_size], ACTION_START, now)
+            started += await self._start_entries(batch, now)
+        for i in range(0, len(due[ACTION_STOP]), self.batch_size):
+            batch = await self._claim(due[ACTION_STOP][i:i + self.batch_size], ACTION_STOP, now)
+            stopped += await self._stop_entries(batch, now)
+        if started or stopped:
+            logger.info(f"Scheduled timers fired: {started} started, {stopped} stopped")
+        return {"started": started, "stopped": stopped}
+
+    async def _claim(self, batch: List[Tuple[Dict, datetime]], action: str,
+                     now: datetime) -> List[Tuple[Dict, datetime, Dict]]:
+        """
+        Claim the fires of `batch` that are still current in the database;
+        returns (schedule, instant, execution log row) for the fires this worker
+        claimed, leaving out those another worker claimed first
+        """
+        if not batch:
+            return []
+        current = await self.db.scheduled_timers.find(
+            {"schedule_id": {"$in": list({schedule["schedule_id"] for schedule, _ in batch})}, "is_active": True}
+        )
+        current = {schedule["schedule_id"]: schedule for schedule in current}
+
+        claims = {}
+        for schedule, fire_at in batch:
+            fresh = current.get(schedule["schedule_id"])
+            if fresh is None:
+                # Deactivated or deleted through another worker
+                self.remove_schedule(schedule["schedule_id"])
+                continue
+            if fresh != schedule:
+                self.upsert_schedule(fresh, now=now)
+                if next_fire_time(fresh, action, fire_at - timedelta(seconds=1)) != fire_at:
+                    continue
+            execution = {
+                "execution_id": generate_id("execution"),
+                "schedule_id": fresh["schedule_id"],
+                "employee_id": fresh["employee_id"],
+                "action": action,
+                "scheduled_time": fire_at.isoformat(),
+                "status": "pending",
+                "created_at": now.isoformat()
+            }
+            claims[execution["execution_id"]] = (fresh, fire_at, execution)
+        if not claims:
+            return []
+
+        result = await self.db.timer_execution_log.upsert_many(
+            [execution for _, _, execution in claims.values()],
+            on_conflict="schedule_id,scheduled_time,action",
+            ignore_duplicates=True
+        )
+        return [claims[row["execution_id"]] for row in result["upserted"] if row["execution_id"] in claims]
+
+    async def _start_entries(self, batch: List[Tuple[Dict, datetime, Dict]], now: datetime) -> int:
+        if not batch:
+            return 0
+        employee_ids = list({schedule["employee_id"] for schedule, _, _ in batch})
+        running = await self.db.time_entries.find(
+            {"user_id": {"$in": employee_ids}, "status": "active"}
+        )
+        busy = {entry["user_id"] for entry in running}
+
+        entries = []
+        executions = []
+        for schedule, fire_at, execution in batch:
+            execution["executed_at"] = now.isoformat()
+            if schedule["employee_id"] in busy:
+                execution.update({"status": "skipped", "error_message": "Employee already has an active timer"})
+                executions.append(execution)
+                continue
+
+            busy.add(schedule["employee_id"])
+            entry_id = generate_entry_id()
+            entries.append({
+                "entry_id": entry_id,
+                "user_id": schedule["employee_id"],
+                "company_id": schedule["company_id"],
+                "schedule_id": schedule["schedule_id"],
+                "start_time": fire_at.isoformat(),
+                "end_time": None,
+                "duration": 0,
+                "idle_time": 0,
+                "source": "scheduled",
+                "status": "active",
+                "notes": schedule.get("notes"),
+                "project_id": schedule.get("project_id"),
+                "created_at": now.isoformat()
+            })
+            execution.update({"status": "executed", "time_entry_id": entry_id})
+            executions.append(execution)
+
+        if entries:
+            await self.db.time_entries.insert_many(entries)
+        if executions:
+            await self.db.timer_execution_log.upsert_many(executions, on_conflict="execution_id")
+
+        if entries and self.start_callback:
+            try:
+                await self.start_callback(entries)
+            except Exception as e:
+                logger.error(f"Error in scheduled timer start callback: {e}")
+        return len(entries)
+
+    async def _stop_entries(self, batch: List[Tuple[Dict, datetime, Dict]], now: datetime) -> int:
+        if not batch:
+            return 0
+        claims = {schedule["schedule_id"]: (fire_at, execution) for schedule, fire_at, execution in batch}
+        running = await self.db.time_entries.find(
+            {"schedule_id": {"$in": list(claims)}, "status": "active"}
+        )
+
+        stopped = []
+        for entry in running:
+            end_time, execution = claims[entry["schedule_id"]]
+            start_time = _parse_datetime(entry["start_time"])
+            if end_time <= start_time:
+                continue  # started manually after the scheduled stop instant
+            stopped.append({
+                **entry,
+                "end_time": end_time.isoformat(),
+                "duration": int((end_time - start_time).total_seconds()),
+                "status": "completed",
+                "updated_at": now.isoformat()
+            })
+            execution.update({"status": "executed", "time_entry_id": entry["entry_id"]})
+
+        for _, execution in claims.values():
+            execution["executed_at"] = now.isoformat()
+            if execution["status"] == "pending":
+                execution.update({"status": "skipped", "error_message": "No scheduled timer running"})
+
+        if stopped:
+            await self.db.time_entries.upsert_many(stopped, on_conflict="entry_id")
+        await self.db.timer_execution_log.upsert_many(
+            [execution for _, execution in claims.values()], on_conflict="execution_id"
+        )
+        if stopped and self.stop_callback:
+            try:
+                await self.stop_callback(stopped)
+            except Exception as e:
+                logger.error(f"Error in scheduled timer stop callback: {e}")
+        return len(stopped)
+
+
+# Global engine instance
+timer_schedule_engine = ScheduledTimerEngine()
@@ -0,0 +1,207 @@
+"""
+Timesheet Batch
+Company-wide weekly timesheet generation, on demand and at each company's week rollover
+"""
+import asyncio
+import os
+from datetime import date, datetime, timezone, timedelta
+from typing import Dict, List, Optional, Tuple
+import logging
+
+from utils.job_runs import JobLease
+from utils.metrics import registry
+from utils.response_cache import data_versions
+from utils.timer_schedule_engine import resolve_timezone
+
+logger = logging.getLogger(__name__)
+
+# How often companies are checked for a week rollover
+TIMESHEET_BATCH_INTERVAL = int(os.environ.get('TIMESHEET_BATCH_INTERVAL', 3600))
+TIMESHEET_BATCH_JOB = "timesheet_batch"
+# `job_runs` rows of this job, one per company, record the local week start when its previous week was closed
+WEEK_CLOSED_JOB = "timesheet_week_closed"
+
+
+def week_start_of(day: date) -> date:
+    """Monday of the week containing `day`"""
+    return day - timedelta(days=day.weekday())
+
+
+def local_week_start(company: Optional[Dict]) -> date:
+    """Monday of the current week in the company's timezone"""
+    tz = resolve_timezone((company or {}).get("timezone"))
+    return week_start_of(datetime.now(tz).date())
+
+
+async def generate_timesheets(db, company_id: str, week_start: date, user_id: Optional[str] = None) -> Dict:
+    """Build and upsert a week's timesheets for the company (or one user) in one database call"""
+    rows = await db.rpc("generate_timesheets", {
+        "p_company_id": company_id,
+        "p_week_start": week_start.isoformat(),
+        "p_user_id": user_id
+    })
+    result = rows[0] if rows else {}
+    if result.get("written"):
+        # The upsert bypasses the collection write listeners
+        await data_versions.bump(company_id, "timesheets")
+    return {
+        "employees": result.get("employees") or 0,
+        "written": result.get("written") or 0,
+        "approved_kept": result.get("approved_kept") or 0,
+        "hours_written": float(result.get("hours_written") or 0)
+    }
+
+
+class TimesheetBatchEngine:
+    """
+    Generates the timesheets of every employee of a company for a week
+
+    Each company is one `generate_timesheets` call: a single scan of the
+    week's time entries grouped by user and one bulk upsert, which leaves
+    approved timesheets untouched. Every `interval` seconds the engine
+    looks for companies whose local week has rolled over since their
+    previous week was closed and generates the week that just ended.
+    Admins can generate any week on demand.
+
+    Batches claim the `timesheet_batch` job in `job_runs`, so one runs at
+    a time across all workers and its progress is readable from any of
+    them; the week each company was last closed is kept there as well, so
+    restarts and other workers do not close a week again.
+    """
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._manual_tasks: set = set()
+
+        self.timesheets_written = registry.counter("timesheets_generated_total", "Timesheets written by batch generation")
+
+    async def start(self, db, interval: int = TIMESHEET_BATCH_INTERVAL):
+        if self._task:
+            return
+        self._task = asyncio.create_task(self._run_loop(db, interval))
+        logger.info(f"Timesheet batch engine started with interval {interval}s")
+
+    async def stop(self):
+        if not self._task:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        logger.info("Timesheet batch engine stopped")
+
+    async def trigger(self, db, company_id: str, week_start: date) -> bool:
+        """Generate a company's week in the background; returns False when a batch is already running on any worker"""
+        lease = JobLease(db, TIMESHEET_BATCH_JOB)
+        if not await lease.acquire():
+            return False
+        task = asyncio.create_task(self._run_and_release(db, lease, [(company_id, week_start)], company_id))
+        self._manual_tasks.add(task)
+        task.add_done_callback(self._manual_tasks.discard)
+        return True
+
+    async def _run_loop(self, db, interval: int):
+        try:
+            while True:
+                try:
+                    await self.close_weeks(db)
+                except Exception as e:
+                    logger.error(f"Error generating timesheets: {e}")
+                await asyncio.sleep(interval)
+        except asyncio.CancelledError:
+            logger.info("Timesheet batch loop cancelled")
+
+    async def close_weeks(self, db):
+        """Generate the week that just ended for every company whose local week rolled over"""
+        lease = JobLease(db, TIMESHEET_BATCH_JOB)
+        if not await lease.acquire():
+            logger.debug("Timesheet batch already running on another worker")
+            return
+        try:
+            closed = await self._closed_weeks(db)
+            companies = await db.companies.find({}, sort=[("company_id", 1)])
+            due = []
+            for company in companies:
+                current = local_week_start(company)
+                if closed.get(company["company_id"]) != current.isoformat():
+                    due.append((company["company_id"], current - timedelta(days=7)))
+            if not due:
+                return
+            await self.run(db, lease, due)
+            await db.job_runs.upsert_many([
+                {
+                    "job": WEEK_CLOSED_JOB,
+                    "scope": company_id,
+                    "progress": {"week_start": (week_start + timedelta(days=7)).isoformat()},
+                    "updated_at": datetime.now(timezone.utc).isoformat()
+                }
+                for company_id, week_start in due
+            ], on_conflict="job,scope")
+        finally:
+            await lease.release()
+
+    async def _closed_weeks(self, db) -> Dict[str, str]:
+        """Company -> local week start (ISO) when its previous week was closed, by any worker"""
+        closed: Dict[str, str] = {}
+        page_size = 1000
+        while True:
+            rows = await db.job_runs.find(
+                {"job": WEEK_CLOSED_JOB}, sort=[("scope", 1)], limit=page_size, skip=len(closed)
+            )
+            closed.update({row["scope"]: (row.get("progress") or {}).get("week_start") for row in rows})
+            if len(rows) < page_size:
+                return closed
+
+    async def _run_and_release(self, db, lease: JobLease, jobs: List[Tuple[str, date]], company_id: str):
+        try:
+            await self.run(db, lease, jobs, company_id)
+        finally:
+            await lease.release()
+
+    async def run(self, db, lease: JobLease, jobs: List[Tuple[str, date]], company_id: Optional[str] = None) -> Dict:
+        """
+        Generate each (company, week start) in `jobs` under an acquired `lease`
+        on the batch job; `company_id` marks an on-demand run
+        """
+        progress = {
+            "company_id": company_id,
+            "week_start": jobs[0][1].isoformat() if company_id else None,
+            "status": "running",
+            "companies_total": len(jobs),
+            "companies_done": 0,
+            "employees": 0,
+            "timesheets_written": 0,
+            "approved_kept": 0,
+            "started_at": datetime.now(timezone.utc).isoformat()
+        }
+        await lease.save_progress(progress)
+        try:
+            for job_company_id, week_start in jobs:
+                if not lease.held:
+                    raise RuntimeError("Lost the timesheet batch claim")
+                result = await generate_timesheets(db, job_company_id, week_start)
+                self.timesheets_written.inc(result["written"])
+                progress["employees"] += result["employees"]
+                progress["timesheets_written"] += result["written"]
+                progress["approved_kept"] += result["approved_kept"]
+                progress["companies_done"] += 1
+                await lease.save_progress(progress)
+            progress["status"] = "completed"
+        except Exception:
+            progress["status"] = "failed"
+            raise
+        finally:
+            progress["finished_at"] = datetime.now(timezone.utc).isoformat()
+            await lease.save_progress(progress)
+
+        logger.info(
+            f"Generated {progress['timesheets_written']} timesheets for "
+            f"{progress['companies_done']} companies ({progress['approved_kept']} approved kept)"
+        )
+        return progress
+
+
+# Global engine instance
+timesheet_batch_engine = TimesheetBatchEngine()
@@ -0,0 +1,398 @@
+"""
+Video Pipeline
+Post-upload processing of recordings and video screenshots: bitrate normalization,
+HLS segmenting and poster/keyframe thumbnails with a capped pool of ffmpeg processes
+"""
+import asyncio
+import glob
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional, Tuple
+import logging
+
+from utils.job_runs import JobLease, read_progress
+from utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+FFMPEG = os.environ.get('FFMPEG_PATH', 'ffmpeg')
+FFPROBE = os.environ.get('FFPROBE_PATH', 'ffprobe')
+VIDEO_PIPELINE_CONCURRENCY = int(os.environ.get('VIDEO_PIPELINE_CONCURRENCY', 2))
+VIDEO_PIPELINE_TIMEOUT = int(os.environ.get('VIDEO_PIPELINE_TIMEOUT', 300))
+HLS_SEGMENT_SECONDS = int(os.environ.get('HLS_SEGMENT_SECONDS', 2))
+KEYFRAME_THUMBNAILS = int(os.environ.get('VIDEO_KEYFRAME_THUMBNAILS', 6))
+# Videos left pending or processing (queue full, worker restarted) are queued again by a periodic sweep
+RECOVERY_INTERVAL = int(os.environ.get('VIDEO_PIPELINE_RECOVERY_INTERVAL', 300))
+RECOVERY_GRACE_SECONDS = 600  # leave recent uploads to the worker that queued them
+# A job still `processing` after this long belongs to a worker that stopped: three ffmpeg runs plus storage I/O
+RECOVERY_STALE_SECONDS = 4 * VIDEO_PIPELINE_TIMEOUT
+RECOVERY_WINDOW_HOURS = 24  # videos still unprocessed after this are left alone
+RECOVERY_JOB = "video_pipeline_recovery"
+
+# VideoScreenshotSettings.quality -> (video bitrate, max height)
+QUALITY_PROFILES = {
+    "low": ("500k", 480),
+    "medium": ("1200k", 720),
+    "high": ("2500k", 1080)
+}
+
+# Where each kind of video lives: table, primary key, duration column and upload time column
+VIDEO_KINDS = {
+    "recording": {
+        "table": "screen_recordings", "id_field": "recording_id",
+        "duration_field": "duration", "uploaded_field": "created_at"
+    },
+    "video": {
+        "table": "video_screenshots", "id_field": "video_id",
+        "duration_field": "duration_seconds", "uploaded_field": "uploaded_at"
+    }
+}
+
+
+class FFmpegError(Exception):
+    pass
+
+
+def transcode_args(source: str, out_dir: str, quality: str, include_audio: bool) -> List[str]:
+    """ffmpeg arguments that re-encode a clip at the quality's bitrate straight into HLS segments"""
+    bitrate, max_height = QUALITY_PROFILES.get(quality, QUALITY_PROFILES["medium"])
+    # Keyframe on every segment boundary so segments start cleanly
+    gop = f"expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})"
+    return [
+        FFMPEG, "-nostdin", "-y", "-v", "error", "-i", source,
+        "-vf", f"scale=-2:'min({max_height},ih)'",
+        "-c:v", "libx264", "-preset", "veryfast", "-profile:v", "main",
+        "-b:v", bitrate, "-maxrate", bitrate, "-bufsize", bitrate,
+        "-force_key_frames", gop, "-sc_threshold", "0",
+        *(["-c:a", "aac", "-b:a", "96k"] if include_audio else ["-an"]),
+        "-f", "hls", "-hls_time", str(HLS_SEGMENT_SECONDS), "-hls_playlist_type", "vod",
+        "-hls_segment_filename", os.path.join(out_dir, "segment_%04d.ts"),
+        os.path.join(out_dir, "index.m3u8")
+    ]
+
+
+def thumbnail_args(source: str, out_dir: str) -> List[str]:
+    """ffmpeg arguments that write a poster frame and up to KEYFRAME_THUMBNAILS keyframe thumbnails in one pass"""
+    return [
+        FFMPEG, "-nostdin", "-y", "-v", "error", "-skip_frame", "nokey", "-i", source,
+        "-filter_complex", "[0:v]split=2[p][k];[p]scale=640:-2[poster];[k]scale=320:-2[keys]",
+        "-map", "[poster]", "-frames:v", "1", "-q:v", "3", os.path.join(out_dir, "poster.jpg"),
+        "-map", "[keys]", "-fps_mode", "vfr", "-frames:v", str(KEYFRAME_THUMBNAILS), "-q:v", "5",
+        os.path.join(out_dir, "keyframe_%02d.jpg")
+    ]
+
+
+def parse_playlist(text: str) -> List[Tuple[str, float]]:
+    """(segment filename, duration) pairs of an HLS media playlist"""
+    segments = []
+    duration = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("#EXTINF:"):
+            duration = float(line[len("#EXTINF:"):].split(",", 1)[0])
+        elif line and not line.startswith("#") and duration is not None:
+            segments.append((line, duration))
+            duration = None
+    return segments
+
+
+def render_playlist(segments: List[Tuple[str, float]]) -> str:
+    """HLS VOD media playlist for (segment URL, duration) pairs"""
+    target = max((int(duration + 0.999) for _, duration in segments), default=HLS_SEGMENT_SECONDS)
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{target}",
+             "#EXT-X-MEDIA-SEQUENCE:0", "#EXT-X-PLAYLIST-TYPE:VOD"]
+    for url, duration in segments:
+        lines += [f"#EXTINF:{duration:.3f},", url]
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+class VideoPipeline:
+    """Queue of uploaded videos processed by at most VIDEO_PIPELINE_CONCURRENCY ffmpeg jobs at a time"""
+
+    def __init__(self, concurrency: int = VIDEO_PIPELINE_CONCURRENCY, queue_size: int = 1000):
+        self.concurrency = concurrency
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.consumers = []
+        self.recovery_task: Optional[asyncio.Task] = None
+        self._queued: set = set()
+        self.db = None
+        self.available = False
+
+        self.queue_depth = registry.gauge("video_pipeline_queue_depth", "Videos waiting for processing")
+        self.processed = registry.counter(
+            "video_pipeline_processed_total", "Videos processed by the video pipeline", ["result"]
+        )
+        self.duration = registry.histogram(
+            "video_pipeline_duration_seconds", "Time to process one video",
+            buckets=(1, 2.5, 5, 10, 20, 40, 80, 160, 320)
+        )
+        self.queue_depth.set_function(self.queue.qsize)
+
+    async def start(self, db):
+        """Start the queue consumers; each runs one ffmpeg job at a time"""
+        if self.consumers:
+            return
+        self.db = db
+        self.available = bool(shutil.which(FFMPEG) and shutil.which(FFPROBE))
+        if not self.available:
+            logger.warning("ffmpeg/ffprobe not found - uploaded videos will not be processed")
+            return
+        self.consumers = [asyncio.create_task(self._consume()) for _ in range(self.concurrency)]
+        self.recovery_task = asyncio.create_task(self._recovery_loop())
+        logger.info(f"Video pipeline started with {self.concurrency} concurrent ffmpeg jobs")
+
+    async def stop(self):
+        """Stop consuming; queued videos stay pending until a recovery sweep queues them again"""
+        tasks = self.consumers + ([self.recovery_task] if self.recovery_task else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.consumers = []
+        self.recovery_task = None
+        logger.info("Video pipeline stopped")
+
+    def enqueue(self, kind: str, item_id: str) -> bool:
+        """Queue an uploaded recording ("recording") or video screenshot ("video"); False when not queued"""
+        if not self.available:
+            return False
+        if (kind, item_id) in self._queued:
+            return True
+        try:
+            self.queue.put_nowait((kind, item_id))
+            self._queued.add((kind, item_id))
+            return True
+        except asyncio.QueueFull:
+            logger.warning(f"Video pipeline queue full, skipping {kind} {item_id}")
+            self.processed.inc(result="dropped")
+            return False
+
+    async def _consume(self):
+        while True:
+            kind, item_id = await self.queue.get()
+            started = time.monotonic()
+            try:
+                outcome = await self.process_video(kind, item_id)
+                self.processed.inc(result=outcome)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.processed.inc(result="error")
+                logger.error(f"Video pipeline failed for {kind} {item_id}: {e}")
+                await self._set(kind, item_id, {"processing_status": "failed"})
+            finally:
+                self._queued.discard((kind, item_id))
+                self.duration.observe(time.monotonic() - started)
+                self.queue.task_done()
+
+    async def _recovery_loop(self):
+        try:
+            while True:
+                try:
+                    await self.recover_unprocessed()
+                except Exception as e:
+                    logger.error(f"Error recovering unprocessed videos: {e}")
+                await asyncio.sleep(RECOVERY_INTERVAL)
+        except asyncio.CancelledError:
+            pass
+
+    async def recover_unprocessed(self, batch_size: int = 200) -> int:
+        """
+        Queue videos of the last RECOVERY_WINDOW_HOURS still pending, or left
+        processing by a worker that stopped; one worker sweeps per interval,
+        claimed in `job_runs`
+
+        Runs at start, so videos queued in a worker that stopped or dropped
+        by a full queue are processed after all.
+        """
+        lease = JobLease(self.db, RECOVERY_JOB)
+        if not await lease.acquire():
+            return 0
+        try:
+            now = datetime.now(timezone.utc)
+            last = await read_progress(self.db, RECOVERY_JOB)
+            if last and last.get("finished_at") and \
+                    now - datetime.fromisoformat(last["finished_at"]) < timedelta(seconds=RECOVERY_INTERVAL / 2):
+                return 0  # another worker swept moments ago
+
+            window_start = (now - timedelta(hours=RECOVERY_WINDOW_HOURS)).isoformat()
+            queued = 0
+            for kind, spec in VIDEO_KINDS.items():
+                table = self.db[spec["table"]]
+                pending = await table.find(
+                    {
+                        "processing_status": "pending",
+                        spec["uploaded_field"]: {
+                            "$gte": window_start,
+                            "$lt": (now - timedelta(seconds=RECOVERY_GRACE_SECONDS)).isoformat()
+                        }
+                    },
+                    sort=[(spec["uploaded_field"], 1)],
+                    limit=batch_size
+                )
+                stalled = await table.find(
+                    {
+                        "processing_status": "processing",
+                        "processing_started_at": {
+                            "$gte": window_start,
+                            "$lt": (now - timedelta(seconds=RECOVERY_STALE_SECONDS)).isoformat()
+                        }
+                    },
+                    sort=[("processing_started_at", 1)],
+                    limit=batch_size
+                )
+                queued += sum(1 for row in pending + stalled if self.enqueue(kind, row[spec["id_field"]]))
+            await lease.save_progress({"queued": queued, "finished_at": now.isoformat()})
+        finally:
+            await lease.release()
+
+        if queued:
+            logger.info(f"Queued {queued} unprocessed videos for processing")
+        return queued
+
+    async def _run(self, args: List[str]) -> bytes:
+        process = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), VIDEO_PIPELINE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            process.kill()
+            await process.wait()
+            raise
+        if process.returncode != 0:
+            raise FFmpegError(stderr.decode(errors="replace").strip()[-500:])
+        return stdout
+
+    async def _probe_duration(self, path: str) -> float:
+        output = await self._run([
+            FFPROBE, "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path
+        ])
+        return float(output.strip() or 0)
+
+    async def _set(self, kind: str, item_id: str, fields: Dict):
+        spec = VIDEO_KINDS[kind]
+        await self.db[spec["table"]].update_one({spec["id_field"]: item_id}, {"$set": fields})
+
+    async def _video_settings(self, company_id: Optional[str]) -> Dict:
+        settings = None
+        if company_id:
+            settings = await self.db.video_screenshot_settings.find_one({"company_id": company_id})
+        return settings or {"quality": "medium", "include_audio": False}
+
+    async def process_video(self, kind: str, item_id: str) -> str:
+        """
+        Probe, re-encode into HLS, extract thumbnails and store the results
+        for one uploaded video
+
+        The original upload is kept for download. Every file operation runs
+        in a thread and the upload is copied to disk without being held in
+        memory. When processing fails, the objects already stored for it
+        are deleted. Returns "ok" or "skipped".
+        """
+        from utils.storage_backends import get_storage
+
+        spec = VIDEO_KINDS[kind]
+        row = await self.db[spec["table"]].find_one({spec["id_field"]: item_id})
+        if not row or not row.get("storage_key") or row.get("processing_status") == "ready":
+            return "skipped"
+        storage = get_storage(row.get("storage_type"))
+        if not storage:
+            return "skipped"
+
+        settings = await self._video_settings(row.get("company_id"))
+        await self._set(kind, item_id, {
+            "processing_status": "processing",
+            "processing_started_at": datetime.now(timezone.utc).isoformat()
+        })
+
+        work_dir = await asyncio.to_thread(tempfile.mkdtemp, prefix="video_")
+        stored: List[str] = []
+        try:
+            source = os.path.join(work_dir, "source" + os.path.splitext(row["storage_key"])[1])
+            await storage.read_to_file(row["storage_key"], source)
+            file_size = await asyncio.to_thread(os.path.getsize, source)
+
+            hls_dir = os.path.join(work_dir, "hls")
+            thumbs_dir = os.path.join(work_dir, "thumbs")
+            await asyncio.to_thread(os.makedirs, hls_dir)
+            await asyncio.to_thread(os.makedirs, thumbs_dir)
+
+            duration = await self._probe_duration(source)
+            await self._run(transcode_args(
+                source, hls_dir, settings.get("quality", "medium"), bool(settings.get("include_audio"))
+            ))
+            await self._run(thumbnail_args(source, thumbs_dir))
+
+            base_key = row["storage_key"].rsplit(".", 1)[0]
+            playlist = parse_playlist(await asyncio.to_thread(_read_text, os.path.join(hls_dir, "index.m3u8")))
+
+            segments = []
+            for filename, segment_duration in playlist:
+                key = await self._store(storage, stored, os.path.join(hls_dir, filename),
+                                        f"{base_key}/hls/{filename}", "video/mp2t")
+                segments.append({"key": key, "duration": segment_duration})
+
+            poster_key = await self._store(storage, stored, os.path.join(thumbs_dir, "poster.jpg"),
+                                           f"{base_key}/poster.jpg", "image/jpeg")
+            keyframe_keys = []
+            for path in sorted(await asyncio.to_thread(glob.glob, os.path.join(thumbs_dir, "keyframe_*.jpg"))):
+                keyframe_keys.append(await self._store(storage, stored, path,
+                                                       f"{base_key}/{os.path.basename(path)}", "image/jpeg"))
+
+            await self._set(kind, item_id, {
+                spec["duration_field"]: int(round(duration)),
+                "file_size": file_size,
+                "poster_key": poster_key,
+                "keyframe_keys": keyframe_keys,
+                "hls_segments": segments,
+                "derived_keys": [poster_key] + keyframe_keys + [segment["key"] for segment in segments],
+                "processing_status": "ready",
+                "processed_at": datetime.now(timezone.utc).isoformat()
+            })
+        except BaseException:
+            if stored:
+                try:
+                    await storage.delete_many(stored)
+                except Exception as e:
+                    logger.error(f"Failed to delete partial output of {kind} {item_id}: {e}")
+            raise
+        finally:
+            await asyncio.to_thread(shutil.rmtree, work_dir, True)
+        return "ok"
+
+    async def _store(self, storage, stored: List[str], path: str, key: str, content_type: str) -> str:
+        """Upload a local file, streamed from disk, and record its key in `stored`"""
+        f = await asyncio.to_thread(open, path, "rb")
+        try:
+            key = await storage.save_file(f, key, content_type)
+        finally:
+            await asyncio.to_thread(f.close)
+        stored.append(key)
+        return key
+
+
+def _read_text(path: str) -> str:
+    with open(path) as f:
+        return f.read()
+
+
+def playback_urls(kind: str, row: Dict) -> Dict:
+    """
+    Add a processed video's signed poster as `thumbnail_url` and its HLS
+    playlist as `hls_url` to an API response row
+    """
+    from utils.storage_backends import signed_url_for
+
+    if row.get("poster_key"):
+        row["thumbnail_url"] = signed_url_for(row.get("storage_type"), row["poster_key"])
+    if row.get("processing_status") == "ready" and row.get("hls_segments"):
+        row["hls_url"] = f"/api/storage/hls/{kind}/{row[VIDEO_KINDS[kind]['id_field']]}/index.m3u8"
+    return row
+
+
+# Global pipeline instance
+video_pipeline = VideoPipeline()
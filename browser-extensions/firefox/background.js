@@ -2,6 +2,13 @@
 
 const API_URL = 'http://localhost:8001/api';
 
+// Activity logs are buffered and uploaded in batches
+const FLUSH_INTERVAL_MINUTES = 1;
+const FLUSH_BATCH_SIZE = 200;
+const MAX_BUFFERED_LOGS = 5000;
+let flushing = false;
+let bufferUpdates = Promise.resolve();
+
 // Track active tab and time
 let activeTabId = null;
 let activeUrl = null;
@@ -59,21 +66,16 @@ async function logTimeSpent() {
     // Categorize the URL
     const category = categorizeUrl(domain);
     
-    // Log activity
-    await fetch(`${API_URL}/activity-logs`, {
-      method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-        'Authorization': `Bearer ${token}`
-      },
-      body: JSON.stringify({
-        app_name: domain,
-        url: activeUrl,
-        window_title: activeTitle,
-        activity_level: 100, // Full activity since user is browsing
-        duration: duration,
-        category: category
-      })
+    // Buffer the activity; it is uploaded with the next batch
+    await bufferLog({
+      client_id: crypto.randomUUID(),
+      app_name: domain,
+      url: activeUrl,
+      window_title: activeTitle,
+      activity_level: 100, // Full activity since user is browsing
+      duration: duration,
+      category: category,
+      timestamp: new Date().toISOString()
     });
     
     // Update local total
@@ -85,6 +87,68 @@ async function logTimeSpent() {
   }
 }
 
+// Apply an update to the persistent log buffer; updates run one at a time so none are lost
+function updateBuffer(update) {
+  bufferUpdates = bufferUpdates.catch(() => {}).then(async () => {
+    const data = await chrome.storage.local.get(['pendingLogs']);
+    const pending = update(data.pendingLogs || []);
+    await chrome.storage.local.set({ pendingLogs: pending });
+    return pending;
+  });
+  return bufferUpdates;
+}
+
+// Add a log to the buffer, flushing once a batch is full
+async function bufferLog(log) {
+  // Keep the newest logs if the server has been unreachable for a long time
+  const pending = await updateBuffer(logs => [...logs, log].slice(-MAX_BUFFERED_LOGS));
+
+  if (pending.length >= FLUSH_BATCH_SIZE) {
+    await flushLogs();
+  }
+}
+
+// Upload buffered logs as gzip-compressed NDJSON batches
+async function flushLogs() {
+  if (flushing) return;
+  flushing = true;
+
+  try {
+    const token = await getToken();
+    if (!token) return;
+
+    while (true) {
+      const data = await chrome.storage.local.get(['pendingLogs']);
+      const batch = (data.pendingLogs || []).slice(0, FLUSH_BATCH_SIZE);
+      if (batch.length === 0) return;
+
+      const ndjson = batch.map(log => JSON.stringify(log)).join('\n');
+      const body = await new Response(
+        new Blob([ndjson]).stream().pipeThrough(new CompressionStream('gzip'))
+      ).arrayBuffer();
+
+      const response = await fetch(`${API_URL}/activity-logs/batch`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/x-ndjson',
+          'Content-Encoding': 'gzip',
+          'Authorization': `Bearer ${token}`
+        },
+        body: body
+      });
+      // Keep the batch for the next flush; client ids make the retry safe
+      if (!response.ok) return;
+
+      const sent = new Set(batch.map(log => log.client_id));
+      await updateBuffer(logs => logs.filter(log => !sent.has(log.client_id)));
+    }
+  } catch (error) {
+    console.error('Failed to upload activity logs:', error);
+  } finally {
+    flushing = false;
+  }
+}
+
 // Categorize URL by domain
 function categorizeUrl(domain) {
   const productivePatterns = [
@@ -127,7 +191,7 @@ chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
   }
   
   if (request.action === 'stopTracking') {
-    logTimeSpent().then(() => {
+    logTimeSpent().then(flushLogs).then(() => {
       isTracking = false;
       activeUrl = null;
       activeTitle = null;
@@ -170,7 +234,7 @@ chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
   }
   
   if (request.action === 'logout') {
-    chrome.storage.local.remove(['token', 'user', 'isTracking', 'totalToday']);
+    chrome.storage.local.remove(['token', 'user', 'isTracking', 'totalToday', 'pendingLogs']);
     isTracking = false;
     sendResponse({ success: true });
   }
@@ -178,7 +242,12 @@ chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
 
 // Reset daily total at midnight
 chrome.alarms.create('resetDaily', { periodInMinutes: 60 });
+chrome.alarms.create('flushLogs', { periodInMinutes: FLUSH_INTERVAL_MINUTES });
 chrome.alarms.onAlarm.addListener((alarm) => {
+  if (alarm.name === 'flushLogs') {
+    flushLogs();
+  }
+
   if (alarm.name === 'resetDaily') {
     const now = new Date();
     if (now.getHours() === 0 && now.getMinutes() < 60) {
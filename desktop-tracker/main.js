@@ -18,6 +18,7 @@ const store = new Store({
     autoStart: true,
     blurScreenshots: false,
     trackingEnabled: false,
+    sendRawActivity: true, // the company's `raw_activity_events` policy, as last reported by the server
     lastActivity: Date.now()
   }
 });
@@ -29,6 +30,13 @@ let currentTimeEntry = null;
 let screenshotJob = null;
 let activityJob = null;
 let idleCheckJob = null;
+let sampleJob = null;
+let heartbeatJob = null;
+let activityBuckets = new Map(); // `${minute}|${app}|${domain}` -> per-minute bucket
+let lastSamplePosition = { x: 0, y: 0 };
+
+const SAMPLE_INTERVAL_SECONDS = 5;
+const MAX_PENDING_BUCKETS = 1440; // one day of minutes; the oldest are dropped beyond that
 let lastMousePosition = { x: 0, y: 0 };
 let lastKeyTime = Date.now();
 let idleSeconds = 0;
@@ -168,6 +176,9 @@ async function startTracking() {
     
     // Start idle detection
     startIdleDetection();
+
+    // Report presence
+    startPresenceHeartbeat();
     
     updateTrayMenu();
     mainWindow.webContents.send('tracking-started', entry);
@@ -199,6 +210,12 @@ async function stopTracking() {
     if (screenshotJob) screenshotJob.cancel();
     if (activityJob) activityJob.cancel();
     if (idleCheckJob) idleCheckJob.cancel();
+    if (sampleJob) sampleJob.cancel();
+    if (heartbeatJob) heartbeatJob.cancel();
+
+    // Upload the current, unfinished minute too
+    await flushActivityBuckets(true);
+    await sendHeartbeat('offline');
     
     updateTrayMenu();
     mainWindow.webContents.send('tracking-stopped');
@@ -271,7 +288,7 @@ function startScreenshotCapture() {
 
 // Monitor activity (app usage)
 async function recordActivity() {
-  if (!isTracking) return;
+  if (!isTracking || !store.get('sendRawActivity')) return;
   
   try {
     const activeWindow = await activeWin();
@@ -291,10 +308,86 @@ async function recordActivity() {
   }
 }
 
+// Sample the active window and add the sample to its minute bucket
+async function sampleActivity() {
+  if (!isTracking) return;
+
+  try {
+    const activeWindow = await activeWin();
+    const now = Date.now();
+    const cursor = screen.getCursorScreenPoint();
+    const moved = cursor.x !== lastSamplePosition.x || cursor.y !== lastSamplePosition.y;
+    lastSamplePosition = cursor;
+
+    const idle = now - store.get('lastActivity') >= store.get('idleTimeout') * 1000;
+    const appName = activeWindow?.owner?.name || 'Unknown';
+    let domain = null;
+    try {
+      domain = activeWindow?.url ? new URL(activeWindow.url).hostname : null;
+    } catch (e) {
+      domain = null;
+    }
+
+    const minute = new Date(Math.floor(now / 60000) * 60000).toISOString();
+    const key = `${minute}|${appName}|${domain || ''}`;
+    let bucket = activityBuckets.get(key);
+    if (!bucket) {
+      bucket = {
+        minute,
+        app_name: appName,
+        domain,
+        active_seconds: 0,
+        idle_seconds: 0,
+        keystrokes: 0, // no keyboard hook on the desktop tracker
+        mouse_clicks: 0,
+        mouse_moves: 0
+      };
+      activityBuckets.set(key, bucket);
+    }
+
+    const field = idle ? 'idle_seconds' : 'active_seconds';
+    bucket[field] = Math.min(60, bucket[field] + SAMPLE_INTERVAL_SECONDS);
+    if (moved) bucket.mouse_moves += 1;
+  } catch (error) {
+    console.error('Activity sampling error:', error);
+  }
+}
+
+// Upload closed minute buckets (all buckets when `includeCurrent`); failed uploads are kept and retried
+async function flushActivityBuckets(includeCurrent = false) {
+  const currentMinute = new Date(Math.floor(Date.now() / 60000) * 60000).toISOString();
+  const keys = [...activityBuckets.keys()].filter(key => {
+    return includeCurrent || activityBuckets.get(key).minute < currentMinute;
+  });
+  if (keys.length === 0) return;
+
+  try {
+    const result = await apiRequest('POST', '/activity/buckets', {
+      version: 1,
+      agent: 'desktop',
+      buckets: keys.map(key => activityBuckets.get(key))
+    });
+    keys.forEach(key => activityBuckets.delete(key));
+    store.set('sendRawActivity', result.raw_events !== false);
+  } catch (error) {
+    // Keep the buckets for the next flush, bounded to a day of minutes
+    const overflow = activityBuckets.size - MAX_PENDING_BUCKETS;
+    if (overflow > 0) {
+      [...activityBuckets.keys()].slice(0, overflow).forEach(key => activityBuckets.delete(key));
+    }
+  }
+}
+
 // Start activity monitoring
 function startActivityMonitoring() {
-  // Record activity every minute
+  // Sample the active window every few seconds
+  sampleJob = schedule.scheduleJob(`*/${SAMPLE_INTERVAL_SECONDS} * * * * *`, () => {
+    sampleActivity();
+  });
+
+  // Upload minute buckets, and raw activity when the company still wants it, every minute
   activityJob = schedule.scheduleJob('* * * * *', () => {
+    flushActivityBuckets();
     recordActivity();
   });
 }
@@ -334,6 +427,34 @@ function checkIdle() {
   }
 }
 
+// Report presence; the server marks the user offline when heartbeats stop
+async function sendHeartbeat(status = null) {
+  try {
+    let appName = null;
+    if (!status) {
+      const idle = Date.now() - store.get('lastActivity') >= store.get('idleTimeout') * 1000;
+      status = idle ? 'idle' : 'online';
+      const activeWindow = await activeWin();
+      appName = activeWindow?.owner?.name || null;
+    }
+    await apiRequest('POST', '/presence/heartbeat', {
+      status,
+      app_name: appName,
+      activity_level: status === 'online' ? calculateActivityLevel() : 0
+    });
+  } catch (error) {
+    console.error('Presence heartbeat error:', error.message);
+  }
+}
+
+// Start presence heartbeats
+function startPresenceHeartbeat() {
+  sendHeartbeat();
+  heartbeatJob = schedule.scheduleJob('*/30 * * * * *', () => {
+    sendHeartbeat();
+  });
+}
+
 // Start idle detection
 function startIdleDetection() {
   // Check idle every 10 seconds
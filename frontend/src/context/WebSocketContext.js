@@ -22,7 +22,9 @@ export const WebSocketProvider = ({ children }) => {
 
     const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
     const backendUrl = process.env.REACT_APP_BACKEND_URL?.replace(/^https?:\/\//, '') || 'localhost:8001';
-    const wsUrl = `${wsProtocol}//${backendUrl}/ws/${user.company_id}`;
+    // Browsers cannot send an Authorization header on a websocket
+    const token = encodeURIComponent(localStorage.getItem('token') || '');
+    const wsUrl = `${wsProtocol}//${backendUrl}/ws/${user.company_id}?token=${token}`;
 
     try {
       const ws = new WebSocket(wsUrl);
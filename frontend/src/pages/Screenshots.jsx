@@ -232,7 +232,7 @@ export default function Screenshots() {
                         data-testid={`screenshot-${screenshot.screenshot_id}`}
                       >
                         <img
-                          src={screenshot.s3_url}
+                          src={screenshot.thumbnail_url || screenshot.s3_url}
                           alt={screenshot.window_title || 'Screenshot'}
                           className="w-full h-36 object-cover"
                         />
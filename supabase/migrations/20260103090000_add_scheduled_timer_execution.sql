@@ -0,0 +1,38 @@
+/*
+  # Scheduled Timer Execution
+
+  ## Overview
+  Supports the scheduled timer engine, which auto-starts and auto-stops
+  time entries for `scheduled_timers` in per-minute batches.
+
+  ## Changes
+
+  1. `time_entries`
+     - New `schedule_id` column linking auto-started entries to their schedule
+     - `source` accepts 'scheduled'
+     - `status` accepts 'completed' (used by the API when a timer is stopped)
+     - Partial index on active entries per user for the "already running" check
+     - Partial index on active entries per schedule for batched auto-stop
+
+  ## Important Notes
+  - Existing rows are unaffected
+*/
+
+ALTER TABLE time_entries
+  ADD COLUMN IF NOT EXISTS schedule_id TEXT REFERENCES scheduled_timers(schedule_id) ON DELETE SET NULL;
+
+ALTER TABLE time_entries DROP CONSTRAINT IF EXISTS time_entries_source_check;
+ALTER TABLE time_entries
+  ADD CONSTRAINT time_entries_source_check
+  CHECK (source IN ('manual', 'desktop', 'mobile', 'browser', 'scheduled'));
+
+ALTER TABLE time_entries DROP CONSTRAINT IF EXISTS time_entries_status_check;
+ALTER TABLE time_entries
+  ADD CONSTRAINT time_entries_status_check
+  CHECK (status IN ('active', 'stopped', 'paused', 'completed'));
+
+CREATE INDEX IF NOT EXISTS idx_time_entries_user_active
+  ON time_entries(user_id) WHERE status = 'active';
+
+CREATE INDEX IF NOT EXISTS idx_time_entries_schedule_active
+  ON time_entries(schedule_id) WHERE status = 'active';
@@ -0,0 +1,68 @@
+/*
+  # Recurring Payment Batch Processing
+
+  ## Overview
+  Supports the recurring payment processor, which pays every due schedule
+  in batches instead of one HTTP call per schedule.
+
+  ## Changes
+
+  1. `recurring_payment_schedules`
+     - `claim_id` / `claimed_until` lease columns written while a run owns a row
+     - Partial index on `next_payment_date` for active, unpaused schedules
+
+  2. `payouts`
+     - `idempotency_key` with a unique index; a retried run cannot create
+       a second payout for the same schedule and due date
+
+  3. `claim_due_recurring_payments` function
+     - Locks due rows with FOR UPDATE SKIP LOCKED so concurrent runs never
+       claim the same schedule, and leases them to the calling run
+*/
+
+ALTER TABLE recurring_payment_schedules
+  ADD COLUMN IF NOT EXISTS claim_id TEXT,
+  ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS idx_recurring_schedules_due
+  ON recurring_payment_schedules(next_payment_date)
+  WHERE is_active = true AND is_paused = false;
+
+ALTER TABLE payouts
+  ADD COLUMN IF NOT EXISTS idempotency_key TEXT;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_payouts_idempotency_key
+  ON payouts(idempotency_key);
+
+CREATE OR REPLACE FUNCTION public.claim_due_recurring_payments(
+  p_run_date date,
+  p_claim_id text,
+  p_company_id text DEFAULT NULL,
+  p_limit integer DEFAULT 500,
+  p_lease_seconds integer DEFAULT 300
+)
+RETURNS SETOF public.recurring_payment_schedules
+LANGUAGE plpgsql
+SECURITY INVOKER
+SET search_path = public
+AS $function$
+BEGIN
+  RETURN QUERY
+  UPDATE public.recurring_payment_schedules s
+  SET claim_id = p_claim_id,
+      claimed_until = now() + make_interval(secs => p_lease_seconds)
+  WHERE s.schedule_id IN (
+    SELECT d.schedule_id
+    FROM public.recurring_payment_schedules d
+    WHERE d.is_active = true
+      AND d.is_paused = false
+      AND d.next_payment_date <= p_run_date
+      AND (p_company_id IS NULL OR d.company_id = p_company_id)
+      AND (d.claimed_until IS NULL OR d.claimed_until < now())
+    ORDER BY d.next_payment_date
+    LIMIT p_limit
+    FOR UPDATE SKIP LOCKED
+  )
+  RETURNING s.*;
+END;
+$function$;
@@ -0,0 +1,25 @@
+/*
+  # Screenshot Storage Metadata
+
+  ## Overview
+  Records how and where each screenshot blob is stored, as written by the
+  storage upload endpoints.
+
+  ## Changes
+
+  1. `screenshots`
+     - `s3_key` object key in the storage bucket
+     - `storage_type` 's3' or 'reference' (storage not configured)
+     - `content_type` MIME type of the stored image
+     - `file_size` stored size in bytes
+     - `checksum_sha256` hex SHA-256 of the uploaded bytes
+
+  ## Important Notes
+  - All columns are nullable; existing rows are unaffected
+*/
+
+ALTER TABLE screenshots ADD COLUMN IF NOT EXISTS s3_key TEXT;
+ALTER TABLE screenshots ADD COLUMN IF NOT EXISTS storage_type TEXT;
+ALTER TABLE screenshots ADD COLUMN IF NOT EXISTS content_type TEXT;
+ALTER TABLE screenshots ADD COLUMN IF NOT EXISTS file_size BIGINT;
+ALTER TABLE screenshots ADD COLUMN IF NOT EXISTS checksum_sha256 TEXT;
@@ -0,0 +1,26 @@
+/*
+  # Screenshot Image Pipeline
+
+  ## Overview
+  Stores the results of the post-upload image pipeline, which re-encodes
+  screenshots to WebP and renders fixed-size thumbnails.
+
+  ## Changes
+
+  1. `screenshots`
+     - `width`, `height` pixel dimensions of the image
+     - `thumbnail_key` object key of the thumbnail
+     - `original_size` size in bytes of the image as uploaded
+     - `bytes_saved` bytes saved by re-encoding
+     - `processed_at` when the pipeline finished with the screenshot
+
+  ## Important Notes
+  - Rows without `processed_at` have not been through the pipeline yet
+*/
+
+ALTER TABLE screenshots ADD COLUMN IF NOT EXISTS width INTEGER;
+ALTER TABLE screenshots ADD COLUMN IF NOT EXISTS height INTEGER;
+ALTER TABLE screenshots ADD COLUMN IF NOT EXISTS thumbnail_key TEXT;
+ALTER TABLE screenshots ADD COLUMN IF NOT EXISTS original_size BIGINT;
+ALTER TABLE screenshots ADD COLUMN IF NOT EXISTS bytes_saved BIGINT;
+ALTER TABLE screenshots ADD COLUMN IF NOT EXISTS processed_at TIMESTAMPTZ;
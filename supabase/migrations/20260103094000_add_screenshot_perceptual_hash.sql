@@ -0,0 +1,29 @@
+/*
+  # Screenshot Perceptual Hash Deduplication
+
+  ## Overview
+  Visually identical consecutive screenshots reuse the earlier stored blob
+  instead of storing a new object.
+
+  ## Changes
+
+  1. `screenshots`
+     - `perceptual_hash` 64-bit dHash as 16 hex characters
+     - `duplicate_of` screenshot whose blob this row references
+     - Partial index on each user's distinct screenshots by capture time, used
+       to load the recent-hash index
+     - Index on `s3_key` to check whether a blob is still referenced before deleting it
+
+  ## Important Notes
+  - Duplicate rows copy the blob's `s3_key` and `thumbnail_key`; the blob is
+    only deleted once no row references it
+*/
+
+ALTER TABLE screenshots ADD COLUMN IF NOT EXISTS perceptual_hash TEXT;
+ALTER TABLE screenshots
+  ADD COLUMN IF NOT EXISTS duplicate_of TEXT REFERENCES screenshots(screenshot_id) ON DELETE SET NULL;
+
+CREATE INDEX IF NOT EXISTS idx_screenshots_user_distinct_taken_at
+  ON screenshots(user_id, taken_at DESC) WHERE duplicate_of IS NULL;
+
+CREATE INDEX IF NOT EXISTS idx_screenshots_s3_key ON screenshots(s3_key);
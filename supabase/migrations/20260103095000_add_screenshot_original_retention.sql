@@ -0,0 +1,26 @@
+/*
+  # Screenshot Original Retention
+
+  ## Overview
+  Screenshots that must be blurred are blurred or pixelated by the image
+  pipeline. A company's `tracking_policy` can keep the unblurred original
+  for a limited time (`original_retention_hours`); it is deleted afterwards.
+
+  ## Changes
+
+  1. `screenshots`
+     - `original_key` object key of the retained unblurred original
+     - `original_expires_at` when the original is purged
+     - Partial index on `original_expires_at` for the purge sweep
+
+  ## Important Notes
+  - New `tracking_policy` keys (all optional): `blur_mode` ('blur' or
+    'pixelate'), `blur_strength`, `original_retention_hours` (0 discards the
+    original immediately)
+*/
+
+ALTER TABLE screenshots ADD COLUMN IF NOT EXISTS original_key TEXT;
+ALTER TABLE screenshots ADD COLUMN IF NOT EXISTS original_expires_at TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS idx_screenshots_original_expires_at
+  ON screenshots(original_expires_at) WHERE original_expires_at IS NOT NULL;
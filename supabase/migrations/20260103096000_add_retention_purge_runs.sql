@@ -0,0 +1,51 @@
+/*
+  # Retention Purge Runs
+
+  ## Overview
+  The retention purge engine deletes screenshots and screen recordings older
+  than each company's retention period, deleting stored objects in batches
+  of 1000 and rows with one set-based delete per batch.
+
+  ## Changes
+
+  1. `retention_purge_runs`
+     - One row per run with its cutoff instant, the last fully purged
+       company (`cursor`) and per-kind row/object counts, so an interrupted
+       run resumes where it stopped and progress can be reported
+
+  2. `screen_recordings`
+     - `storage_key` / `storage_type` locate the stored recording so the
+       purge can delete it
+
+  3. Indexes on the purge sweep columns
+
+  ## Important Notes
+  - New `tracking_policy` keys (all optional): `screenshot_retention_days`,
+    `recording_retention_days`; 0 or unset keeps data forever unless the
+    SCREENSHOT_RETENTION_DAYS / RECORDING_RETENTION_DAYS defaults are set
+*/
+
+CREATE TABLE IF NOT EXISTS retention_purge_runs (
+  run_id TEXT PRIMARY KEY,
+  company_id TEXT REFERENCES companies(company_id),
+  status TEXT NOT NULL DEFAULT 'running',
+  cutoff_at TIMESTAMPTZ NOT NULL,
+  cursor TEXT,
+  companies_done INTEGER DEFAULT 0,
+  rows_deleted JSONB DEFAULT '{}'::jsonb,
+  objects_deleted JSONB DEFAULT '{}'::jsonb,
+  duration_ms BIGINT DEFAULT 0,
+  started_at TIMESTAMPTZ DEFAULT now(),
+  finished_at TIMESTAMPTZ
+);
+
+ALTER TABLE retention_purge_runs ENABLE ROW LEVEL SECURITY;
+
+CREATE INDEX IF NOT EXISTS idx_retention_purge_runs_status
+  ON retention_purge_runs(status, started_at DESC);
+
+ALTER TABLE screen_recordings ADD COLUMN IF NOT EXISTS storage_key TEXT;
+ALTER TABLE screen_recordings ADD COLUMN IF NOT EXISTS storage_type TEXT;
+
+CREATE INDEX IF NOT EXISTS idx_screenshots_company_taken_at
+  ON screenshots(company_id, taken_at);
@@ -0,0 +1,52 @@
+/*
+  # Chunked Upload Sessions
+
+  ## Overview
+  Screen recordings and video screenshots are uploaded by the desktop
+  tracker as resumable chunked uploads: initiate, upload chunks at byte
+  offsets with a SHA-256 per chunk, then complete. Each upload maps onto an
+  S3 multipart upload or a staging file of the local storage backend.
+
+  ## Changes
+
+  1. `upload_sessions`
+     - One row per upload with its storage key, the backend's multipart
+       upload handle, the acknowledged byte count and the stored parts, so an
+       interrupted upload resumes from the last acknowledged chunk
+
+  2. `video_screenshots`
+     - `storage_key` / `storage_type` locate the uploaded clip
+
+  ## Important Notes
+  - Abandoned S3 multipart uploads should be cleaned up with a bucket
+    lifecycle rule (AbortIncompleteMultipartUpload)
+*/
+
+CREATE TABLE IF NOT EXISTS upload_sessions (
+  upload_id TEXT PRIMARY KEY,
+  kind TEXT NOT NULL,
+  company_id TEXT NOT NULL REFERENCES companies(company_id),
+  user_id TEXT NOT NULL REFERENCES users(user_id),
+  time_entry_id TEXT REFERENCES time_entries(entry_id),
+  storage_type TEXT NOT NULL,
+  storage_key TEXT NOT NULL,
+  storage_upload_id TEXT NOT NULL,
+  content_type TEXT NOT NULL,
+  total_size BIGINT NOT NULL,
+  chunk_size INTEGER NOT NULL,
+  received_bytes BIGINT DEFAULT 0,
+  parts JSONB DEFAULT '[]'::jsonb,
+  status TEXT NOT NULL DEFAULT 'uploading',
+  details JSONB DEFAULT '{}'::jsonb,
+  result_id TEXT,
+  created_at TIMESTAMPTZ DEFAULT now(),
+  updated_at TIMESTAMPTZ DEFAULT now()
+);
+
+ALTER TABLE upload_sessions ENABLE ROW LEVEL SECURITY;
+
+CREATE INDEX IF NOT EXISTS idx_upload_sessions_status
+  ON upload_sessions(status, updated_at);
+
+ALTER TABLE IF EXISTS video_screenshots ADD COLUMN IF NOT EXISTS storage_key TEXT;
+ALTER TABLE IF EXISTS video_screenshots ADD COLUMN IF NOT EXISTS storage_type TEXT;
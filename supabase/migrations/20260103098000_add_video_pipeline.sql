@@ -0,0 +1,43 @@
+/*
+  # Video Pipeline
+
+  ## Overview
+  Uploaded screen recordings and video screenshots are processed by an
+  ffmpeg pipeline: re-encoded at the company's video quality into HLS
+  segments, with a poster frame and keyframe thumbnails. Playback starts
+  from `/api/storage/hls/{kind}/{id}/index.m3u8` instead of downloading
+  the whole MP4.
+
+  ## Changes
+
+  1. `screen_recordings` and `video_screenshots`
+     - `processing_status` pending, processing, ready or failed
+     - `poster_key`, `keyframe_keys` stored thumbnails
+     - `hls_segments` segment keys and durations, in playback order
+     - `derived_keys` every object produced from the upload, deleted with it
+     - `processed_at`
+
+  2. `video_screenshots`
+     - `thumbnail_url`, `company_id`, `user_id` (set by chunked uploads)
+
+  ## Important Notes
+  - Requires `ffmpeg` and `ffprobe` on the PATH (or FFMPEG_PATH /
+    FFPROBE_PATH); without them videos are stored but not processed
+*/
+
+ALTER TABLE screen_recordings ADD COLUMN IF NOT EXISTS processing_status TEXT;
+ALTER TABLE screen_recordings ADD COLUMN IF NOT EXISTS poster_key TEXT;
+ALTER TABLE screen_recordings ADD COLUMN IF NOT EXISTS keyframe_keys JSONB;
+ALTER TABLE screen_recordings ADD COLUMN IF NOT EXISTS hls_segments JSONB;
+ALTER TABLE screen_recordings ADD COLUMN IF NOT EXISTS derived_keys JSONB;
+ALTER TABLE screen_recordings ADD COLUMN IF NOT EXISTS processed_at TIMESTAMPTZ;
+
+ALTER TABLE IF EXISTS video_screenshots ADD COLUMN IF NOT EXISTS company_id TEXT;
+ALTER TABLE IF EXISTS video_screenshots ADD COLUMN IF NOT EXISTS user_id TEXT;
+ALTER TABLE IF EXISTS video_screenshots ADD COLUMN IF NOT EXISTS thumbnail_url TEXT;
+ALTER TABLE IF EXISTS video_screenshots ADD COLUMN IF NOT EXISTS processing_status TEXT;
+ALTER TABLE IF EXISTS video_screenshots ADD COLUMN IF NOT EXISTS poster_key TEXT;
+ALTER TABLE IF EXISTS video_screenshots ADD COLUMN IF NOT EXISTS keyframe_keys JSONB;
+ALTER TABLE IF EXISTS video_screenshots ADD COLUMN IF NOT EXISTS hls_segments JSONB;
+ALTER TABLE IF EXISTS video_screenshots ADD COLUMN IF NOT EXISTS derived_keys JSONB;
+ALTER TABLE IF EXISTS video_screenshots ADD COLUMN IF NOT EXISTS processed_at TIMESTAMPTZ;
@@ -0,0 +1,24 @@
+/*
+  # Activity Log Batch Ingestion
+
+  ## Overview
+  Browser extensions and agents buffer activity logs and upload them in
+  batches to `POST /api/activity-logs/batch`. Every record carries a
+  client-generated id so a retried batch does not insert duplicates.
+
+  ## Changes
+
+  1. `activity_logs`
+     - `client_id` client-generated record id
+     - `duration` seconds spent, as reported by the extensions
+     - `category` productive / neutral / distracting, as reported by the extensions
+     - Unique index on (`user_id`, `client_id`); rows without a client id
+       (single-record endpoint) are unaffected
+*/
+
+ALTER TABLE activity_logs ADD COLUMN IF NOT EXISTS client_id TEXT;
+ALTER TABLE activity_logs ADD COLUMN IF NOT EXISTS duration INTEGER;
+ALTER TABLE activity_logs ADD COLUMN IF NOT EXISTS category TEXT;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_activity_logs_user_client_id
+  ON activity_logs(user_id, client_id);
@@ -0,0 +1,127 @@
+/*
+  # Activity Minute Buckets
+
+  ## Overview
+  Agents aggregate activity samples per minute, app and domain and upload
+  the closed minutes to `POST /api/activity/buckets`. The buckets are merged
+  into per-user, per-day, per-app rollups in a single statement, so reports
+  read a handful of rollup rows instead of scanning raw activity events.
+
+  ## Changes
+
+  1. `activity_minute_buckets`
+     - One row per uploaded bucket, keyed by a deterministic `bucket_id`
+       (user, minute, app, domain); a re-sent bucket is ignored
+     - Kept only for de-duplication; buckets older than seven days are
+       refused by the API, so older rows may be deleted at any time
+
+  2. `daily_activity_rollups`
+     - Summed counters per (`user_id`, `day`, `app_name`, `domain`)
+     - `minutes` number of merged minute buckets
+
+  3. `merge_activity_buckets(p_buckets jsonb)`
+     - Inserts the new buckets and adds them to the rollups; returns how many
+       buckets were new
+
+  ## Important Notes
+  - Rollup days are UTC days
+  - Companies can stop raw activity events with the tracking policy key
+    `raw_activity_events` (default true); agents then send buckets only
+*/
+
+CREATE TABLE IF NOT EXISTS activity_minute_buckets (
+  bucket_id TEXT PRIMARY KEY,
+  user_id TEXT NOT NULL,
+  company_id TEXT NOT NULL,
+  minute TIMESTAMPTZ NOT NULL,
+  app_name TEXT NOT NULL,
+  domain TEXT NOT NULL DEFAULT '',
+  category TEXT,
+  active_seconds INTEGER NOT NULL DEFAULT 0,
+  idle_seconds INTEGER NOT NULL DEFAULT 0,
+  keystrokes INTEGER NOT NULL DEFAULT 0,
+  mouse_clicks INTEGER NOT NULL DEFAULT 0,
+  mouse_moves INTEGER NOT NULL DEFAULT 0,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_activity_minute_buckets_company_created
+  ON activity_minute_buckets(company_id, created_at);
+
+CREATE TABLE IF NOT EXISTS daily_activity_rollups (
+  id BIGSERIAL PRIMARY KEY,
+  user_id TEXT NOT NULL,
+  company_id TEXT NOT NULL,
+  day DATE NOT NULL,
+  app_name TEXT NOT NULL,
+  domain TEXT NOT NULL DEFAULT '',
+  category TEXT,
+  active_seconds BIGINT NOT NULL DEFAULT 0,
+  idle_seconds BIGINT NOT NULL DEFAULT 0,
+  keystrokes BIGINT NOT NULL DEFAULT 0,
+  mouse_clicks BIGINT NOT NULL DEFAULT 0,
+  mouse_moves BIGINT NOT NULL DEFAULT 0,
+  minutes INTEGER NOT NULL DEFAULT 0,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  UNIQUE (user_id, day, app_name, domain)
+);
+
+CREATE INDEX IF NOT EXISTS idx_daily_activity_rollups_company_day
+  ON daily_activity_rollups(company_id, day);
+
+ALTER TABLE activity_minute_buckets ENABLE ROW LEVEL SECURITY;
+ALTER TABLE daily_activity_rollups ENABLE ROW LEVEL SECURITY;
+
+CREATE OR REPLACE FUNCTION public.merge_activity_buckets(p_buckets jsonb)
+RETURNS TABLE(merged integer)
+LANGUAGE plpgsql
+SECURITY INVOKER
+SET search_path = public
+AS $function$
+BEGIN
+  RETURN QUERY
+  WITH incoming AS (
+    SELECT *
+    FROM jsonb_to_recordset(p_buckets) AS b(
+      bucket_id text, user_id text, company_id text, minute timestamptz,
+      app_name text, domain text, category text,
+      active_seconds integer, idle_seconds integer,
+      keystrokes integer, mouse_clicks integer, mouse_moves integer
+    )
+  ),
+  inserted AS (
+    INSERT INTO public.activity_minute_buckets (
+      bucket_id, user_id, company_id, minute, app_name, domain, category,
+      active_seconds, idle_seconds, keystrokes, mouse_clicks, mouse_moves
+    )
+    SELECT bucket_id, user_id, company_id, minute, app_name, COALESCE(domain, ''), category,
+           active_seconds, idle_seconds, keystrokes, mouse_clicks, mouse_moves
+    FROM incoming
+    ON CONFLICT (bucket_id) DO NOTHING
+    RETURNING *
+  ),
+  rolled AS (
+    INSERT INTO public.daily_activity_rollups AS r (
+      user_id, company_id, day, app_name, domain, category,
+      active_seconds, idle_seconds, keystrokes, mouse_clicks, mouse_moves, minutes
+    )
+    SELECT i.user_id, max(i.company_id), (i.minute AT TIME ZONE 'UTC')::date, i.app_name, i.domain,
+           max(i.category),
+           sum(i.active_seconds), sum(i.idle_seconds), sum(i.keystrokes),
+           sum(i.mouse_clicks), sum(i.mouse_moves), count(*)
+    FROM inserted i
+    GROUP BY i.user_id, (i.minute AT TIME ZONE 'UTC')::date, i.app_name, i.domain
+    ON CONFLICT (user_id, day, app_name, domain) DO UPDATE
+    SET active_seconds = r.active_seconds + EXCLUDED.active_seconds,
+        idle_seconds = r.idle_seconds + EXCLUDED.idle_seconds,
+        keystrokes = r.keystrokes + EXCLUDED.keystrokes,
+        mouse_clicks = r.mouse_clicks + EXCLUDED.mouse_clicks,
+        mouse_moves = r.mouse_moves + EXCLUDED.mouse_moves,
+        minutes = r.minutes + EXCLUDED.minutes,
+        category = COALESCE(EXCLUDED.category, r.category),
+        updated_at = now()
+    RETURNING 1
+  )
+  SELECT count(*)::integer FROM inserted;
+END;
+$function$;
@@ -0,0 +1,48 @@
+/*
+  # Activity Sessions
+
+  ## Overview
+  Activity logs are point samples. As they are written, consecutive samples
+  of the same app (or window) are merged into session intervals, so
+  app-usage charts and AI summaries read sessions instead of samples.
+
+  ## Changes
+
+  1. `activity_sessions`
+     - `started_at` / `ended_at` interval covered by the merged samples
+     - `duration` seconds between start and end
+     - `sample_count`, `activity_sum`, `avg_activity` activity level statistics
+     - `window_title` latest window title seen in the session
+     - `status` open (may still be extended) or closed; each user has at
+       most one open session
+
+  ## Important Notes
+  - A new session starts when the app changes or the next sample arrives
+    more than SESSION_GAP_SECONDS (default 120) after the session ended
+  - Only activity logs written after this migration are sessionized
+*/
+
+CREATE TABLE IF NOT EXISTS activity_sessions (
+  session_id TEXT PRIMARY KEY,
+  user_id TEXT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+  company_id TEXT NOT NULL REFERENCES companies(company_id) ON DELETE CASCADE,
+  app_name TEXT NOT NULL,
+  window_title TEXT,
+  started_at TIMESTAMPTZ NOT NULL,
+  ended_at TIMESTAMPTZ NOT NULL,
+  duration INTEGER NOT NULL DEFAULT 0,
+  sample_count INTEGER NOT NULL DEFAULT 0,
+  activity_sum INTEGER NOT NULL DEFAULT 0,
+  avg_activity NUMERIC(5, 1) NOT NULL DEFAULT 0,
+  status TEXT NOT NULL DEFAULT 'open' CHECK (status IN ('open', 'closed')),
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_activity_sessions_user_started
+  ON activity_sessions(user_id, started_at);
+CREATE INDEX IF NOT EXISTS idx_activity_sessions_started
+  ON activity_sessions(started_at);
+CREATE INDEX IF NOT EXISTS idx_activity_sessions_open
+  ON activity_sessions(user_id) WHERE status = 'open';
+
+ALTER TABLE activity_sessions ENABLE ROW LEVEL SECURITY;
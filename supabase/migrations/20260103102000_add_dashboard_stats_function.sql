@@ -0,0 +1,92 @@
+/*
+  # Dashboard Stats Function
+
+  ## Overview
+  `GET /api/dashboard/stats` used to issue separate, overlapping
+  time_entries queries for today, week and month (each capped at 1000
+  rows), scan today's activity logs and run several counts one after
+  another. `dashboard_stats` computes all of it in one round trip.
+
+  ## Changes
+
+  1. `dashboard_stats(...)`
+     - Sums time entry durations for today, this week and this month in a
+       single scan of the earliest of the three windows
+     - Average activity level of today's activity sessions
+     - Team online / total, pending timesheets and today's screenshots
+       (team figures only when `p_include_team`)
+     - `p_user_id` restricts everything except team figures to one user
+
+  2. Indexes on (company_id, start_time) and (user_id, start_time) for the
+     time entry scan
+*/
+
+CREATE INDEX IF NOT EXISTS idx_time_entries_company_start_time
+  ON time_entries(company_id, start_time);
+CREATE INDEX IF NOT EXISTS idx_time_entries_user_start_time
+  ON time_entries(user_id, start_time);
+
+CREATE OR REPLACE FUNCTION public.dashboard_stats(
+  p_company_id text,
+  p_today timestamptz,
+  p_week_start timestamptz,
+  p_month_start timestamptz,
+  p_user_id text DEFAULT NULL,
+  p_include_team boolean DEFAULT false
+)
+RETURNS TABLE(
+  today_seconds bigint,
+  week_seconds bigint,
+  month_seconds bigint,
+  avg_activity numeric,
+  team_online integer,
+  team_total integer,
+  pending_timesheets integer,
+  screenshots_today integer
+)
+LANGUAGE sql
+STABLE
+SECURITY INVOKER
+SET search_path = public
+AS $function$
+  WITH totals AS (
+    SELECT
+      COALESCE(sum(e.duration) FILTER (WHERE e.start_time >= p_today), 0)::bigint AS today_seconds,
+      COALESCE(sum(e.duration) FILTER (WHERE e.start_time >= p_week_start), 0)::bigint AS week_seconds,
+      COALESCE(sum(e.duration) FILTER (WHERE e.start_time >= p_month_start), 0)::bigint AS month_seconds
+    FROM time_entries e
+    WHERE e.company_id = p_company_id
+      AND (p_user_id IS NULL OR e.user_id = p_user_id)
+      AND e.start_time >= LEAST(p_today, p_week_start, p_month_start)
+  ),
+  activity AS (
+    SELECT COALESCE(sum(s.activity_sum)::numeric / NULLIF(sum(s.sample_count), 0), 0) AS avg_activity
+    FROM activity_sessions s
+    WHERE s.company_id = p_company_id
+      AND (p_user_id IS NULL OR s.user_id = p_user_id)
+      AND s.started_at >= p_today
+  )
+  SELECT
+    t.today_seconds,
+    t.week_seconds,
+    t.month_seconds,
+    a.avg_activity,
+    CASE WHEN p_include_team THEN (
+      SELECT count(DISTINCT e.user_id)::integer FROM time_entries e
+      WHERE e.company_id = p_company_id AND e.status = 'active'
+    ) ELSE 0 END,
+    CASE WHEN p_include_team THEN (
+      SELECT count(*)::integer FROM users u WHERE u.company_id = p_company_id
+    ) ELSE 0 END,
+    CASE WHEN p_include_team THEN (
+      SELECT count(*)::integer FROM timesheets ts
+      WHERE ts.company_id = p_company_id AND ts.status = 'pending'
+    ) ELSE 0 END,
+    (
+      SELECT count(*)::integer FROM screenshots sc
+      WHERE sc.company_id = p_company_id
+        AND (p_user_id IS NULL OR sc.user_id = p_user_id)
+        AND sc.taken_at >= p_today
+    )
+  FROM totals t, activity a;
+$function$;
@@ -0,0 +1,300 @@
+/*
+  # Daily User Stats
+
+  ## Overview
+  Charts, benchmarks, work-life balance, burnout risk and time summary
+  reports used to rescan raw time entries and re-sum durations on every
+  request. `daily_user_stats` keeps one row per user and local day,
+  maintained incrementally by a trigger on `time_entries`, so those reads
+  become one row per user per day.
+
+  ## Changes
+
+  1. `daily_user_stats`
+     - Keyed by (`user_id`, `day`); `day` is the entry's start date in the
+       company's timezone (`companies.timezone`, default UTC)
+     - `tracked_seconds`, `idle_seconds`, `entry_count`
+     - `first_start`, `last_end` earliest start and latest end of the day
+     - `late_night_entries` entries starting at or after 20:00 local time,
+       `early_morning_entries` entries starting before 07:00 local time
+     - `is_weekend` the day is a Saturday or Sunday
+
+  2. `apply_daily_user_stats(entry, sign)` adds (+1) or removes (-1) one
+     time entry from its day; `time_entries` triggers call it on insert,
+     on relevant updates (removing the old row, adding the new one) and on
+     delete
+
+  3. `rebuild_daily_user_stats(p_company_id, p_start, p_end)` recomputes a
+     company's days from `time_entries`; used by the backfill / repair job
+     and after a company changes timezone
+
+  4. Backfill of all existing time entries
+
+  5. `dashboard_stats` reads today / week / month hours from the rollup,
+     using the company's local today
+
+  ## Important Notes
+  - An entry counts towards the day it started on, as before
+*/
+
+CREATE TABLE IF NOT EXISTS daily_user_stats (
+  user_id TEXT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+  company_id TEXT NOT NULL REFERENCES companies(company_id) ON DELETE CASCADE,
+  day DATE NOT NULL,
+  tracked_seconds BIGINT NOT NULL DEFAULT 0,
+  idle_seconds BIGINT NOT NULL DEFAULT 0,
+  entry_count INTEGER NOT NULL DEFAULT 0,
+  first_start TIMESTAMPTZ,
+  last_end TIMESTAMPTZ,
+  late_night_entries INTEGER NOT NULL DEFAULT 0,
+  early_morning_entries INTEGER NOT NULL DEFAULT 0,
+  is_weekend BOOLEAN NOT NULL DEFAULT false,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (user_id, day)
+);
+
+CREATE INDEX IF NOT EXISTS idx_daily_user_stats_company_day
+  ON daily_user_stats(company_id, day);
+
+ALTER TABLE daily_user_stats ENABLE ROW LEVEL SECURITY;
+
+CREATE OR REPLACE FUNCTION public.apply_daily_user_stats(p_entry public.time_entries, p_sign integer)
+RETURNS void
+LANGUAGE plpgsql
+SECURITY INVOKER
+SET search_path = public
+AS $function$
+DECLARE
+  v_tz text;
+  v_local timestamp;
+  v_day date;
+BEGIN
+  SELECT COALESCE(c.timezone, 'UTC') INTO v_tz FROM public.companies c WHERE c.company_id = p_entry.company_id;
+  v_local := p_entry.start_time AT TIME ZONE COALESCE(v_tz, 'UTC');
+  v_day := v_local::date;
+
+  INSERT INTO public.daily_user_stats AS d (
+    user_id, company_id, day, tracked_seconds, idle_seconds, entry_count,
+    first_start, last_end, late_night_entries, early_morning_entries, is_weekend
+  )
+  VALUES (
+    p_entry.user_id, p_entry.company_id, v_day,
+    p_sign * COALESCE(p_entry.duration, 0),
+    p_sign * COALESCE(p_entry.idle_time, 0),
+    p_sign,
+    CASE WHEN p_sign > 0 THEN p_entry.start_time END,
+    CASE WHEN p_sign > 0 THEN p_entry.end_time END,
+    CASE WHEN extract(hour FROM v_local) >= 20 THEN p_sign ELSE 0 END,
+    CASE WHEN extract(hour FROM v_local) < 7 THEN p_sign ELSE 0 END,
+    extract(isodow FROM v_day) >= 6
+  )
+  ON CONFLICT (user_id, day) DO UPDATE
+  SET tracked_seconds = d.tracked_seconds + EXCLUDED.tracked_seconds,
+      idle_seconds = d.idle_seconds + EXCLUDED.idle_seconds,
+      entry_count = d.entry_count + EXCLUDED.entry_count,
+      first_start = LEAST(d.first_start, EXCLUDED.first_start),
+      last_end = GREATEST(d.last_end, EXCLUDED.last_end),
+      late_night_entries = d.late_night_entries + EXCLUDED.late_night_entries,
+      early_morning_entries = d.early_morning_entries + EXCLUDED.early_morning_entries,
+      updated_at = now();
+
+  IF p_sign < 0 THEN
+    -- Minimum and maximum cannot be decremented; recompute them from the day's remaining entries
+    UPDATE public.daily_user_stats d
+    SET first_start = r.first_start, last_end = r.last_end
+    FROM (
+      SELECT min(e.start_time) AS first_start, max(e.end_time) AS last_end
+      FROM public.time_entries e
+      WHERE e.user_id = p_entry.user_id
+        AND e.start_time >= (v_day::timestamp AT TIME ZONE COALESCE(v_tz, 'UTC'))
+        AND e.start_time < ((v_day + 1)::timestamp AT TIME ZONE COALESCE(v_tz, 'UTC'))
+    ) r
+    WHERE d.user_id = p_entry.user_id AND d.day = v_day;
+
+    DELETE FROM public.daily_user_stats d
+    WHERE d.user_id = p_entry.user_id AND d.day = v_day AND d.entry_count <= 0;
+  END IF;
+END;
+$function$;
+
+CREATE OR REPLACE FUNCTION public.time_entries_daily_user_stats()
+RETURNS trigger
+LANGUAGE plpgsql
+SECURITY INVOKER
+SET search_path = public
+AS $function$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    PERFORM public.apply_daily_user_stats(OLD, -1);
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    PERFORM public.apply_daily_user_stats(NEW, 1);
+  END IF;
+  RETURN NULL;
+END;
+$function$;
+
+DROP TRIGGER IF EXISTS time_entries_daily_user_stats_insert_delete ON time_entries;
+CREATE TRIGGER time_entries_daily_user_stats_insert_delete
+  AFTER INSERT OR DELETE ON time_entries
+  FOR EACH ROW EXECUTE FUNCTION public.time_entries_daily_user_stats();
+
+DROP TRIGGER IF EXISTS time_entries_daily_user_stats_update ON time_entries;
+CREATE TRIGGER time_entries_daily_user_stats_update
+  AFTER UPDATE ON time_entries
+  FOR EACH ROW
+  WHEN (
+    OLD.start_time IS DISTINCT FROM NEW.start_time
+    OR OLD.end_time IS DISTINCT FROM NEW.end_time
+    OR OLD.duration IS DISTINCT FROM NEW.duration
+    OR OLD.idle_time IS DISTINCT FROM NEW.idle_time
+    OR OLD.user_id IS DISTINCT FROM NEW.user_id
+  )
+  EXECUTE FUNCTION public.time_entries_daily_user_stats();
+
+CREATE OR REPLACE FUNCTION public.rebuild_daily_user_stats(
+  p_company_id text,
+  p_start date,
+  p_end date
+)
+RETURNS TABLE(days integer)
+LANGUAGE plpgsql
+SECURITY INVOKER
+SET search_path = public
+AS $function$
+DECLARE
+  v_tz text;
+BEGIN
+  SELECT COALESCE(c.timezone, 'UTC') INTO v_tz FROM public.companies c WHERE c.company_id = p_company_id;
+  v_tz := COALESCE(v_tz, 'UTC');
+
+  DELETE FROM public.daily_user_stats d
+  WHERE d.company_id = p_company_id AND d.day BETWEEN p_start AND p_end;
+
+  RETURN QUERY
+  WITH rebuilt AS (
+    INSERT INTO public.daily_user_stats (
+      user_id, company_id, day, tracked_seconds, idle_seconds, entry_count,
+      first_start, last_end, late_night_entries, early_morning_entries, is_weekend
+    )
+    SELECT
+      e.user_id,
+      p_company_id,
+      (e.start_time AT TIME ZONE v_tz)::date,
+      sum(COALESCE(e.duration, 0)),
+      sum(COALESCE(e.idle_time, 0)),
+      count(*),
+      min(e.start_time),
+      max(e.end_time),
+      count(*) FILTER (WHERE extract(hour FROM e.start_time AT TIME ZONE v_tz) >= 20),
+      count(*) FILTER (WHERE extract(hour FROM e.start_time AT TIME ZONE v_tz) < 7),
+      extract(isodow FROM (e.start_time AT TIME ZONE v_tz)::date) >= 6
+    FROM public.time_entries e
+    WHERE e.company_id = p_company_id
+      AND e.start_time >= (p_start::timestamp AT TIME ZONE v_tz)
+      AND e.start_time < ((p_end + 1)::timestamp AT TIME ZONE v_tz)
+    GROUP BY e.user_id, (e.start_time AT TIME ZONE v_tz)::date
+    ON CONFLICT (user_id, day) DO NOTHING
+    RETURNING 1
+  )
+  SELECT count(*)::integer FROM rebuilt;
+END;
+$function$;
+
+-- Backfill existing entries
+INSERT INTO daily_user_stats (
+  user_id, company_id, day, tracked_seconds, idle_seconds, entry_count,
+  first_start, last_end, late_night_entries, early_morning_entries, is_weekend
+)
+SELECT
+  e.user_id,
+  e.company_id,
+  (e.start_time AT TIME ZONE COALESCE(c.timezone, 'UTC'))::date AS day,
+  sum(COALESCE(e.duration, 0)),
+  sum(COALESCE(e.idle_time, 0)),
+  count(*),
+  min(e.start_time),
+  max(e.end_time),
+  count(*) FILTER (WHERE extract(hour FROM e.start_time AT TIME ZONE COALESCE(c.timezone, 'UTC')) >= 20),
+  count(*) FILTER (WHERE extract(hour FROM e.start_time AT TIME ZONE COALESCE(c.timezone, 'UTC')) < 7),
+  extract(isodow FROM (e.start_time AT TIME ZONE COALESCE(c.timezone, 'UTC'))::date) >= 6
+FROM time_entries e
+JOIN companies c ON c.company_id = e.company_id
+GROUP BY e.user_id, e.company_id, c.timezone, (e.start_time AT TIME ZONE COALESCE(c.timezone, 'UTC'))::date
+ON CONFLICT (user_id, day) DO NOTHING;
+
+-- Dashboard hours now come from the rollup, in the company's timezone
+DROP FUNCTION IF EXISTS public.dashboard_stats(text, timestamptz, timestamptz, timestamptz, text, boolean);
+
+CREATE OR REPLACE FUNCTION public.dashboard_stats(
+  p_company_id text,
+  p_user_id text DEFAULT NULL,
+  p_include_team boolean DEFAULT false
+)
+RETURNS TABLE(
+  today_seconds bigint,
+  week_seconds bigint,
+  month_seconds bigint,
+  avg_activity numeric,
+  team_online integer,
+  team_total integer,
+  pending_timesheets integer,
+  screenshots_today integer
+)
+LANGUAGE sql
+STABLE
+SECURITY INVOKER
+SET search_path = public
+AS $function$
+  WITH local AS (
+    SELECT
+      tz,
+      (now() AT TIME ZONE tz)::date AS today,
+      date_trunc('week', now() AT TIME ZONE tz)::date AS week_start,
+      date_trunc('month', now() AT TIME ZONE tz)::date AS month_start
+    FROM (
+      SELECT COALESCE((SELECT c.timezone FROM companies c WHERE c.company_id = p_company_id), 'UTC') AS tz
+    ) company
+  ),
+  totals AS (
+    SELECT
+      COALESCE(sum(d.tracked_seconds) FILTER (WHERE d.day >= l.today), 0)::bigint AS today_seconds,
+      COALESCE(sum(d.tracked_seconds) FILTER (WHERE d.day >= l.week_start), 0)::bigint AS week_seconds,
+      COALESCE(sum(d.tracked_seconds) FILTER (WHERE d.day >= l.month_start), 0)::bigint AS month_seconds
+    FROM local l
+    LEFT JOIN daily_user_stats d
+      ON d.company_id = p_company_id
+      AND (p_user_id IS NULL OR d.user_id = p_user_id)
+      AND d.day >= LEAST(l.week_start, l.month_start)
+  ),
+  activity AS (
+    SELECT COALESCE(sum(s.activity_sum)::numeric / NULLIF(sum(s.sample_count), 0), 0) AS avg_activity
+    FROM activity_sessions s, local l
+    WHERE s.company_id = p_company_id
+      AND (p_user_id IS NULL OR s.user_id = p_user_id)
+      AND s.started_at >= (l.today::timestamp AT TIME ZONE l.tz)
+  )
+  SELECT
+    t.today_seconds,
+    t.week_seconds,
+    t.month_seconds,
+    a.avg_activity,
+    CASE WHEN p_include_team THEN (
+      SELECT count(DISTINCT e.user_id)::integer FROM time_entries e
+      WHERE e.company_id = p_company_id AND e.status = 'active'
+    ) ELSE 0 END,
+    CASE WHEN p_include_team THEN (
+      SELECT count(*)::integer FROM users u WHERE u.company_id = p_company_id
+    ) ELSE 0 END,
+    CASE WHEN p_include_team THEN (
+      SELECT count(*)::integer FROM timesheets ts
+      WHERE ts.company_id = p_company_id AND ts.status = 'pending'
+    ) ELSE 0 END,
+    (
+      SELECT count(*)::integer FROM screenshots sc, local l
+      WHERE sc.company_id = p_company_id
+        AND (p_user_id IS NULL OR sc.user_id = p_user_id)
+        AND sc.taken_at >= (l.today::timestamp AT TIME ZONE l.tz)
+    )
+  FROM totals t, activity a;
+$function$;
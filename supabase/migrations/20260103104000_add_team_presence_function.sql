@@ -0,0 +1,82 @@
+/*
+  # Team Presence Function
+
+  ## Overview
+  `GET /api/dashboard/team-status` used to run three queries per team
+  member. It is now answered from an in-memory presence index; when a
+  company is not in the index yet, `team_presence` loads every member's
+  state in one call.
+
+  ## Changes
+
+  1. `team_presence(p_company_id)`
+     - One row per user: profile fields, active time entry, latest activity
+       log sample and tracked seconds today (company-local day, from
+       `daily_user_stats`), plus the company's timezone
+
+  2. Index on `activity_logs(user_id, timestamp DESC)` for the latest
+     sample lookup
+*/
+
+CREATE INDEX IF NOT EXISTS idx_activity_logs_user_timestamp
+  ON activity_logs(user_id, timestamp DESC);
+
+CREATE OR REPLACE FUNCTION public.team_presence(p_company_id text)
+RETURNS TABLE(
+  user_id text,
+  name text,
+  email text,
+  role text,
+  picture text,
+  timezone text,
+  active_entry_id text,
+  active_since timestamptz,
+  last_activity_at timestamptz,
+  current_app text,
+  activity_level integer,
+  today_seconds bigint
+)
+LANGUAGE sql
+STABLE
+SECURITY INVOKER
+SET search_path = public
+AS $function$
+  WITH company AS (
+    SELECT COALESCE(c.timezone, 'UTC') AS tz
+    FROM companies c
+    WHERE c.company_id = p_company_id
+  )
+  SELECT
+    u.user_id,
+    u.name,
+    u.email,
+    u.role,
+    u.picture,
+    company.tz,
+    a.entry_id,
+    a.start_time,
+    l.timestamp,
+    l.app_name,
+    l.activity_level,
+    COALESCE(d.tracked_seconds, 0)::bigint
+  FROM users u
+  CROSS JOIN company
+  LEFT JOIN LATERAL (
+    SELECT e.entry_id, e.start_time
+    FROM time_entries e
+    WHERE e.user_id = u.user_id AND e.status = 'active'
+    ORDER BY e.start_time DESC
+    LIMIT 1
+  ) a ON true
+  LEFT JOIN LATERAL (
+    SELECT al.app_name, al.activity_level, al.timestamp
+    FROM activity_logs al
+    WHERE al.user_id = u.user_id
+    ORDER BY al.timestamp DESC
+    LIMIT 1
+  ) l ON true
+  LEFT JOIN daily_user_stats d
+    ON d.user_id = u.user_id
+    AND d.day = (now() AT TIME ZONE company.tz)::date
+  WHERE u.company_id = p_company_id;
+$function$;
@@ -0,0 +1,105 @@
+/*
+  # Company-Wide Payroll Generation
+
+  ## Overview
+  `POST /api/payroll/generate` used to read approved timesheets (capped at
+  1000 rows), look up each employee's rate separately and insert payroll
+  rows one at a time. `generate_payroll` now does the whole run in one
+  statement: it sums each employee's approved timesheet hours for the
+  period, joins their rate, computes amounts in exact `numeric`
+  arithmetic and inserts every payroll row at once, returning a summary
+  of the run.
+
+  ## Changes
+
+  1. `payroll.user_name` and `payroll.period` columns, written by the API
+     and used to filter payroll by month
+
+  2. Index on `timesheets(company_id, status, week_start)` for the period
+     scan, and on `payroll(company_id, period)`
+
+  3. `generate_payroll(p_company_id, p_period_start, p_period_end)`
+     - One `pending` payroll row per employee with approved timesheets
+       whose week starts in the period
+     - `hours` is the sum of the timesheets' `total_hours`; `amount` is
+       hours times the employee's `hourly_rate`, rounded half up to cents
+     - Returns one row: `employees`, `timesheets`, `total_hours`,
+       `total_amount` and `employees_without_rate` (rate missing or zero)
+
+  ## Important Notes
+  - Employees without a rate still get a row with a zero amount, as before
+*/
+
+ALTER TABLE payroll ADD COLUMN IF NOT EXISTS user_name TEXT;
+ALTER TABLE payroll ADD COLUMN IF NOT EXISTS period TEXT;
+
+CREATE INDEX IF NOT EXISTS idx_timesheets_company_status_week
+  ON timesheets(company_id, status, week_start);
+
+CREATE INDEX IF NOT EXISTS idx_payroll_company_period
+  ON payroll(company_id, period);
+
+CREATE OR REPLACE FUNCTION public.generate_payroll(
+  p_company_id text,
+  p_period_start date,
+  p_period_end date
+)
+RETURNS TABLE(
+  employees integer,
+  timesheets integer,
+  total_hours numeric,
+  total_amount numeric,
+  employees_without_rate integer
+)
+LANGUAGE sql
+SECURITY INVOKER
+SET search_path = public
+AS $function$
+  WITH hours AS (
+    SELECT t.user_id, SUM(COALESCE(t.total_hours, 0)) AS hours, COUNT(*) AS timesheets
+    FROM timesheets t
+    WHERE t.company_id = p_company_id
+      AND t.status = 'approved'
+      AND t.week_start BETWEEN p_period_start AND p_period_end
+    GROUP BY t.user_id
+  ),
+  lines AS (
+    SELECT
+      h.user_id,
+      u.name AS user_name,
+      h.hours,
+      h.timesheets,
+      COALESCE(u.hourly_rate, 0) AS rate,
+      ROUND(h.hours * COALESCE(u.hourly_rate, 0), 2) AS amount
+    FROM hours h
+    JOIN users u ON u.user_id = h.user_id
+  ),
+  inserted AS (
+    INSERT INTO payroll (
+      payroll_id, user_id, user_name, company_id, period_start, period_end,
+      period, hours, rate, amount, status, created_at
+    )
+    SELECT
+      'payroll_' || left(replace(gen_random_uuid()::text, '-', ''), 12),
+      l.user_id,
+      l.user_name,
+      p_company_id,
+      p_period_start,
+      p_period_end,
+      to_char(p_period_start, 'YYYY-MM'),
+      ROUND(l.hours, 2),
+      l.rate,
+      l.amount,
+      'pending',
+      now()
+    FROM lines l
+    RETURNING 1
+  )
+  SELECT
+    (SELECT COUNT(*) FROM inserted)::integer,
+    COALESCE(SUM(l.timesheets), 0)::integer,
+    COALESCE(ROUND(SUM(l.hours), 2), 0),
+    COALESCE(SUM(l.amount), 0),
+    (COUNT(*) FILTER (WHERE l.rate = 0))::integer
+  FROM lines l;
+$function$;
@@ -0,0 +1,130 @@
+/*
+  # Company-Wide Timesheet Generation
+
+  ## Overview
+  `POST /api/timesheets/generate` could only build the caller's current
+  week. `generate_timesheets` builds a week's timesheets for a whole
+  company from one scan of its time entries, grouped by user, and upserts
+  them in a single statement. Timesheets that are already approved are
+  left exactly as they are.
+
+  ## Changes
+
+  1. `timesheets.user_name` column, written by the API
+
+  2. Duplicate (`user_id`, `week_start`) timesheets are removed and a
+     unique index on `timesheets(user_id, week_start)` is added so a week
+     can be upserted
+
+  3. `generate_timesheets(p_company_id, p_week_start, p_user_id)`
+     - The week is `p_week_start` and the six days after it in the
+       company's timezone; an entry belongs to the week it started in
+     - One timesheet per user with entries in the week (only `p_user_id`
+       when given): total hours, the entries and their durations
+     - Existing timesheets for the week are updated in place, keeping
+       their id and status; approved timesheets are not touched
+     - Returns one row: `employees` with entries, `written` timesheets,
+       `approved_kept` and `hours_written`
+
+  ## Important Notes
+  - The week scan uses the `time_entries(company_id, start_time)` index
+  - Of duplicate timesheets for the same user and week, the approved one
+    (else the most recently updated) is kept
+*/
+
+ALTER TABLE timesheets ADD COLUMN IF NOT EXISTS user_name TEXT;
+
+DELETE FROM timesheets t
+USING (
+  SELECT
+    timesheet_id,
+    row_number() OVER (
+      PARTITION BY user_id, week_start
+      ORDER BY (status = 'approved') DESC, updated_at DESC NULLS LAST, created_at DESC NULLS LAST
+    ) AS rank
+  FROM timesheets
+) d
+WHERE t.timesheet_id = d.timesheet_id AND d.rank > 1;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_timesheets_user_week_unique
+  ON timesheets(user_id, week_start);
+
+CREATE OR REPLACE FUNCTION public.generate_timesheets(
+  p_company_id text,
+  p_week_start date,
+  p_user_id text DEFAULT NULL
+)
+RETURNS TABLE(
+  employees integer,
+  written integer,
+  approved_kept integer,
+  hours_written numeric
+)
+LANGUAGE plpgsql
+SECURITY INVOKER
+SET search_path = public
+AS $function$
+DECLARE
+  v_tz text;
+  v_from timestamptz;
+  v_to timestamptz;
+BEGIN
+  SELECT COALESCE(c.timezone, 'UTC') INTO v_tz FROM public.companies c WHERE c.company_id = p_company_id;
+  v_tz := COALESCE(v_tz, 'UTC');
+  v_from := p_week_start::timestamp AT TIME ZONE v_tz;
+  v_to := (p_week_start + 7)::timestamp AT TIME ZONE v_tz;
+
+  RETURN QUERY
+  WITH weeks AS (
+    SELECT
+      e.user_id,
+      SUM(COALESCE(e.duration, 0)) AS seconds,
+      jsonb_agg(
+        jsonb_build_object('entry_id', e.entry_id, 'duration', COALESCE(e.duration, 0))
+        ORDER BY e.start_time
+      ) AS entries
+    FROM public.time_entries e
+    WHERE e.company_id = p_company_id
+      AND e.start_time >= v_from
+      AND e.start_time < v_to
+      AND (p_user_id IS NULL OR e.user_id = p_user_id)
+    GROUP BY e.user_id
+  ),
+  upserted AS (
+    INSERT INTO public.timesheets AS t (
+      timesheet_id, user_id, user_name, company_id, week_start, week_end,
+      total_hours, billable_hours, status, entries, created_at, updated_at
+    )
+    SELECT
+      'timesheet_' || left(replace(gen_random_uuid()::text, '-', ''), 12),
+      w.user_id,
+      u.name,
+      p_company_id,
+      p_week_start,
+      p_week_start + 6,
+      ROUND(w.seconds / 3600.0, 2),
+      ROUND(w.seconds / 3600.0, 2),
+      'pending',
+      w.entries,
+      now(),
+      now()
+    FROM weeks w
+    JOIN public.users u ON u.user_id = w.user_id
+    ON CONFLICT (user_id, week_start) DO UPDATE
+    SET user_name = EXCLUDED.user_name,
+        week_end = EXCLUDED.week_end,
+        total_hours = EXCLUDED.total_hours,
+        billable_hours = EXCLUDED.billable_hours,
+        entries = EXCLUDED.entries,
+        updated_at = now()
+    WHERE t.status <> 'approved'
+    RETURNING t.total_hours
+  )
+  SELECT
+    (SELECT COUNT(*) FROM weeks)::integer,
+    COUNT(*)::integer,
+    ((SELECT COUNT(*) FROM weeks) - COUNT(*))::integer,
+    COALESCE(SUM(upserted.total_hours), 0)
+  FROM upserted;
+END;
+$function$;
@@ -0,0 +1,73 @@
+/*
+  # Attendance Report Function
+
+  ## Overview
+  `GET /api/attendance/report` used to query attendance once per team
+  member (at most 100 records each) and re-scan the records for every
+  figure. `attendance_report` computes every member's figures for the
+  date range in one grouped query, a page of members at a time, so the
+  API can stream the report.
+
+  ## Changes
+
+  1. `attendance.work_hours` and `attendance.overtime` columns, written
+     on clock-out
+
+  2. Index on `attendance(company_id, date)` for the range scan
+
+  3. `attendance_report(p_company_id, p_start, p_end, p_after_user_id, p_limit)`
+     - One row per company member, ordered by `user_id`, starting after
+       `p_after_user_id` and at most `p_limit` rows
+     - `total_work_hours`, `total_overtime` and the number of `present`
+       (present or late), `late` and `absent` days and of `records` in
+       `p_start`..`p_end`; members without records get zeros
+*/
+
+ALTER TABLE attendance ADD COLUMN IF NOT EXISTS work_hours NUMERIC(10,2) DEFAULT 0;
+ALTER TABLE attendance ADD COLUMN IF NOT EXISTS overtime NUMERIC(10,2) DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS idx_attendance_company_date
+  ON attendance(company_id, date);
+
+CREATE OR REPLACE FUNCTION public.attendance_report(
+  p_company_id text,
+  p_start date,
+  p_end date,
+  p_after_user_id text DEFAULT NULL,
+  p_limit integer DEFAULT 500
+)
+RETURNS TABLE(
+  user_id text,
+  name text,
+  total_work_hours numeric,
+  total_overtime numeric,
+  present_days integer,
+  late_days integer,
+  absent_days integer,
+  records integer
+)
+LANGUAGE sql
+STABLE
+SECURITY INVOKER
+SET search_path = public
+AS $function$
+  SELECT
+    u.user_id,
+    u.name,
+    COALESCE(SUM(a.work_hours), 0),
+    COALESCE(SUM(a.overtime), 0),
+    (COUNT(a.attendance_id) FILTER (WHERE a.status IN ('present', 'late')))::integer,
+    (COUNT(a.attendance_id) FILTER (WHERE a.status = 'late'))::integer,
+    (COUNT(a.attendance_id) FILTER (WHERE a.status = 'absent'))::integer,
+    COUNT(a.attendance_id)::integer
+  FROM users u
+  LEFT JOIN attendance a
+    ON a.user_id = u.user_id
+    AND a.company_id = p_company_id
+    AND a.date BETWEEN p_start AND p_end
+  WHERE u.company_id = p_company_id
+    AND (p_after_user_id IS NULL OR u.user_id > p_after_user_id)
+  GROUP BY u.user_id, u.name
+  ORDER BY u.user_id
+  LIMIT p_limit;
+$function$;
@@ -0,0 +1,70 @@
+/*
+  # Company Storage Keys Function
+
+  ## Overview
+  `POST /api/storage/presigned-url(s)` signed any key it was given.
+  `company_storage_keys` tells which of a batch of storage keys belong to
+  a company's screenshots, screen recordings or video screenshots, so only
+  those are signed.
+
+  ## Changes
+
+  1. `company_storage_keys(p_company_id, p_keys)`
+     - Returns the keys of `p_keys` that are a screenshot's `s3_key` or
+       `thumbnail_key`, or a recording's / video's `storage_key` or
+       `poster_key`, in the company
+     - A screenshot's `s3_key` only counts once the image pipeline has
+       processed it (`processed_at` set): until then it may be the
+       unblurred original of a blur-required capture
+     - Retained originals (`original_key`) are never returned
+
+  2. Indexes on the key columns looked up
+
+  ## Important Notes
+  - `video_screenshots` is only consulted when the table exists
+*/
+
+CREATE INDEX IF NOT EXISTS idx_screenshots_thumbnail_key ON screenshots(thumbnail_key);
+CREATE INDEX IF NOT EXISTS idx_screen_recordings_storage_key ON screen_recordings(storage_key);
+CREATE INDEX IF NOT EXISTS idx_screen_recordings_poster_key ON screen_recordings(poster_key);
+
+DO $$
+BEGIN
+  IF to_regclass('public.video_screenshots') IS NOT NULL THEN
+    CREATE INDEX IF NOT EXISTS idx_video_screenshots_storage_key ON video_screenshots(storage_key);
+    CREATE INDEX IF NOT EXISTS idx_video_screenshots_poster_key ON video_screenshots(poster_key);
+  END IF;
+END $$;
+
+CREATE OR REPLACE FUNCTION public.company_storage_keys(p_company_id text, p_keys text[])
+RETURNS TABLE(key text)
+LANGUAGE plpgsql
+STABLE
+SECURITY INVOKER
+SET search_path = public
+AS $function$
+BEGIN
+  RETURN QUERY
+  SELECT s.s3_key FROM screenshots s
+  WHERE s.company_id = p_company_id AND s.s3_key = ANY(p_keys) AND s.processed_at IS NOT NULL
+  UNION
+  SELECT s.thumbnail_key FROM screenshots s
+  WHERE s.company_id = p_company_id AND s.thumbnail_key = ANY(p_keys)
+  UNION
+  SELECT r.storage_key FROM screen_recordings r
+  WHERE r.company_id = p_company_id AND r.storage_key = ANY(p_keys)
+  UNION
+  SELECT r.poster_key FROM screen_recordings r
+  WHERE r.company_id = p_company_id AND r.poster_key = ANY(p_keys);
+
+  IF to_regclass('public.video_screenshots') IS NOT NULL THEN
+    RETURN QUERY EXECUTE
+      'SELECT v.storage_key FROM video_screenshots v
+       WHERE v.company_id = $1 AND v.storage_key = ANY($2)
+       UNION
+       SELECT v.poster_key FROM video_screenshots v
+       WHERE v.company_id = $1 AND v.poster_key = ANY($2)'
+    USING p_company_id, p_keys;
+  END IF;
+END;
+$function$;
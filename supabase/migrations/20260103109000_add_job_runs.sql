@@ -0,0 +1,67 @@
+/*
+  # Job Runs
+
+  ## Overview
+  The background engines (retention purge, daily stats rebuild, timesheet
+  batches) kept their "already running" lock and their progress in the
+  memory of one API worker, so with several workers the same job could
+  run concurrently and its progress was only visible to one of them.
+  `job_runs` holds one row per job and scope: which worker currently
+  claims it, until when, and the run's last saved progress.
+
+  ## Changes
+
+  1. `job_runs` table
+     - `job`, `scope` (primary key; `*` for a job that runs cluster-wide)
+     - `owner` and `lease_expires_at` of the current claim, null when free
+     - `progress` (jsonb) as last saved by the run, kept after it ends
+
+  2. `claim_job_run(p_job, p_scope, p_owner, p_lease_seconds)`
+     - Atomically claims the row, creating it when missing, unless
+       another owner's claim has not expired yet
+     - Also renews the claim when `p_owner` already holds it
+     - Returns one row: `claimed`
+
+  ## Important Notes
+  - A worker that dies mid-run loses its claim once the lease expires;
+    the next claimant resumes or restarts the job
+*/
+
+CREATE TABLE IF NOT EXISTS job_runs (
+  job TEXT NOT NULL,
+  scope TEXT NOT NULL DEFAULT '*',
+  owner TEXT,
+  lease_expires_at TIMESTAMPTZ,
+  progress JSONB,
+  updated_at TIMESTAMPTZ DEFAULT now(),
+  PRIMARY KEY (job, scope)
+);
+
+ALTER TABLE job_runs ENABLE ROW LEVEL SECURITY;
+
+CREATE OR REPLACE FUNCTION public.claim_job_run(
+  p_job text,
+  p_scope text,
+  p_owner text,
+  p_lease_seconds integer
+)
+RETURNS TABLE(claimed boolean)
+LANGUAGE sql
+SECURITY INVOKER
+SET search_path = public
+AS $function$
+  WITH claim AS (
+    INSERT INTO public.job_runs AS j (job, scope, owner, lease_expires_at, updated_at)
+    VALUES (p_job, p_scope, p_owner, now() + make_interval(secs => p_lease_seconds), now())
+    ON CONFLICT (job, scope) DO UPDATE
+    SET owner = EXCLUDED.owner,
+        lease_expires_at = EXCLUDED.lease_expires_at,
+        updated_at = now()
+    WHERE j.owner IS NULL
+       OR j.owner = p_owner
+       OR j.lease_expires_at IS NULL
+       OR j.lease_expires_at < now()
+    RETURNING 1
+  )
+  SELECT EXISTS (SELECT 1 FROM claim);
+$function$;
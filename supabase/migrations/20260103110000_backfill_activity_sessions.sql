@@ -0,0 +1,78 @@
+/*
+  # Backfill Activity Sessions
+
+  ## Overview
+  `activity_sessions` only covered activity logs written after it was
+  added, so the AI insights app-usage breakdown and productivity analysis,
+  which read sessions, showed nothing for earlier periods. This migration
+  sessionizes the earlier activity logs once.
+
+  ## Changes
+
+  1. Closed `activity_sessions` for every user's activity logs older than
+     the user's first session (all of them for users without sessions)
+     - Consecutive logs of the same app form one session; a new one starts
+       when the app changes or a log starts more than 120 seconds after
+       the previous one ended (the sessionizer's defaults)
+     - A log without `duration` stands for 60 seconds
+
+  ## Important Notes
+  - Sessions are grouped by app, like the default SESSION_GROUPING=app;
+    `window_title` is the latest one seen in the session
+  - Running it again adds nothing: afterwards every user's logs are older
+    than, or covered by, their sessions
+*/
+
+WITH samples AS (
+  SELECT
+    l.user_id,
+    l.company_id,
+    COALESCE(l.app_name, 'Unknown') AS app_name,
+    l.window_title,
+    l.timestamp AS started_at,
+    l.timestamp + make_interval(secs => COALESCE(l.duration, 60)) AS ended_at,
+    COALESCE(l.activity_level, 0) AS activity_level
+  FROM activity_logs l
+  WHERE l.timestamp IS NOT NULL
+    AND l.timestamp < COALESCE(
+      (SELECT MIN(s.started_at) FROM activity_sessions s WHERE s.user_id = l.user_id),
+      'infinity'::timestamptz
+    )
+),
+marked AS (
+  SELECT
+    samples.*,
+    CASE
+      WHEN LAG(app_name) OVER w IS DISTINCT FROM app_name
+        OR started_at > MAX(ended_at) OVER (w ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) + interval '120 seconds'
+      THEN 1 ELSE 0
+    END AS starts_session
+  FROM samples
+  WINDOW w AS (PARTITION BY user_id ORDER BY started_at)
+),
+grouped AS (
+  SELECT
+    marked.*,
+    SUM(starts_session) OVER (PARTITION BY user_id ORDER BY started_at ROWS UNBOUNDED PRECEDING) AS session_number
+  FROM marked
+)
+INSERT INTO activity_sessions (
+  session_id, user_id, company_id, app_name, window_title, started_at, ended_at,
+  duration, sample_count, activity_sum, avg_activity, status, updated_at
+)
+SELECT
+  'session_' || left(replace(gen_random_uuid()::text, '-', ''), 12),
+  user_id,
+  MIN(company_id),
+  MIN(app_name),
+  (ARRAY_AGG(window_title ORDER BY started_at DESC) FILTER (WHERE window_title IS NOT NULL))[1],
+  MIN(started_at),
+  MAX(ended_at),
+  EXTRACT(EPOCH FROM MAX(ended_at) - MIN(started_at))::integer,
+  COUNT(*)::integer,
+  SUM(activity_level)::integer,
+  ROUND(AVG(activity_level), 1),
+  'closed',
+  now()
+FROM grouped
+GROUP BY user_id, session_number;
@@ -0,0 +1,16 @@
+/*
+  # Unprocessed Screenshots Index
+
+  ## Overview
+  The image pipeline periodically re-queues stored screenshots it never
+  processed (dropped by a full queue, or queued in a worker that stopped).
+  The sweep looks them up by upload time among rows without
+  `processed_at`.
+
+  ## Changes
+
+  1. Partial index on `screenshots(created_at)` where `processed_at` is null
+*/
+
+CREATE INDEX IF NOT EXISTS idx_screenshots_unprocessed_created_at
+  ON screenshots(created_at) WHERE processed_at IS NULL;
@@ -0,0 +1,41 @@
+/*
+  # Claim Scheduled Timer Fires
+
+  ## Overview
+  The scheduled timer engine runs in every API worker, so each worker
+  fired every due schedule and employees got duplicate auto-started time
+  entries. A worker now claims a fire by inserting its
+  `timer_execution_log` row first; the row is unique per schedule,
+  instant and action, so only one worker's claim is stored and only that
+  worker starts or stops the timer.
+
+  ## Changes
+
+  1. `timer_execution_log`
+     - New `action` column ('start' or 'stop'); existing rows are starts
+     - Duplicate rows of one fire are removed, keeping the earliest
+     - Unique index on (schedule_id, scheduled_time, action)
+
+  ## Important Notes
+  - A claim is written with status 'pending' and updated once the fire is
+    executed or skipped; a worker dying in between leaves the fire
+    'pending' rather than firing it twice
+  - Time entries already duplicated by earlier double fires are left as they are
+*/
+
+ALTER TABLE timer_execution_log ADD COLUMN IF NOT EXISTS action TEXT NOT NULL DEFAULT 'start';
+
+ALTER TABLE timer_execution_log DROP CONSTRAINT IF EXISTS timer_execution_log_action_check;
+ALTER TABLE timer_execution_log
+  ADD CONSTRAINT timer_execution_log_action_check
+  CHECK (action IN ('start', 'stop'));
+
+DELETE FROM timer_execution_log t
+USING timer_execution_log d
+WHERE t.schedule_id = d.schedule_id
+  AND t.scheduled_time = d.scheduled_time
+  AND t.action = d.action
+  AND (t.created_at, t.execution_id) > (d.created_at, d.execution_id);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_timer_execution_log_fire
+  ON timer_execution_log(schedule_id, scheduled_time, action);
@@ -0,0 +1,42 @@
+/*
+  # Video Pipeline Recovery
+
+  ## Overview
+  The video pipeline queues uploads in memory, so videos queued in a
+  worker that stopped (or dropped by a full queue) stayed `pending`, and
+  jobs cut short by a restart stayed `processing`, forever. A periodic
+  sweep now queues them again: pending videos by upload time, and
+  processing ones whose job started long enough ago that its worker must
+  have stopped.
+
+  ## Changes
+
+  1. `screen_recordings` and `video_screenshots`
+     - `processing_started_at`, set when a job starts processing the video
+     - Partial indexes on the upload time of pending videos and on
+       `processing_started_at` of processing ones
+
+  ## Important Notes
+  - `video_screenshots` is only altered when the table exists
+  - Rows left `processing` before this migration have no
+    `processing_started_at` and are not picked up by the sweep
+*/
+
+ALTER TABLE screen_recordings ADD COLUMN IF NOT EXISTS processing_started_at TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS idx_screen_recordings_pending_created_at
+  ON screen_recordings(created_at) WHERE processing_status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_screen_recordings_processing_started_at
+  ON screen_recordings(processing_started_at) WHERE processing_status = 'processing';
+
+DO $$
+BEGIN
+  IF to_regclass('public.video_screenshots') IS NOT NULL THEN
+    ALTER TABLE video_screenshots ADD COLUMN IF NOT EXISTS processing_started_at TIMESTAMPTZ;
+    ALTER TABLE video_screenshots ADD COLUMN IF NOT EXISTS uploaded_at TIMESTAMPTZ;
+    CREATE INDEX IF NOT EXISTS idx_video_screenshots_pending_uploaded_at
+      ON video_screenshots(uploaded_at) WHERE processing_status = 'pending';
+    CREATE INDEX IF NOT EXISTS idx_video_screenshots_processing_started_at
+      ON video_screenshots(processing_started_at) WHERE processing_status = 'processing';
+  END IF;
+END $$;
@@ -0,0 +1,60 @@
+/*
+  # Complete Recurring Payments Function
+
+  ## Overview
+  The recurring payment processor wrote each paid schedule back as the
+  whole row it had claimed, so edits made while a run was in progress
+  (pausing a schedule, changing its amount) were reverted.
+  `complete_recurring_payments` applies only the fields a run owns, and
+  only to rows the run still holds.
+
+  ## Changes
+
+  1. `complete_recurring_payments(p_claim_id, p_updates)`
+     - `p_updates` is a JSON array of objects with `schedule_id`,
+       `next_payment_date`, `payments_made` (0 or 1), `last_payment_date`,
+       `last_payout_id` and `completed`
+     - Advances `next_payment_date`, adds `payments_made` to
+       `total_payments_made`, sets `last_payment_date` / `last_payout_id`
+       when given, deactivates completed schedules and releases the claim
+     - Rows whose `claim_id` is no longer `p_claim_id` (the lease lapsed
+       and another run took them) are left alone
+     - Returns the number of rows updated
+*/
+
+CREATE OR REPLACE FUNCTION public.complete_recurring_payments(
+  p_claim_id text,
+  p_updates jsonb
+)
+RETURNS integer
+LANGUAGE plpgsql
+SECURITY INVOKER
+SET search_path = public
+AS $function$
+DECLARE
+  v_updated integer;
+BEGIN
+  UPDATE public.recurring_payment_schedules s
+  SET next_payment_date = u.next_payment_date,
+      total_payments_made = COALESCE(s.total_payments_made, 0) + u.payments_made,
+      last_payment_date = COALESCE(u.last_payment_date, s.last_payment_date),
+      last_payout_id = COALESCE(u.last_payout_id, s.last_payout_id),
+      is_active = CASE WHEN u.completed THEN false ELSE s.is_active END,
+      claim_id = NULL,
+      claimed_until = NULL,
+      updated_at = now()
+  FROM jsonb_to_recordset(p_updates) AS u(
+    schedule_id text,
+    next_payment_date date,
+    payments_made integer,
+    last_payment_date date,
+    last_payout_id text,
+    completed boolean
+  )
+  WHERE s.schedule_id = u.schedule_id
+    AND s.claim_id = p_claim_id;
+
+  GET DIAGNOSTICS v_updated = ROW_COUNT;
+  RETURN v_updated;
+END;
+$function$;